@@ -0,0 +1,97 @@
+"""
+Parity check of the classifier preprocessing (classifier/classifier.py, PIL and NumPy only) against
+the torchvision Resize((224, 224)) + ToTensor() pipeline it replaced.
+
+Runs both on the invoices_for_testing PNGs and on JPEG encodings of them. Without JPEG draft
+decoding the inputs must be identical (up to --tolerance). With it (classifier_jpeg_draft), JPEG
+inputs may differ by at most --draft-max-diff per value and --draft-mean-diff on average; PNGs must
+still be identical. With --model-path, the classifier scores of both inputs are compared as well and
+must not change the handwritten/machinewritten decision. Exits with status 1 when a check fails.
+Needs torchvision, which the gateway itself does not.
+
+    python -m benchmarks.classifier_parity
+    python -m benchmarks.classifier_parity --model-path classifier/efficientnet_classifier_model.onnx
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+
+from classifier.classifier import INPUT_SIZE, ImageClassifier, preprocess_image
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'invoices_for_testing')
+# Accepted differences from the reference input, also checked by tests/test_classifier_parity.py
+TOLERANCE = 1e-6
+DRAFT_MAX_DIFF = 0.15
+DRAFT_MEAN_DIFF = 0.01
+
+
+def reference_input(image_bytes):
+    """The model input as computed before, with torchvision."""
+    transform = transforms.Compose([transforms.Resize(INPUT_SIZE), transforms.ToTensor()])
+    return transform(Image.open(io.BytesIO(image_bytes)).convert('RGB')).unsqueeze(0).numpy()
+
+
+def samples(samples_dir, jpeg_quality):
+    """(name, kind, encoded bytes) of every PNG sample and of its JPEG encoding."""
+    for path in sorted(glob.glob(os.path.join(samples_dir, '*.png'))):
+        with open(path, 'rb') as image_file:
+            png = image_file.read()
+        jpeg = io.BytesIO()
+        Image.open(io.BytesIO(png)).convert('RGB').save(jpeg, 'JPEG', quality=jpeg_quality)
+        name = os.path.basename(path)
+        yield name, 'png', png
+        yield name, 'jpeg', jpeg.getvalue()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples-dir', default=SAMPLES_DIR)
+    parser.add_argument('--jpeg-quality', type=int, default=90, help='Quality of the JPEG encodings of the samples.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Maximum difference of the exact preprocessing.')
+    parser.add_argument('--draft-max-diff', type=float, default=DRAFT_MAX_DIFF, help='Maximum difference per value with JPEG draft decoding.')
+    parser.add_argument('--draft-mean-diff', type=float, default=DRAFT_MEAN_DIFF, help='Maximum mean difference with JPEG draft decoding.')
+    parser.add_argument('--model-path', default=None, help='ONNX classifier, to also compare the scores.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    classifier = ImageClassifier(args.model_path, executor=None) if args.model_path else None
+    results, parity = [], True
+    for name, kind, image_bytes in samples(args.samples_dir, args.jpeg_quality):
+        expected = reference_input(image_bytes)
+        for jpeg_draft in (False, True):
+            actual = preprocess_image(image_bytes, jpeg_draft)
+            difference = np.abs(actual - expected)
+            if jpeg_draft and kind == 'jpeg':
+                ok = difference.max() <= args.draft_max_diff and difference.mean() <= args.draft_mean_diff
+            else:
+                ok = difference.max() <= args.tolerance
+            result = {
+                'image': name,
+                'kind': kind,
+                'jpeg_draft': jpeg_draft,
+                'max_diff': round(float(difference.max()), 6),
+                'mean_diff': round(float(difference.mean()), 6),
+            }
+            if classifier is not None:
+                expected_score, actual_score = classifier.score_batch([expected, actual])
+                result['score_diff'] = round(abs(actual_score - expected_score), 6)
+                ok = ok and (actual_score > 0.5) == (expected_score > 0.5)
+            result['ok'] = bool(ok)
+            parity = parity and result['ok']
+            results.append(result)
+
+    print(json.dumps({'results': results, 'parity': parity}, indent=2))
+    return 0 if parity else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
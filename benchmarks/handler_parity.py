@@ -0,0 +1,129 @@
+"""
+Parity check of the execution modes of the RetinaNet TorchServe handler
+(object_detection/torchserve/docker_handler.py) against the eager float32 model.
+
+Runs the handler in eager float32 and in the chosen mode on the invoices_for_testing images, checks
+that every detection scoring at least --threshold in one is found by the other, with the same label,
+a box IoU of at least --min-iou and a score within --score-tolerance, and reports the inference time
+of both. Exits with status 1 when a detection differs.
+
+    python -m benchmarks.handler_parity --mode script --threads 4
+    python -m benchmarks.handler_parity --mode compile --dtype bfloat16 --min-iou 0.8 --score-tolerance 0.05
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER_DIR = os.path.join(ROOT, 'object_detection', 'torchserve')
+CHECKPOINTS_DIR = os.path.join(HANDLER_DIR, 'checkpoints')
+SAMPLES_DIR = os.path.join(ROOT, 'invoices_for_testing')
+
+sys.path.insert(0, HANDLER_DIR)
+from docker_handler import INFERENCE_DTYPES, INFERENCE_MODES, DetectionModelHandler  # noqa: E402
+
+
+def iou(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection)
+
+
+def unmatched(detections, others, threshold, min_iou, score_tolerance):
+    """
+    Detections scoring at least threshold without a counterpart among others: same label, IoU of at
+    least min_iou and a score within score_tolerance. Each counterpart is used once.
+    """
+    used = set()
+    missing = []
+    for box, score, label in zip(detections['boxes'], detections['scores'], detections['labels']):
+        if score < threshold:
+            continue
+        best, best_iou = None, min_iou
+        for index, (other_box, other_score, other_label) in enumerate(zip(others['boxes'], others['scores'], others['labels'])):
+            if index in used or other_label != label or abs(other_score - score) > score_tolerance:
+                continue
+            overlap = iou(box, other_box)
+            if overlap >= best_iou:
+                best, best_iou = index, overlap
+        if best is None:
+            missing.append({'box': [round(v, 1) for v in box], 'score': round(score, 4), 'label': label})
+        else:
+            used.add(best)
+    return missing
+
+
+def timed_inference(handler, image_bytes, repeat):
+    """Detections of an image and the mean seconds of repeat runs (after one untimed run)."""
+    images, _ = handler.preprocess([{'body': image_bytes}])
+    detections = handler.inference(images)[0]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        handler.inference(images)
+    return detections, (time.perf_counter() - start) / repeat
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=INFERENCE_MODES, default='optimized', help='Execution mode checked against eager.')
+    parser.add_argument('--dtype', choices=INFERENCE_DTYPES, default='float32')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads for both runs (0 keeps the default).')
+    parser.add_argument('--model-path', default=os.path.join(CHECKPOINTS_DIR, 'best_model.pth'))
+    parser.add_argument('--weights-path', default=os.path.join(CHECKPOINTS_DIR, 'retinanet_resnet50_fpn_v2_coco-5905b1c5.pth'))
+    parser.add_argument('--compiled-model-dir', default=os.path.join(tempfile.gettempdir(), 'retinanet-compiled'),
+                        help='Where the TorchScript model and the torch.compile cache are kept.')
+    parser.add_argument('--samples-dir', default=SAMPLES_DIR)
+    parser.add_argument('--threshold', type=float, default=0.3, help='Score of the detections compared.')
+    parser.add_argument('--min-iou', type=float, default=0.9)
+    parser.add_argument('--score-tolerance', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per image and mode.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    reference = DetectionModelHandler('eager', 'float32', args.threads, args.compiled_model_dir)
+    reference.load(args.model_path, args.weights_path)
+    candidate = DetectionModelHandler(args.mode, args.dtype, args.threads, args.compiled_model_dir)
+    candidate.load(args.model_path, args.weights_path)
+
+    paths = sorted(path for path in glob.glob(os.path.join(args.samples_dir, '*'))
+                   if path.lower().endswith(('.png', '.jpg', '.jpeg')))
+    images, reference_seconds, candidate_seconds = [], 0.0, 0.0
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            image_bytes = image_file.read()
+        expected, seconds = timed_inference(reference, image_bytes, args.repeat)
+        reference_seconds += seconds
+        actual, seconds = timed_inference(candidate, image_bytes, args.repeat)
+        candidate_seconds += seconds
+        images.append({
+            'image': os.path.basename(path),
+            'detections': sum(score >= args.threshold for score in expected['scores']),
+            'missing': unmatched(expected, actual, args.threshold, args.min_iou, args.score_tolerance),
+            'extra': unmatched(actual, expected, args.threshold, args.min_iou, args.score_tolerance),
+        })
+
+    report = {
+        'mode': args.mode,
+        'dtype': args.dtype,
+        'threads': args.threads or None,
+        'images': images,
+        'eager_seconds_per_image': round(reference_seconds / max(len(paths), 1), 4),
+        'seconds_per_image': round(candidate_seconds / max(len(paths), 1), 4),
+        'speedup': round(reference_seconds / candidate_seconds, 2) if candidate_seconds else None,
+        'parity': all(not image['missing'] and not image['extra'] for image in images),
+    }
+    print(json.dumps(report, indent=2))
+    return 0 if report['parity'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
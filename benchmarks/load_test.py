@@ -0,0 +1,311 @@
+"""
+Load generator for the gateway (/predict) and the object detection service (/detect).
+
+Sends multipart requests built from the invoices_for_testing samples (PNGs, and multi-page PDFs made
+of them) from a number of concurrent clients, then reports the throughput, the latency percentiles
+and, with --pid, the CPU and memory use of the server processes. Reports can be saved as a baseline
+and later runs compared against it.
+
+    python -m benchmarks.load_test --url http://localhost:8000/predict --concurrency 8 --duration 60 \
+        --mix png=3,pdf=1 --pid 1234 --save benchmarks/results/baseline.json
+    python -m benchmarks.load_test --url http://localhost:8000/predict --concurrency 8 --duration 60 \
+        --mix png=3,pdf=1 --pid 1234 --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+from collections import Counter
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+import fitz
+import httpx
+
+from utils.latency import percentiles
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'invoices_for_testing')
+
+# Metrics compared against a baseline, and whether a higher value is better
+COMPARED = {
+    'throughput_rps': True,
+    'pages_per_second': True,
+    'latency.p50': False,
+    'latency.p95': False,
+    'latency.p99': False,
+    'error_ratio': False,
+    'process.cpu_percent_avg': False,
+    'process.rss_mb_peak': False,
+}
+
+
+class Samples:
+    """
+    Files sent by the load generator: the sample PNGs and PDFs of pdf_pages pages built from them.
+
+    With unique=True every file is made distinct (a random trailer after the PNG data, a random
+    invisible word on each PDF page) so that the gateway's result cache and single-flight do not
+    serve it without going through the models.
+    """
+    def __init__(self, samples_dir, pdf_pages, pdf_count, unique=False):
+        self.unique = unique
+        self.pngs = [(os.path.basename(path), open(path, 'rb').read()) for path in sorted(glob.glob(os.path.join(samples_dir, '*.png')))]
+        if not self.pngs:
+            raise SystemExit(f'No PNG samples in {samples_dir}')
+        self.pdf_pages = pdf_pages
+        self.pdfs = [(f'invoice_{i}.pdf', self.build_pdf(i)) for i in range(pdf_count)]
+
+    def build_pdf(self, offset, marker=None):
+        """A PDF whose pages are the sample PNGs, starting from the offset-th one."""
+        doc = fitz.open()
+        for page_number in range(self.pdf_pages):
+            _, contents = self.pngs[(offset + page_number) % len(self.pngs)]
+            image = fitz.open(stream=contents, filetype='png')
+            rect = image[0].rect
+            page = doc.new_page(width=rect.width, height=rect.height)
+            page.insert_image(rect, stream=contents)
+            if marker is not None:
+                page.insert_text((2, 8), f'{marker}-{page_number}', fontsize=4, color=(1, 1, 1))
+        return doc.tobytes()
+
+    async def pick(self, kind, rng):
+        """A (filename, contents, pages) sample of the given kind ('png' or 'pdf')."""
+        if kind == 'png':
+            filename, contents = rng.choice(self.pngs)
+            if self.unique:
+                contents += rng.randbytes(16)
+            return filename, contents, 1
+        index = rng.randrange(len(self.pdfs))
+        filename, contents = self.pdfs[index]
+        if self.unique:
+            contents = await asyncio.to_thread(self.build_pdf, index, rng.getrandbits(64))
+        return filename, contents, self.pdf_pages
+
+
+class ProcessSampler:
+    """
+    Samples the CPU use and resident memory of server processes (and their children) from /proc
+    every interval seconds while the load runs. Linux only.
+    """
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.cpu_percent = []
+        self.rss_mb = []
+
+    def tree(self):
+        pids, pending = [], list(self.pids)
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                with open(f'/proc/{pid}/task/{pid}/children') as children:
+                    pending.extend(int(child) for child in children.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def read(self):
+        """Total CPU time (seconds) and resident memory (MB) of the processes."""
+        cpu_seconds, rss_kb = 0.0, 0
+        for pid in self.tree():
+            try:
+                with open(f'/proc/{pid}/stat') as stat:
+                    fields = stat.read().rsplit(')', 1)[1].split()
+                cpu_seconds += (int(fields[11]) + int(fields[12])) / self.ticks
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('VmRSS:'):
+                            rss_kb += int(line.split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+        return cpu_seconds, rss_kb / 1024
+
+    async def run(self):
+        previous_cpu, _ = self.read()
+        previous_time = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.interval)
+            cpu, rss = self.read()
+            now = time.perf_counter()
+            self.cpu_percent.append(100 * (cpu - previous_cpu) / (now - previous_time))
+            self.rss_mb.append(rss)
+            previous_cpu, previous_time = cpu, now
+
+    def report(self):
+        if not self.cpu_percent:
+            return {}
+        return {
+            'cpu_percent_avg': round(sum(self.cpu_percent) / len(self.cpu_percent), 1),
+            'cpu_percent_max': round(max(self.cpu_percent), 1),
+            'rss_mb_avg': round(sum(self.rss_mb) / len(self.rss_mb), 1),
+            'rss_mb_peak': round(max(self.rss_mb), 1),
+        }
+
+
+def parse_mix(mix):
+    """'png=3,pdf=1' -> (['png', 'pdf'], [3.0, 1.0])"""
+    kinds, weights = [], []
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('png', 'pdf'):
+            raise SystemExit(f'Unknown file kind in --mix: {kind}')
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+async def send_request(client, args, samples, rng, kinds, weights):
+    """Post one request; returns its latency, status code (None on a transport error) and page count."""
+    files, file_ids, pages = [], [], 0
+    for i in range(args.files_per_request):
+        filename, contents, file_pages = await samples.pick(rng.choices(kinds, weights)[0], rng)
+        files.append(('files', (filename, contents)))
+        file_ids.append(str(i))
+        pages += file_pages
+    start = time.perf_counter()
+    try:
+        response = await client.post(args.url, data={'file_id': file_ids}, files=files)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return time.perf_counter() - start, status, pages
+
+
+async def run_load(args):
+    kinds, weights = parse_mix(args.mix)
+    samples = Samples(args.samples_dir, args.pdf_pages, args.pdf_count, args.unique)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        rng = random.Random(args.seed)
+        for _ in range(args.warmup):
+            await send_request(client, args, samples, rng, kinds, weights)
+
+        sampler = ProcessSampler(args.pid) if args.pid else None
+        sampler_task = asyncio.create_task(sampler.run()) if sampler else None
+        sent = 0
+        start = time.perf_counter()
+        stop = start + args.duration if args.duration else None
+
+        async def client_loop(client_index):
+            nonlocal sent
+            client_rng = random.Random(None if args.seed is None else args.seed + client_index)
+            while (stop is None or time.perf_counter() < stop) and (args.requests is None or sent < args.requests):
+                sent += 1
+                results.append(await send_request(client, args, samples, client_rng, kinds, weights))
+
+        await asyncio.gather(*(client_loop(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        if sampler_task:
+            sampler_task.cancel()
+    return build_report(args, results, elapsed, sampler)
+
+
+def build_report(args, results, elapsed, sampler):
+    latencies = [latency for latency, status, _ in results if status == 200]
+    errors = sum(1 for _, status, _ in results if status != 200)
+    pages = sum(file_pages for _, status, file_pages in results if status == 200)
+    report = {
+        'label': args.label,
+        'url': args.url,
+        'settings': {
+            'concurrency': args.concurrency, 'duration': args.duration, 'requests': args.requests, 'mix': args.mix,
+            'files_per_request': args.files_per_request, 'pdf_pages': args.pdf_pages, 'unique': args.unique,
+        },
+        'requests': len(results),
+        'errors': errors,
+        'error_ratio': round(errors / len(results), 4) if results else 0.0,
+        'status_codes': dict(Counter(str(status) for _, status, _ in results)),
+        'duration_seconds': round(elapsed, 2),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'pages_per_second': round(pages / elapsed, 2),
+        'latency': {},
+        'process': sampler.report() if sampler else {},
+    }
+    if latencies:
+        p50, p95, p99 = percentiles(latencies, [50, 95, 99])
+        report['latency'] = {
+            'mean': round(sum(latencies) / len(latencies), 4), 'p50': round(p50, 4), 'p95': round(p95, 4),
+            'p99': round(p99, 4), 'max': round(max(latencies), 4),
+        }
+    return report
+
+
+def metric(report, name):
+    value = report
+    for key in name.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(report, baseline, tolerance):
+    """
+    Print the compared metrics next to the baseline and return the regressions: metrics that got
+    worse by more than tolerance (a ratio of the baseline value).
+    """
+    regressions = []
+    print(f"\n{'metric':<26}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in COMPARED.items():
+        old, new = metric(baseline, name), metric(report, name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<26}{old:>12}{new:>12}{change:>+10.1%}{flag}')
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000/predict',
+                        help='Endpoint to load: the gateway /predict or the object detection /detect.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients.')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds of load (0 to only use --requests).')
+    parser.add_argument('--requests', type=int, default=None, help='Stop after this many requests.')
+    parser.add_argument('--warmup', type=int, default=2, help='Requests sent before measuring.')
+    parser.add_argument('--mix', default='png=3,pdf=1', help='Relative share of each file kind.')
+    parser.add_argument('--files-per-request', type=int, default=1)
+    parser.add_argument('--pdf-pages', type=int, default=5, help='Pages of the generated PDFs.')
+    parser.add_argument('--pdf-count', type=int, default=3, help='Distinct PDFs generated.')
+    parser.add_argument('--unique', action='store_true', help='Make every file distinct to bypass the result cache.')
+    parser.add_argument('--samples-dir', default=SAMPLES_DIR)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--pid', type=int, action='append', help='Server process to sample (repeatable).')
+    parser.add_argument('--label', default=None, help='Name of the run, stored in the report.')
+    parser.add_argument('--save', help='Write the report (JSON) to this file, e.g. to use it as a baseline.')
+    parser.add_argument('--compare', help='Baseline report to compare this run against.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative change of a compared metric counted as a regression.')
+    args = parser.parse_args(argv)
+    if not args.duration and args.requests is None:
+        parser.error('--duration 0 requires --requests')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_load(args))
+    print(json.dumps(report, indent=2))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
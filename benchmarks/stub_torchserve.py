@@ -0,0 +1,119 @@
+"""
+Stand-in for the TorchServe prediction endpoints (RetinaNet and LayoutLMv3), used to load-test the
+gateway and the object detection service without GPUs or models.
+
+Every prediction waits for a latency drawn from the configured distribution and answers with a
+response of the same shape as the real model, with a configurable number of detections or labels.
+
+    python -m benchmarks.stub_torchserve --port 8080 --latency lognormal --median 0.08 --sigma 0.4
+"""
+import argparse
+import asyncio
+import math
+import random
+
+from fastapi import FastAPI, Request, Response
+import uvicorn
+
+LMV3_LABELS = ['O', 'B-title', 'I-title', 'B-date', 'I-date', 'B-ieee', 'I-ieee', 'B-total', 'I-total', 'B-totalValue', 'I-totalValue']
+
+app = FastAPI()
+settings = argparse.Namespace(
+    latency='constant', median=0.05, sigma=0.5, low=0.02, high=0.1,
+    tail_ratio=0.0, tail_latency=1.0, error_ratio=0.0, boxes=3, labels=64, seed=None,
+)
+calls = {'retinanet': 0, 'retinanet_images': 0, 'lmv3': 0, 'errors': 0}
+
+
+def draw_latency():
+    """Seconds to wait before answering a prediction, drawn from the configured distribution."""
+    if settings.tail_ratio and random.random() < settings.tail_ratio:
+        return settings.tail_latency
+    if settings.latency == 'uniform':
+        return random.uniform(settings.low, settings.high)
+    if settings.latency == 'lognormal':
+        return random.lognormvariate(math.log(settings.median), settings.sigma)
+    if settings.latency == 'exponential':
+        return random.expovariate(1 / settings.median)
+    return settings.median
+
+
+async def predict(model):
+    """Wait like a model would, then tell whether the prediction fails (503) or not."""
+    calls[model] += 1
+    await asyncio.sleep(draw_latency())
+    if settings.error_ratio and random.random() < settings.error_ratio:
+        calls['errors'] += 1
+        return False
+    return True
+
+
+def detections(count):
+    """RetinaNet response with count boxes, alternately stamps and signatures (labels 1 and 2)."""
+    boxes, scores, labels = [], [], []
+    for i in range(count):
+        x, y = random.uniform(0, 1500), random.uniform(0, 2000)
+        boxes.append([x, y, x + random.uniform(50, 400), y + random.uniform(30, 200)])
+        scores.append(round(random.uniform(0.3, 0.99), 4))
+        labels.append(1 + i % 2)
+    return {'boxes': boxes, 'scores': scores, 'labels': labels}
+
+
+@app.get('/ping')
+async def ping():
+    return {'status': 'Healthy'}
+
+
+@app.post('/predictions/retinanet')
+async def retinanet(request: Request):
+    """Detections of a single image, or the list of the detections of the image_<i> parts of a multi-image request."""
+    form = await request.form()
+    images = sum(1 for name in form.keys() if name.startswith('image_'))
+    calls['retinanet_images'] += images or 1
+    if not await predict('retinanet'):
+        return Response(status_code=503)
+    if images:
+        return [detections(settings.boxes) for _ in range(images)]
+    return detections(settings.boxes)
+
+
+@app.post('/predictions/{model_name}')
+async def lmv3(model_name: str, request: Request):
+    await request.body()
+    if not await predict('lmv3'):
+        return Response(status_code=503)
+    return [random.choice(LMV3_LABELS) for _ in range(settings.labels)]
+
+
+@app.get('/calls')
+async def get_calls():
+    """Number of predictions served so far, per model, and of images sent to RetinaNet."""
+    return calls
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', choices=['constant', 'uniform', 'lognormal', 'exponential'], default='constant',
+                        help='Latency distribution of the predictions.')
+    parser.add_argument('--median', type=float, default=0.05,
+                        help='Latency (constant), median (lognormal) or mean (exponential), in seconds.')
+    parser.add_argument('--sigma', type=float, default=0.5, help='Shape of the lognormal distribution.')
+    parser.add_argument('--low', type=float, default=0.02, help='Lower bound of the uniform distribution.')
+    parser.add_argument('--high', type=float, default=0.1, help='Upper bound of the uniform distribution.')
+    parser.add_argument('--tail-ratio', type=float, default=0.0,
+                        help='Share of the predictions that take --tail-latency instead (stragglers).')
+    parser.add_argument('--tail-latency', type=float, default=1.0)
+    parser.add_argument('--error-ratio', type=float, default=0.0, help='Share of the predictions answered with 503.')
+    parser.add_argument('--boxes', type=int, default=3, help='Detections per RetinaNet response.')
+    parser.add_argument('--labels', type=int, default=64, help='Labels per LayoutLMv3 response.')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    vars(settings).update({key: value for key, value in vars(args).items() if key not in ('host', 'port')})
+    random.seed(settings.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
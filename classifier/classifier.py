@@ -1,31 +1,100 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import onnxruntime as ort
 import io
 from PIL import Image
-from torchvision import transforms
 import logging
+import time
+
+from utils.batching import MicroBatcher
+from utils.metrics import observe_stage
+
+# Input resolution of the EfficientNet classifier
+INPUT_SIZE = (224, 224)
+
+def preprocess_image(image_bytes, jpeg_draft=False):
+    """
+    Decode and resize an image to the 1x3x224x224 float32 model input, scaled to [0, 1].
+    Matches torchvision's Resize((224, 224)) + ToTensor() on PIL images, using only PIL and NumPy.
+    With jpeg_draft, JPEGs are decoded at a reduced scale first, which departs from it slightly
+    (see benchmarks/classifier_parity.py).
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    if jpeg_draft:
+        image.draft('RGB', INPUT_SIZE)  # No-op for formats other than JPEG
+    image = image.convert('RGB').resize(INPUT_SIZE, Image.BILINEAR)
+    image = np.asarray(image, dtype=np.float32) / np.float32(255)
+    image = image.transpose(2, 0, 1)  # HWC -> CHW
+    return np.ascontiguousarray(image[np.newaxis])  # Add batch dimension
+
+# Classifier owned by each worker process when running with executor='process'
+_process_classifier = None
+
+def _init_process_classifier(model_path, jpeg_draft):
+    global _process_classifier
+    _process_classifier = ImageClassifier(model_path, executor=None, jpeg_draft=jpeg_draft)
+
+def _classify_timed_in_process(image_bytes):
+    return _process_classifier.classify_bytes_timed(image_bytes)
+
+def _preprocess_in_process(image_bytes):
+    return _process_classifier.preprocess_image(image_bytes)
+
+def _score_in_process(inputs):
+    return _process_classifier.score_batch(inputs)
+
+def _classify_batch_in_process(images_bytes):
+    return _process_classifier.classify_batch(images_bytes)
 
 class ImageClassifier:
-    def __init__(self, model_path):
+    """
+    EfficientNet handwritten/machinewritten classifier backed by ONNX Runtime.
+
+    Parameters:
+    - model_path: Path to the ONNX model.
+    - executor: 'thread' or 'process' pool used by classify_async, so decoding, resizing and
+      inference never run on the asyncio event loop. None disables the pool.
+    - max_workers: Size of the pool.
+    - max_batch_size: When greater than 1, classify_async calls from all in-flight requests are
+      coalesced into batched ONNX runs of up to this many images.
+    - max_batch_wait: Maximum time (seconds) a classification waits for its batch to fill.
+    - jpeg_draft: Let PIL decode JPEGs directly at a reduced scale (still at least 224x224)
+      instead of decoding the full resolution image only to shrink it. Faster, but the inputs of
+      JPEGs are no longer identical to the full-resolution preprocessing.
+    """
+    def __init__(self, model_path, executor='thread', max_workers=2, max_batch_size=1, max_batch_wait=0.005, jpeg_draft=False):
         self.session = ort.InferenceSession(model_path)
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-        ])
+        self.jpeg_draft = jpeg_draft
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        # Models exported with a fixed batch dimension can only be run that many images at a time
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.model_batch_size = batch_dim if isinstance(batch_dim, int) else None
+
+        self.process_pool = executor == 'process'
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_process_classifier, initargs=(model_path, jpeg_draft))
+        elif executor == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='classifier')
+        elif executor is None:
+            self.executor = None
+        else:
+            raise ValueError(f"Unknown classifier executor: {executor}")
+
+        self.batcher = None
+        if max_batch_size > 1 and self.executor is not None:
+            self.batcher = MicroBatcher(self._score_batch_async, max_batch_size=max_batch_size,
+                                        max_wait=max_batch_wait, max_concurrent_batches=max_workers)
 
     def preprocess_image(self, image_bytes):
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        image = self.transform(image)
-        image = image.unsqueeze(0)  # Add batch dimension
-        return image.numpy()
+        return preprocess_image(image_bytes, self.jpeg_draft)
 
     def sigmoid(self, x):
         return 1 / (1 + np.exp(-x))
 
     def classify_image(self, input_data):
-        input_name = self.session.get_inputs()[0].name
-        output_name = self.session.get_outputs()[0].name
-        result = self.session.run([output_name], {input_name: input_data})
+        result = self.session.run([self.output_name], {self.input_name: input_data})
         result_sigmoid = self.sigmoid(result[0])
 
         # Determine if the result is handwritten or machinewritten
@@ -38,3 +107,74 @@ class ImageClassifier:
         logging.info(f"returned result, is it handwritten? : {is_handwritten}")
 
         return is_handwritten  # Return True if handwritten, False if machinewritten
+
+    def score_batch(self, inputs):
+        """
+        Run the model once over a list of preprocessed images (each of shape 1x3x224x224)
+        and return the sigmoid score of each image, in order.
+        """
+        step = self.model_batch_size or len(inputs)
+        scores = []
+        for start in range(0, len(inputs), step):
+            batch = np.concatenate(inputs[start:start + step], axis=0)
+            result = self.session.run([self.output_name], {self.input_name: batch})
+            scores.extend(float(score) for score in self.sigmoid(result[0]).reshape(len(batch), -1)[:, 0])
+        logging.info(f"Sigmoid outputs for a batch of {len(inputs)}: {scores}")
+        return scores
+
+    def classify_batch(self, images_bytes):
+        """
+        Classify many encoded images with batched inference (blocking).
+        Returns one boolean per image: True if handwritten, False if machinewritten.
+        """
+        inputs = [self.preprocess_image(image_bytes) for image_bytes in images_bytes]
+        return [score > 0.5 for score in self.score_batch(inputs)]
+
+    def classify_bytes_timed(self, image_bytes):
+        """Preprocess and classify an encoded image (blocking), also returning the preprocessing and inference durations (seconds)."""
+        start = time.perf_counter()
+        input_data = self.preprocess_image(image_bytes)
+        preprocessed = time.perf_counter()
+        is_handwritten = self.classify_image(input_data)
+        return is_handwritten, preprocessed - start, time.perf_counter() - preprocessed
+
+    async def _run_in_executor(self, thread_func, process_func, *args):
+        if self.executor is None:
+            raise RuntimeError("Asynchronous classification requires an executor")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, process_func if self.process_pool else thread_func, *args)
+
+    async def _score_batch_async(self, inputs):
+        return await self._run_in_executor(self.score_batch, _score_in_process, inputs)
+
+    async def classify_async(self, image_bytes):
+        """
+        Classify an encoded image on the classifier pool without blocking the event loop.
+        With batching enabled, the inference is shared with concurrent callers.
+        Returns True if the image is handwritten, False if machinewritten.
+        """
+        if self.batcher is None:
+            is_handwritten, preprocess_seconds, inference_seconds = await self._run_in_executor(
+                self.classify_bytes_timed, _classify_timed_in_process, image_bytes)
+            observe_stage('classifier_preprocess', preprocess_seconds)
+            observe_stage('classifier_inference', inference_seconds)
+            return is_handwritten
+        start = time.perf_counter()
+        input_data = await self._run_in_executor(self.preprocess_image, _preprocess_in_process, image_bytes)
+        preprocessed = time.perf_counter()
+        observe_stage('classifier_preprocess', preprocessed - start)
+        score = await self.batcher.submit(input_data)
+        observe_stage('classifier_inference', time.perf_counter() - preprocessed)  # Including the wait for the batch to fill
+        return score > 0.5
+
+    async def classify_batch_async(self, images_bytes):
+        """Awaitable classify_batch for callers that already hold many pages."""
+        if self.batcher is not None:
+            return list(await asyncio.gather(*[self.classify_async(image_bytes) for image_bytes in images_bytes]))
+        return await self._run_in_executor(self.classify_batch, _classify_batch_in_process, images_bytes)
+
+    def shutdown(self):
+        if self.batcher is not None:
+            self.batcher.stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,20 +1,27 @@
 import logging
-from typing import List
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import JSONResponse
-import httpx
-import aiofiles
-import tempfile
-import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, File, Form, Header, HTTPException, Query, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 import json
 
 from classifier.classifier import ImageClassifier
+from middleware.admission import AdmissionMiddleware
+from middleware.body_limit import RequestSizeLimitMiddleware
 from middleware.cors_setup import add_cors_middleware
 from middleware.ip_whitelist import IPWhitelistMiddleware
-from utils.postprocessing import process_torch_serve_response, aggregate_results
-from utils.pdf_to_png import convert_pdf_to_png
-
-app = FastAPI()
+from utils.admission import AdmissionQueue, Overloaded, RateLimiter
+from utils.backend_client import BackendClients
+from utils.degradation import DegradationPolicy
+from utils.image_normalize import ImageNormalizer
+from utils.jobs import JobQueue
+from utils.metrics import ADMISSION_REJECTIONS, REQUESTS_IN_FLIGHT, latest_metrics
+from utils.pipeline import InvoicePipeline
+from utils.result_cache import ResultCache
+from utils.streaming import MEDIA_TYPES, stream_predictions
+from utils.tracing import TRACE_MODES, Trace, current_trace
+from utils.uploads import SpooledUpload, spooling_route
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -22,80 +29,315 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 with open('config.json') as config_file:
     config = json.load(config_file)
 
-#IP_whitelist
+# URLs for various services; each can be a single URL or a list of replicas
+retinanet_url = config['retinanet_torch_serve_url']
+LMv3_machine_url = config['LMv3_machine_torch_serve_url']
+LMv3_hand_url = config['LMv3_hand_torch_serve_url']
+
+# Pooled HTTP clients shared by every request, one connection pool per backend replica
+backend_clients = BackendClients(
+    {'retinanet': retinanet_url, 'LMv3_machine': LMv3_machine_url, 'LMv3_hand': LMv3_hand_url},
+    pools=config['backend_pools'],
+    http2=config['backend_http2'],
+    max_retries=config['backend_max_retries'],
+    failure_threshold=config['backend_failure_threshold'],
+    open_seconds=config['backend_open_seconds'],
+    health_interval=config['backend_health_interval'],
+    health_timeout=config['backend_health_timeout'],
+    hedging=config['backend_hedging'],
+)
+
+@asynccontextmanager
+async def lifespan(app):
+    backend_clients.open()
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    pipeline.close()
+    await backend_clients.close()
+    efficientnet_classifier.shutdown()
+    if result_cache is not None:
+        result_cache.close()
+
+app = FastAPI(lifespan=lifespan)
+# Uploaded files above the threshold are spooled to disk while the multipart body is parsed
+app.router.route_class = spooling_route(config['upload_spool_threshold_bytes'])
+
+# Oversized requests are rejected before their body is buffered
+app.add_middleware(RequestSizeLimitMiddleware, max_body_bytes=config['max_request_bytes'])
+
+def count_rejection(reason):
+    ADMISSION_REJECTIONS.labels(reason=reason).inc()
+
+# Admission control: a global budget of pages in flight with a bounded wait queue, and optional
+# per-client rate limits. Clients over their rate or arriving at a full queue are turned away before
+# their body is read, with a Retry-After header
+admission_queue = AdmissionQueue(
+    config['admission_max_pages'],
+    max_queued_requests=config['admission_max_queued_requests'],
+    max_queue_wait=config['admission_max_queue_wait_seconds'],
+    service='gateway',
+    on_reject=count_rejection,
+)
+rate_limiter = (RateLimiter(config['rate_limit_per_second'], config['rate_limit_burst'], on_reject=count_rejection)
+                if config['rate_limit_per_second'] else None)
+app.add_middleware(AdmissionMiddleware, paths=['/predict', '/predict/stream'], queue=admission_queue,
+                   rate_limiter=rate_limiter, api_key_header=config['api_key_header'])
+
+#IP_whitelist, checked before the request body is read
 allow_all_ips = "*" in config['allowed_ips'] or "0.0.0.0" in config['allowed_ips']
-app.add_middleware(IPWhitelistMiddleware, allowlist=config['allowed_ips'], allow_all=allow_all_ips)
+app.add_middleware(IPWhitelistMiddleware, allowlist=config['allowed_ips'], allow_all=allow_all_ips,
+                   trusted_proxies=config['trusted_proxies'])
 
 # Add CORS middleware
 add_cors_middleware(app)
 
-# URLs for various services
-retinanet_url = config['retinanet_torch_serve_url']
-LMv3_machine_url = config['LMv3_machine_torch_serve_url']
-LMv3_hand_url = config['LMv3_hand_torch_serve_url']
+# Initialize the classifier with the ONNX model path; inference runs on its own worker pool
+efficientnet_classifier = ImageClassifier(
+    "./classifier/efficientnet_classifier_model.onnx",
+    executor=config['classifier_executor'],
+    max_workers=config['classifier_workers'],
+    max_batch_size=config['classifier_max_batch_size'],
+    max_batch_wait=config['classifier_max_batch_wait'],
+    jpeg_draft=config['classifier_jpeg_draft'],
+)
 
-# Initialize the classifier with the ONNX model path
-efficientnet_classifier = ImageClassifier("./classifier/efficientnet_classifier_model.onnx")
+# Persistent per-stage result cache, keyed by page hash and model version
+result_cache = ResultCache(config['result_cache_path'], max_bytes=config['result_cache_max_bytes']) if config['result_cache'] else None
+# Page images are downscaled and re-encoded per backend; the profiles, like the classifier's JPEG decoding mode, are part of the cache keys
+normalizer = ImageNormalizer(config['image_normalization'])
+model_versions = config['model_versions']
+model_ids = {
+    'retinanet': f"retinanet-{model_versions['retinanet']}-t{config['threshold']}-{normalizer.profile_id('retinanet')}",
+    'classifier': f"efficientnet-{model_versions['classifier']}-{'jpegdraft' if config['classifier_jpeg_draft'] else 'full'}",
+    'LMv3_machine': f"LMv3_machine-{model_versions['LMv3_machine']}-{normalizer.profile_id('LMv3_machine')}",
+    'LMv3_hand': f"LMv3_hand-{model_versions['LMv3_hand']}-{normalizer.profile_id('LMv3_hand')}",
+}
 
-@app.post("/predict")
-async def process_images(file_id: List[str] = Form(...), files: List[UploadFile] = File(...)):
+# Page pipeline shared by all requests; the global concurrency cap applies across requests
+pipeline = InvoicePipeline(
+    efficientnet_classifier, backend_clients,
+    concurrent=config['concurrent_execution'],
+    max_concurrent_pages=config['max_concurrent_pages'],
+    max_concurrent_pages_per_request=config['max_concurrent_pages_per_request'],
+    single_flight=config['single_flight'],
+    cache=result_cache,
+    model_ids=model_ids,
+    pdf_render_buffer_pages=config['pdf_render_buffer_pages'],
+    max_request_memory_bytes=config['max_request_memory_bytes'],
+    max_upload_memory_bytes=config['max_upload_memory_bytes'],
+    normalizer=normalizer,
+    request_deadline=config['request_deadline_seconds'],
+    stage_budgets=config['stage_budgets'],
+    presence_target_fields=config['presence_only']['target_fields'],
+    presence_page_order=config['presence_only']['page_order'],
+    presence_max_pages_in_flight=config['presence_only']['max_pages_in_flight'],
+    detection_batch_size=config['retinanet_max_images_per_call'],
+    detection_batch_wait=config['retinanet_max_batch_wait'],
+    detection_concurrent_batches=config['retinanet_max_concurrent_calls'],
+)
+
+# Degradable requests get object detection only while the LayoutLMv3 backends are overloaded
+degradation_config = config['degradation']
+degradation_policy = DegradationPolicy(
+    backend_clients,
+    enabled=degradation_config['enabled'],
+    mode=degradation_config['mode'],
+    max_in_flight=degradation_config['max_lmv3_in_flight'],
+    max_latency=degradation_config['max_lmv3_latency_seconds'],
+    percentile=degradation_config['percentile'],
+    latency_window=degradation_config['latency_window_seconds'],
+    hold_seconds=degradation_config['hold_seconds'],
+)
+
+# Durable queue for bulk batches, processed in the background by the same pipeline. The deferred
+# field extraction of degraded requests waits until the LayoutLMv3 backends are no longer overloaded
+job_queue = JobQueue(
+    config['jobs_db_path'], pipeline,
+    workers=config['job_workers'],
+    retention_seconds=config['job_retention_seconds'],
+    hold_deferred=degradation_policy.degraded,
+    callback_allowed_hosts=config['job_callback_allowed_hosts'],
+)
+
+def check_uploads(file_id, files):
+    """Reject a request whose form fields do not match its files, or with a file above max_file_bytes."""
     if len(files) != len(file_id):
         raise HTTPException(status_code=400, detail="Number of file_id and files must be equal.")
+    for file in files:
+        if file.size is not None and file.size > config['max_file_bytes']:
+            raise HTTPException(status_code=413, detail=f"File {file.filename} exceeds {config['max_file_bytes']} bytes.")
+
+def close_uploads(uploads):
+    for upload in uploads:
+        upload.close()
+
+async def admit(files):
+    """Reserve the pages of a request in the admission budget; 503 with Retry-After when the gateway is overloaded."""
+    try:
+        return await admission_queue.acquire(await pipeline.count_pages(files))
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers())
+
+def finish_stream(uploads, pages):
+    close_uploads(uploads)
+    admission_queue.release(pages)
+
+async def degrade(endpoint, degradable, file_id, uploads):
+    """
+    Degradation of a request: None when it is not degradable, else {'degraded': ...}. A degraded request
+    gets object detection only; in defer mode its uploads (SpooledUpload) are queued as a deferred job,
+    whose id is returned as 'fields_job_id' for GET /jobs/{job_id}. The job stays queued until the
+    LayoutLMv3 backends are no longer overloaded, then computes the complete results, reusing the
+    detections this request left in the result cache.
+    """
+    if not degradable:
+        return None
+    if not degradation_policy.degrade(endpoint):
+        return {'degraded': False}
+    if degradation_policy.mode == 'skip':
+        return {'degraded': True}
+    return {'degraded': True, 'fields_job_id': await job_queue.submit(file_id, uploads, deferred=True)}
+
+@app.post("/predict")
+async def process_images(
+    file_id: List[str] = Form(...),
+    files: List[UploadFile] = File(...),
+    trace: Optional[str] = Query(None, pattern='^(server-timing|full)$'),
+    x_trace: Optional[str] = Header(None),
+    degradable: bool = Query(False),
+    presence_only: bool = Query(False),
+):
+    """
+    Detections and field predictions of every uploaded image and PDF, in upload order.
+    With trace=server-timing (or the X-Trace header), the time spent in each stage and backend is
+    returned in a Server-Timing header; with trace=full, each file result also gets its spans in 'timings'.
+    With degradable=true, the request may get detections only while the LayoutLMv3 backends are
+    overloaded; each result then says whether it is 'degraded'.
+    With presence_only=true, the pages of a PDF stop being analysed once every class and target field was found.
+    """
+    check_uploads(file_id, files)
+    trace_mode = trace or (x_trace if x_trace in TRACE_MODES else None)
+    pages = await admit(files)
+
+    # Degradable uploads may also be queued for deferred field extraction
+    uploads = [SpooledUpload(file) for file in files] if degradable else files
+    request_trace = Trace() if trace_mode else None
+    token = current_trace.set(request_trace)
+    try:
+        degradation = await degrade('/predict', degradable, file_id, uploads)
+        with REQUESTS_IN_FLIGHT.labels(endpoint='/predict').track_inprogress():
+            results = await pipeline.process_files(
+                file_id, uploads, extract_fields=not (degradation and degradation['degraded']), presence=presence_only)
+    finally:
+        current_trace.reset(token)
+        admission_queue.release(pages)
+        if degradable:
+            close_uploads(uploads)
+    if degradation is not None:
+        for result in results:
+            result.update(degradation)
+    if request_trace is None:
+        return JSONResponse(content=results)
+
+    if trace_mode == 'full':
+        for result in results:
+            result['timings'] = request_trace.file_timings(result['id'])
+    return JSONResponse(content=results, headers={'Server-Timing': request_trace.server_timing()})
+
+@app.post("/predict/stream")
+async def process_images_stream(
+    file_id: List[str] = Form(...),
+    files: List[UploadFile] = File(...),
+    granularity: str = Query('file', pattern='^(file|page)$'),
+    format: str = Query('ndjson', pattern='^(ndjson|sse)$'),
+    degradable: bool = Query(False),
+    presence_only: bool = Query(False),
+):
+    """
+    Streaming variant of /predict: emits one JSON record per file (or per page with granularity=page)
+    as soon as it completes, as NDJSON or server-sent events, and ends with a summary record.
+    """
+    check_uploads(file_id, files)
+    pages = await admit(files)
+
+    # The UploadFiles are closed once this function returns, before the response body is streamed;
+    # the pages stay admitted until the stream ends
+    uploads = [SpooledUpload(file) for file in files]
+    try:
+        degradation = await degrade('/predict/stream', degradable, file_id, uploads)
+    except BaseException:
+        finish_stream(uploads, pages)
+        raise
+    return StreamingResponse(
+        stream_predictions(pipeline, file_id, uploads, granularity, format, degradation, presence_only),
+        media_type=MEDIA_TYPES[format],
+        background=BackgroundTask(finish_stream, uploads, pages),
+    )
+
+@app.post("/jobs", status_code=202)
+async def submit_job(file_id: List[str] = Form(...), files: List[UploadFile] = File(...), callback_url: Optional[str] = Form(None)):
+    """
+    Queue a batch for asynchronous processing and return its job id right away.
+    Poll GET /jobs/{job_id}, or pass a callback_url to receive the final status by POST.
+    """
+    check_uploads(file_id, files)
+    if callback_url is not None and not job_queue.callback_allowed(callback_url):
+        raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL on an allowed host.")
+
+    uploads = [SpooledUpload(file) for file in files]
+    try:
+        job_id = await job_queue.submit(file_id, uploads, callback_url)
+    finally:
+        close_uploads(uploads)
+    return JSONResponse(status_code=202, content={'job_id': job_id, 'status': 'queued'})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a job and the results of the files completed so far."""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return JSONResponse(content=job)
+
+@app.get("/health")
+async def health():
+    """Cached health of every backend replica; 503 when a backend has no available replica."""
+    backends = backend_clients.health()
+    healthy = all(backend['healthy'] for backend in backends.values())
+    return JSONResponse(status_code=200 if healthy else 503, content={'status': 'ok' if healthy else 'degraded', 'backends': backends})
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage and backend latencies, in-flight requests and pages, bytes sent and errors."""
+    data, content_type = latest_metrics()
+    return Response(content=data, media_type=content_type)
+
+@app.get("/stats/backends")
+async def backend_stats():
+    """Connection pool, request and circuit breaker statistics for each TorchServe backend and replica."""
+    return JSONResponse(content=backend_clients.stats())
+
+@app.get("/stats/pipeline")
+async def pipeline_stats():
+    """Deduplication, result cache, memory, normalisation and RetinaNet call grouping statistics of the page pipeline."""
+    return JSONResponse(content=pipeline.stats())
+
+@app.get("/stats/admission")
+async def admission_stats():
+    """Pages in flight and queued, observed service rate, and admitted, rejected and rate-limited requests."""
+    return JSONResponse(content={
+        **admission_queue.stats(),
+        'rate_limit': rate_limiter.stats() if rate_limiter is not None else None,
+    })
+
+@app.get("/stats/degradation")
+async def degradation_stats():
+    """Whether degradable requests are currently degraded, the load of the LayoutLMv3 backends and the degraded requests."""
+    return JSONResponse(content=degradation_policy.stats())
 
-    results = []
-    async with httpx.AsyncClient() as client:
-        for f_id, file in zip(file_id, files):
-            file_contents = await file.read()
-            file_extension = file.filename.split('.')[-1].lower()
-
-            file_result = {'id': f_id, 'detected_classes': {}, 'field_predictions': []}
-            if file_extension in ['png', 'jpeg', 'jpg']:
-                # Object Detection
-                od_response = await client.post(retinanet_url, files={'data': ('filename', file_contents)})
-                if od_response.status_code == 200:
-                    od_data = process_torch_serve_response(od_response)
-                    file_result['detected_classes'] = od_data['detected_classes']
-                
-                # Classification and Field Detection
-                processed_image = efficientnet_classifier.preprocess_image(file_contents)
-                is_handwritten = efficientnet_classifier.classify_image(processed_image)
-                document_type = 'handwritten' if is_handwritten else 'machinewritten'
-                target_url = LMv3_hand_url if is_handwritten else LMv3_machine_url
-                field_response = await client.post(target_url, files={'data': ('filename', file_contents)})
-                
-                if field_response.status_code == 200:
-                    labels = field_response.json()  # Directly using the list
-                    unique_fields = {label[2:] if label.startswith(('B-', 'I-')) else label for label in labels if label != 'O'}
-                    file_result['field_predictions'].extend(list(unique_fields))
-
-            elif file_extension == 'pdf':
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    pdf_path = os.path.join(temp_dir, file.filename)
-                    async with aiofiles.open(pdf_path, 'wb') as out_file:
-                        await out_file.write(file_contents)
-                    images = convert_pdf_to_png(pdf_path, temp_dir)
-                    if images is None:
-                        images = []  # Ensure images is always a list, even if empty
-                    pdf_results = []
-                    for image_filename in images:
-                        image_path = os.path.join(temp_dir, image_filename)
-                        async with aiofiles.open(image_path, 'rb') as image_file:
-                            image_contents = await image_file.read()
-                            # Object Detection
-                            od_response = await client.post(retinanet_url, files={'data': ('filename', image_contents)})
-                            if od_response.status_code == 200:
-                                od_data = process_torch_serve_response(od_response)
-                                # Classification and Field Detection
-                                processed_image = efficientnet_classifier.preprocess_image(image_contents)
-                                is_handwritten = efficientnet_classifier.classify_image(processed_image)
-                                document_type = 'handwritten' if is_handwritten else 'machinewritten'
-                                target_url = LMv3_hand_url if is_handwritten else LMv3_machine_url
-                                field_response = await client.post(target_url, files={'data': ('filename', image_contents)})
-                                if field_response.status_code == 200:
-                                    labels = field_response.json()  # Directly using the list
-                                    pdf_results.append({"unique_fields": [label[2:] if label.startswith(('B-', 'I-')) else label for label in labels if label != 'O']})
-                    aggregate_results(file_result, pdf_results)
-
-            results.append(file_result)
-
-    return JSONResponse(content=results)
+@app.get("/stats/classifier")
+async def classifier_stats():
+    """Batching statistics of the EfficientNet classifier."""
+    batcher = efficientnet_classifier.batcher
+    return JSONResponse(content=batcher.stats() if batcher is not None else {'batching': False})
@@ -0,0 +1,64 @@
+import json
+
+
+class RequestSizeLimitMiddleware:
+    """
+    Pure ASGI middleware rejecting request bodies larger than max_body_bytes with 413.
+
+    A declared Content-Length above the limit is rejected before any of the body is read. Chunked
+    bodies are counted as they are received and cut off as soon as they cross the limit, so an
+    oversized upload is never fully buffered or spooled to disk.
+    """
+    def __init__(self, app, max_body_bytes):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or self.max_body_bytes is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            await self.reject(send)
+            return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_body_bytes:
+                    if not response_started:
+                        rejected = True
+                        await self.reject(send)
+                    # The application sees a disconnected client and stops reading
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return  # The 413 response has already been sent
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    async def reject(self, send):
+        body = json.dumps({'detail': f"Request body exceeds {self.max_body_bytes} bytes."}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'connection', b'close'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -1,16 +1,116 @@
-from fastapi import HTTPException, Request
-from starlette.middleware.base import BaseHTTPMiddleware
+import ipaddress
+import json
 
-class IPWhitelistMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, allowlist=None, allow_all=False):
-        super().__init__(app)
-        self.allowlist = allowlist or []
+
+class CIDRTrie:
+    """
+    Binary trie of IPv4 and IPv6 networks. Looking up an address walks at most as many nodes as the
+    longest prefix stored, whatever the number of networks.
+
+    Parameters:
+    - networks: Addresses or CIDR networks ('10.0.0.0/8', '2001:db8::/32', '192.168.1.7').
+    """
+    def __init__(self, networks=()):
+        # One root per IP version; a node is [child for bit 0, child for bit 1, whether a network ends here]
+        self.roots = {4: [None, None, False], 6: [None, None, False]}
+        for network in networks:
+            self.add(network)
+
+    def add(self, network):
+        network = ipaddress.ip_network(network, strict=False)
+        bits = int(network.network_address)
+        node = self.roots[network.version]
+        for i in range(network.prefixlen):
+            bit = (bits >> (network.max_prefixlen - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[2] = True
+
+    def __contains__(self, address):
+        address = parse_address(address)
+        if address is None:
+            return False
+        bits = int(address)
+        node = self.roots[address.version]
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            if node[2]:
+                return True
+            node = node[(bits >> i) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+
+def parse_address(address):
+    """The IP address of a string (IPv4-mapped IPv6 addresses as IPv4), or None if it is not one."""
+    try:
+        address = ipaddress.ip_address(address.strip() if isinstance(address, str) else address)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+class IPWhitelistMiddleware:
+    """
+    Pure ASGI middleware answering 403 to clients whose address is not in the allowlist, before
+    the application (and the parsing of the request body) is reached.
+
+    Parameters:
+    - allowlist: Allowed addresses and CIDR networks ('*' entries are ignored, see allow_all).
+    - allow_all: Let every client through.
+    - trusted_proxies: Addresses and CIDR networks of the reverse proxies in front of the gateway.
+      For a request coming from one of them, the client is the right-most X-Forwarded-For address
+      that is not itself a trusted proxy; the request scope's client is updated accordingly.
+    """
+    def __init__(self, app, allowlist=None, allow_all=False, trusted_proxies=None):
+        self.app = app
         self.allow_all = allow_all
+        self.allowlist = CIDRTrie(entry for entry in allowlist or [] if entry != '*')
+        self.trusted_proxies = CIDRTrie(trusted_proxies or [])
+        self.has_trusted_proxies = bool(trusted_proxies)
 
-    async def dispatch(self, request: Request, call_next):
-        client_host = request.client.host
-        if self.allow_all or client_host in self.allowlist:
-            response = await call_next(request)
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket') or (self.allow_all and not self.has_trusted_proxies):
+            await self.app(scope, receive, send)
+            return
+
+        client_host = self.client_host(scope)
+        if client_host is not None and scope.get('client') and client_host != scope['client'][0]:
+            scope = {**scope, 'client': (client_host, 0)}
+        if self.allow_all or (client_host is not None and client_host in self.allowlist):
+            await self.app(scope, receive, send)
         else:
-            raise HTTPException(status_code=403, detail="Access forbidden")
-        return response
+            await self.reject(scope, send)
+
+    def client_host(self, scope):
+        """Address of the client, looking through X-Forwarded-For when the peer is a trusted proxy."""
+        peer = scope.get('client')
+        if not peer:
+            return None
+        host = peer[0]
+        if not self.has_trusted_proxies or host not in self.trusted_proxies:
+            return host
+        forwarded = [value.decode('latin-1') for name, value in scope['headers'] if name == b'x-forwarded-for']
+        hops = [hop.strip() for hop in ','.join(forwarded).split(',') if hop.strip()]
+        for hop in reversed(hops):
+            if hop not in self.trusted_proxies:
+                return hop
+        return hops[0] if hops else host
+
+    async def reject(self, scope, send):
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        body = json.dumps({'detail': "Access forbidden"}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 403,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
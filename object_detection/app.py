@@ -1,17 +1,17 @@
 import asyncio
+from contextlib import aclosing, asynccontextmanager
 import os
-import tempfile
 from typing import List
-from fastapi import FastAPI, File, Form, Request, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, Query, Request, HTTPException, UploadFile
+from fastapi.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 import httpx
 import json
-import aiofiles
 from utils import *
-from utils.postprocessing import process_torch_serve_response, aggregate_results
-from utils.pdf_to_png import convert_pdf_to_png
-
-app = FastAPI()
+from middleware.admission import AdmissionMiddleware
+from utils.admission import AdmissionQueue, Overloaded, RateLimiter
+from utils.postprocessing import CLASSES, process_detections, aggregate_results
+from utils.pdf_to_png import pdf_page_count, stream_pdf_pages
 
 class IPWhitelistMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, allowlist=None, allow_all=False):
@@ -31,119 +31,172 @@ class IPWhitelistMiddleware(BaseHTTPMiddleware):
 with open('config.json') as config_file:
     config = json.load(config_file)
 
+# Access configuration values
+
+torch_serve_url = config['retinanet_torch_serve_url']
+# Order in which PDF pages are rendered in presence-only mode
+presence_page_order = config['presence_page_order']
+# Images sent to TorchServe per call; several are sent as one multi-image request
+max_images_per_call = config['max_images_per_call']
+
+# A single pooled client is shared by every request and reused across images and PDF pages
+client = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_keepalive_connections'],
+            keepalive_expiry=config['keepalive_expiry'],
+        ),
+        timeout=httpx.Timeout(config['timeout'], connect=config['connect_timeout']),
+        http2=config['http2'],
+    )
+    yield
+    await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# Admission control, as in the gateway: a global budget of pages in flight with a bounded wait queue,
+# and optional per-client rate limits. Clients over their rate or arriving at a full queue are turned
+# away before their body is read, with a Retry-After header
+admission_queue = AdmissionQueue(
+    config['admission_max_pages'],
+    max_queued_requests=config['admission_max_queued_requests'],
+    max_queue_wait=config['admission_max_queue_wait_seconds'],
+    service='object detection service',
+)
+rate_limiter = RateLimiter(config['rate_limit_per_second'], config['rate_limit_burst']) if config['rate_limit_per_second'] else None
+app.add_middleware(AdmissionMiddleware, paths=['/detect'], queue=admission_queue,
+                   rate_limiter=rate_limiter, api_key_header=config['api_key_header'])
+
 # Determine if all IPs should be allowed based on the configuration
 allow_all_ips = "*" in config['allowed_ips'] or "0.0.0.0" in config['allowed_ips']
 
 # Initialize middleware with the list of allowed IPs from the config and the allow_all setting
 app.add_middleware(IPWhitelistMiddleware, allowlist=config['allowed_ips'], allow_all=allow_all_ips)
 
-# Access configuration values
+async def send_batch_request(batch):
+    """
+    Send page images to TorchServe in one call and return the processed detections of each, in order.
+    Several images are sent as the parts image_0 ... image_<n-1> of a multi-image request, whose
+    response is the list of their detections. An image the call failed for gets an 'error'.
+    """
+    if len(batch) == 1:
+        response = await client.post(torch_serve_url, files={'data': ('filename', batch[0])})
+        detections = [response.json()] if response.status_code == 200 else None
+    else:
+        files = [(f'image_{i}', (f'page_{i}', image_contents)) for i, image_contents in enumerate(batch)]
+        response = await client.post(torch_serve_url, files=files)
+        detections = response.json() if response.status_code == 200 else None
+    if not isinstance(detections, list) or len(detections) != len(batch):
+        return [{'error': 'Failed to process image'} for _ in batch]
+    return [{'error': 'Failed to process image'} if 'error' in result else process_detections(result) for result in detections]
+
+async def detect_images(batch):
+    """Detect objects on the images of a batch of (file_result, image_contents) and fill in their file results."""
+    for (file_result, _), processed_data in zip(batch, await send_batch_request([contents for _, contents in batch])):
+        if 'error' in processed_data:
+            file_result['error'] = processed_data['error']
+        else:
+            file_result['detected_classes'].update(processed_data)
 
-torch_serve_url = config['retinanet_torch_serve_url']
+async def detect_pdf_pages(batch, base_name, pdf_results, missing_classes):
+    """Detect objects on a batch of (page_number, image_contents) of a PDF, appending the page results."""
+    for (page_number, _), processed_data in zip(batch, await send_batch_request([contents for _, contents in batch])):
+        if 'error' in processed_data:
+            pdf_results.append({'error': processed_data['error'], 'filename': f"{base_name}_{page_number}.png"})
+        else:
+            pdf_results.append(processed_data)
+            missing_classes -= {name for name, data in processed_data['detected_classes'].items() if data['present']}
+
+async def count_pages(files):
+    """
+    Pages a request puts through detection, for admission control: one per image and the page count
+    of each PDF, blank pages included. PDFs are rewound for the endpoint.
+    """
+    pages = 0
+    for file in files:
+        if file.filename.split('.')[-1].lower() != 'pdf':
+            pages += 1
+            continue
+        pages += await asyncio.to_thread(pdf_page_count, await file.read())
+        await file.seek(0)
+    return pages
+
+async def admit(files):
+    """Reserve the pages of a request in the admission budget; 503 with Retry-After when the service is overloaded."""
+    try:
+        return await admission_queue.acquire(await count_pages(files))
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers())
 
 @app.post("/detect")
-async def detect_objects(file_id: List[str] = Form(...), files: List[UploadFile] = File(...)):
+async def detect_objects(file_id: List[str] = Form(...), files: List[UploadFile] = File(...), presence_only: bool = Query(False)):
     """
     Receives files (PNG, JPEG, or PDF) and their IDs, processes each image or PDF page for object detection,
     and returns a list of detection results as JSON objects, each associated with the given file ID.
+    Images and the pages of each PDF are sent to TorchServe in calls of up to max_images_per_call images.
+    With presence_only=true, the pages of a PDF are rendered in presence_page_order and detection stops
+    as soon as every class has been found.
+    Requests wait for their pages to fit in the admission budget, and get 503 when it stays full.
     """
+    pages = await admit(files)
+    try:
+        return await detect_files(file_id, files, presence_only)
+    finally:
+        admission_queue.release(pages)
+
+async def detect_files(file_id, files, presence_only):
+    """Detection results of the uploaded files, in upload order."""
     results = []
+    images = []  # Image files waiting for their call
     for file_id, file in zip(file_id, files):
         file_extension = file.filename.split('.')[-1].lower()
         file_result = {'id': file_id, 'detected_classes': {}}
 
         if file_extension in ['png', 'jpeg', 'jpg']:
-            file_contents = await file.read()
-            files = {'data': ('filename', file_contents)}
-            async with httpx.AsyncClient() as client:
-                response = await client.post(torch_serve_url, files=files)
-                if response.status_code == 200:
-                    processed_data = process_torch_serve_response(response)
-                    file_result['detected_classes'].update(processed_data)
-                else:
-                    file_result['error'] = 'Failed to process image'
+            images.append((file_result, await file.read()))
+            if len(images) == max_images_per_call:
+                await detect_images(images)
+                images = []
             results.append(file_result)
         
         elif file_extension == 'pdf':
-            with tempfile.TemporaryDirectory() as temp_dir:
-                pdf_path = os.path.join(temp_dir, file.filename)
-                async with aiofiles.open(pdf_path, 'wb') as out_file:
-                    await out_file.write(await file.read())
-                convert_pdf_to_png(pdf_path, temp_dir)  # Convert PDF to PNG
-                pdf_results = []
-                for image_filename in os.listdir(temp_dir):
-                    if image_filename.endswith('.png'):
-                        image_path = os.path.join(temp_dir, image_filename)
-                        with open(image_path, 'rb') as image_file:
-                            files = {'data': ('filename', image_file.read())}
-                            async with httpx.AsyncClient() as client:
-                                response = await client.post(torch_serve_url, files=files)
-                                if response.status_code == 200:
-                                    processed_data = process_torch_serve_response(response)
-                                    pdf_results.append(processed_data)
-                                else:
-                                    pdf_results.append({'error': 'Failed to process image', 'filename': image_filename})
-                # Aggregate results for the entire PDF file
-                aggregate_results(file_result, pdf_results)
+            # Render the non-blank pages to PNG in memory, the next page renders while earlier ones are detected
+            base_name = os.path.splitext(file.filename)[0]
+            pdf_results = []
+            missing_classes = {class_name for class_name in CLASSES if class_name != '__background__'}
+            order = presence_page_order if presence_only else 'natural'
+            batch = []
+            async with aclosing(stream_pdf_pages(await file.read(), order=order)) as pages:
+                async for page_number, image_contents in pages:
+                    if presence_only and not missing_classes:
+                        break
+                    batch.append((page_number, image_contents))
+                    if len(batch) == max_images_per_call:
+                        await detect_pdf_pages(batch, base_name, pdf_results, missing_classes)
+                        batch = []
+            if batch:
+                await detect_pdf_pages(batch, base_name, pdf_results, missing_classes)
+            # Aggregate results for the entire PDF file
+            aggregate_results(file_result, pdf_results)
             results.append(file_result)
 
         else:
             raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
 
-    return results
-
-# async def send_batch_request(batch):
-#     """Send a batch of image requests and process the responses."""
-#     async with httpx.AsyncClient() as client:
-#         responses = await asyncio.gather(*[
-#             client.post(torch_serve_url, files={'data': ('filename', image.read())}) 
-#             for image in batch
-#         ])
-#     return [process_torch_serve_response(response) if response.status_code == 200 else {'error': 'Failed to process image'}
-#             for response in responses]
-
-# @app.post("/2detect")
-# async def detect_objects(file_id: List[str] = Form(...), files: List[UploadFile] = File(...)):
-#     results = []
-#     batch = []
-#     for file_id, file in zip(file_ids, files):
-#         file_extension = file.filename.split('.')[-1].lower()
-#         file_result = {'id': file_id, 'detected_classes': {}}
-
-#         if file_extension in ['png', 'jpeg', 'jpg']:
-#             file_contents = await file.read()
-#             batch.append(('filename', file_contents))
-#             if len(batch) == 4:
-#                 file_results = await send_batch_request(batch)
-#                 results.extend(file_results)
-#                 batch = []
-        
-#         elif file_extension == 'pdf':
-#             with tempfile.TemporaryDirectory() as temp_dir:
-#                 pdf_path = os.path.join(temp_dir, file.filename)
-#                 async with aiofiles.open(pdf_path, 'wb') as out_file:
-#                     await out_file.write(await file.read())
-#                 convert_pdf_to_png(pdf_path, temp_dir)  # Convert PDF to PNG
-#                 pdf_results = []
-#                 pdf_images = []
-#                 for image_filename in os.listdir(temp_dir):
-#                     if image_filename.endswith('.png'):
-#                         with open(os.path.join(temp_dir, image_filename), 'rb') as image_file:
-#                             pdf_images.append(image_file)
-#                             if len(pdf_images) == 4:
-#                                 pdf_results.extend(await send_batch_request(pdf_images))
-#                                 pdf_images = []
-#                 if pdf_images:
-#                     pdf_results.extend(await send_batch_request(pdf_images))
-#                 aggregate_results(file_result, pdf_results)
-#             results.append(file_result)
-
-#         else:
-#             raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
-
-#     if batch:  # Check if there is a residual batch to send
-#         results.extend(await send_batch_request(batch))
-
-#     return results
+    if images:  # Residual images waiting for a call
+        await detect_images(images)
 
+    return results
 
+@app.get("/stats/admission")
+async def admission_stats():
+    """Pages in flight and queued, observed service rate, and admitted, rejected and rate-limited requests."""
+    return JSONResponse(content={
+        **admission_queue.stats(),
+        'rate_limit': rate_limiter.stats() if rate_limiter is not None else None,
+    })
@@ -1,7 +1,9 @@
 from functools import partial
+import hashlib
 import io
 import json
 import logging
+import os
 import numpy as np
 import torch
 import torchvision
@@ -16,18 +18,132 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 # Set the device
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Execution of the model: 'eager' runs it as trained; 'optimized' runs it in inference mode with
+# channels_last weights; 'script' and 'compile' also run it through TorchScript or torch.compile
+INFERENCE_MODES = ('eager', 'optimized', 'script', 'compile')
+INFERENCE_DTYPES = ('float32', 'bfloat16')
+# Where the TorchScript model and the torch.compile cache are kept across worker restarts
+COMPILED_MODEL_DIR = "/home/model-server/model-store/compiled"
+
+# Parts of a multi-image request are named image_0 ... image_<n-1>
+MULTI_IMAGE_PREFIX = "image_"
+INVALID_IMAGE = {'error': "Invalid image"}
+
+
+def request_images(row):
+    """
+    Encoded images of one request, in order, and whether it is a multi-image request: the 'data'
+    (or 'body') of a single-image request, or the image_<i> parts of a multi-image one.
+    """
+    image = row.get("data") or row.get("body")
+    parts = sorted(
+        (int(name[len(MULTI_IMAGE_PREFIX):]), value) for name, value in row.items()
+        if name.startswith(MULTI_IMAGE_PREFIX) and name[len(MULTI_IMAGE_PREFIX):].isdigit()
+    )
+    if image is not None or not parts:
+        return [image], False
+    return [value for _, value in parts], True
+
+
+class Autocast(torch.nn.Module):
+    """
+    Runs a part of the model (the backbone or the head) under bfloat16 autocast and returns its outputs
+    in float32, so that the boxes are still decoded and filtered in float32.
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16):
+            outputs = self.module(x)
+        return {name: output.float() for name, output in outputs.items()}
+
+
 class DetectionModelHandler:
-    def __init__(self):
+    """
+    TorchServe handler of the RetinaNet model.
+
+    The execution of the model is set by the environment of the TorchServe workers, unless given:
+    - INFERENCE_MODE: One of INFERENCE_MODES (default 'eager'). The TorchScript model is saved in
+      COMPILED_MODEL_DIR and reused while the weights and the PyTorch version are unchanged; the
+      torch.compile cache is kept there too. Both are warmed up when the worker starts.
+    - INFERENCE_DTYPE: 'float32' (default) or 'bfloat16' to run the backbone and the head under
+      bfloat16 autocast; not available with 'script'.
+    - TORCH_NUM_THREADS: Intra-op threads of each worker; 0 (default) keeps PyTorch's default.
+    - COMPILED_MODEL_DIR: See above.
+    """
+    def __init__(self, inference_mode=None, dtype=None, num_threads=None, compiled_model_dir=None):
         self.initialized = False
+        self.inference_mode = inference_mode or os.environ.get("INFERENCE_MODE", "eager")
+        self.dtype = dtype or os.environ.get("INFERENCE_DTYPE", "float32")
+        self.num_threads = num_threads if num_threads is not None else int(os.environ.get("TORCH_NUM_THREADS", "0"))
+        self.compiled_model_dir = compiled_model_dir or os.environ.get("COMPILED_MODEL_DIR", COMPILED_MODEL_DIR)
+        if self.inference_mode not in INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode: {self.inference_mode}")
+        if self.dtype not in INFERENCE_DTYPES:
+            raise ValueError(f"Unknown inference dtype: {self.dtype}")
+        if self.dtype == 'bfloat16' and self.inference_mode == 'script':
+            raise ValueError("bfloat16 is not available with the 'script' inference mode")
 
     def initialize(self, context):
         properties = context.system_properties
         model_path = "/home/model-server/model-store/best_model.pth"
         weights_path = "/home/model-server/model-store/retinanet_resnet50_fpn_v2_coco-5905b1c5.pth"
-        self.model = self.load_model(model_path, weights_path, num_classes=3)
-        self.model.eval()
+        self.load(model_path, weights_path)
         self.initialized = True
-        logging.info("Model initialized successfully.")
+        logging.info("Model initialized successfully (mode: %s, dtype: %s, threads: %d).",
+                     self.inference_mode, self.dtype, torch.get_num_threads())
+
+    def load(self, model_path, weights_path):
+        """Load the model and prepare it for the configured execution."""
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        model = self.load_model(model_path, weights_path, num_classes=3)
+        model.eval()
+        self.model = self.optimize(model, model_path)
+        if self.inference_mode != 'eager':
+            self.warm_up()
+
+    def optimize(self, model, model_path):
+        if self.inference_mode != 'eager':
+            model = model.to(memory_format=torch.channels_last)
+        if self.dtype == 'bfloat16':
+            model.backbone = Autocast(model.backbone)
+            model.head = Autocast(model.head)
+        if self.inference_mode == 'script':
+            return self.scripted(model, model_path)
+        if self.inference_mode == 'compile':
+            # Set on import of torch, and read by the compiler when it looks up or stores its artifacts
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(self.compiled_model_dir, "inductor")
+            model.backbone = torch.compile(model.backbone, dynamic=True)
+            model.head = torch.compile(model.head, dynamic=True)
+        return model
+
+    def scripted(self, model, model_path):
+        """TorchScript version of the model, loaded from compiled_model_dir when these weights were already scripted."""
+        digest = hashlib.sha256()
+        with open(model_path, 'rb') as model_file:
+            for chunk in iter(lambda: model_file.read(1 << 20), b''):
+                digest.update(chunk)
+        path = os.path.join(self.compiled_model_dir,
+                            f"retinanet-{digest.hexdigest()[:16]}-torch{torch.__version__}-tv{torchvision.__version__}.pt")
+        if os.path.exists(path):
+            logging.info("Loading the TorchScript model from %s", path)
+            return torch.jit.load(path, map_location=DEVICE)
+        scripted = torch.jit.script(model)
+        os.makedirs(self.compiled_model_dir, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"  # Workers starting together each write their own copy
+        torch.jit.save(scripted, temporary_path)
+        os.replace(temporary_path, path)
+        logging.info("Saved the TorchScript model to %s", path)
+        return scripted
+
+    def warm_up(self):
+        """Run the model on blank pages so that the first requests do not pay for compilation."""
+        page = torch.zeros(3, 1123, 794, device=DEVICE)  # A4 at 96 dpi
+        for _ in range(2):
+            self.inference([page])
 
     def load_model(self, model_path, weights_path, num_classes):
         model = torchvision.models.detection.retinanet_resnet50_fpn_v2(weights=None)  # No pretrained weights
@@ -51,13 +167,31 @@ class DetectionModelHandler:
         return model
 
     def preprocess(self, data):
+        """
+        Decode the images of every request of the batch. Returns the image tensors and, per request,
+        whether it is a multi-image request and the position of each of its images among the tensors
+        (None for an image that could not be decoded).
+        """
         if isinstance(data, dict):
-            image = data.get("data") or data.get("body")
-        elif isinstance(data, list) and data:
-            image = data[0].get("data") or data[0].get("body")
-        else:
+            data = [data]
+        elif not isinstance(data, list) or not data:
             raise ValueError("Data provided is neither dict nor list, or it is empty.")
 
+        images, requests = [], []
+        for idx, row in enumerate(data):
+            encoded, multi = request_images(row)
+            positions = []
+            for image in encoded:
+                try:
+                    images.append(self.read_image(image))
+                    positions.append(len(images) - 1)
+                except (ValueError, OSError, cv2.error) as e:
+                    logging.warning("Request %d of the batch has an invalid image: %s", idx, e)
+                    positions.append(None)
+            requests.append((multi, positions))
+        return images, requests
+
+    def read_image(self, image):
         if isinstance(image, (bytes, bytearray)):
             image = Image.open(io.BytesIO(image))
             image = np.array(image)
@@ -65,29 +199,43 @@ class DetectionModelHandler:
             raise ValueError("Invalid image format: not bytes or bytearray")
 
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-        image_tensor = to_tensor(image).unsqueeze_(0).to(DEVICE)
-        return image_tensor
+        return to_tensor(image).to(DEVICE)
 
     def inference(self, model_input):
-        logging.info("Model input size: %s", model_input.size())
-        with torch.no_grad():
+        """
+        Run the model once on the whole batch. RetinaNet's transform resizes the images, pads them
+        into a single batched tensor and maps the boxes back to the size of each original image.
+        """
+        if not model_input:
+            return []
+        logging.info("Batch of %d images, sizes: %s", len(model_input), [tuple(image.shape[1:]) for image in model_input])
+        with torch.no_grad() if self.inference_mode == 'eager' else torch.inference_mode():
             outputs = self.model(model_input)
-        if outputs[0]['boxes'].nelement() == 0:
-            logging.info("No objects detected.")
-        else:
-            logging.info("Objects detected: %d", outputs[0]['boxes'].shape[0])
-        output_dict = {
-            'boxes': outputs[0]['boxes'].cpu().tolist(),
-            'labels': outputs[0]['labels'].cpu().tolist(),
-            'scores': outputs[0]['scores'].cpu().tolist()
-        }
-        return output_dict
+        if isinstance(outputs, tuple):  # Scripted detection models return (losses, detections)
+            outputs = outputs[1]
+        logging.info("Objects detected: %s", [output['boxes'].shape[0] for output in outputs])
+        return [
+            {
+                'boxes': output['boxes'].cpu().tolist(),
+                'labels': output['labels'].cpu().tolist(),
+                'scores': output['scores'].cpu().tolist()
+            }
+            for output in outputs
+        ]
 
-    def postprocess(self, inference_output):
-        return json.dumps(inference_output).encode('utf-8')
+    def postprocess(self, inference_output, requests, context):
+        """
+        One response per request, in order: the detections of a single-image request (a 400 when its
+        image is invalid), or the list of the detections of each image of a multi-image request.
+        """
+        responses = []
+        for idx, (multi, positions) in enumerate(requests):
+            outputs = [inference_output[position] if position is not None else INVALID_IMAGE for position in positions]
+            if not multi and outputs[0] is INVALID_IMAGE:
+                context.set_response_status(code=400, phrase="Invalid image", idx=idx)
+            responses.append(json.dumps(outputs if multi else outputs[0]).encode('utf-8'))
+        return responses
 
     def handle(self, data, context):
-        model_input = self.preprocess(data)
-        model_output = self.inference(model_input)
-        response = self.postprocess(model_output)
-        return [response]
+        images, requests = self.preprocess(data)
+        return self.postprocess(self.inference(images), requests, context)
@@ -12,6 +12,42 @@ from torchvision.transforms.functional import to_tensor
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Side of the square input the model was exported with
+INPUT_SIZE = 640
+
+# Parts of a multi-image request are named image_0 ... image_<n-1>
+MULTI_IMAGE_PREFIX = "image_"
+INVALID_IMAGE = {'error': "Invalid image"}
+
+
+def request_images(row):
+    """
+    Encoded images of one request, in order, and whether it is a multi-image request: the 'data'
+    (or 'body') of a single-image request, or the image_<i> parts of a multi-image one.
+    """
+    image = row.get("data") or row.get("body")
+    parts = sorted(
+        (int(name[len(MULTI_IMAGE_PREFIX):]), value) for name, value in row.items()
+        if name.startswith(MULTI_IMAGE_PREFIX) and name[len(MULTI_IMAGE_PREFIX):].isdigit()
+    )
+    if image is not None or not parts:
+        return [image], False
+    return [value for _, value in parts], True
+
+
+def letterbox(image, size):
+    """
+    Resize an image to fit in a size x size square without distorting it, and pad the bottom and
+    right with black. Returns the square image and the scale applied, which boxes are divided by to
+    get back to the original image.
+    """
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    resized = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))))
+    square = np.zeros((size, size, image.shape[2]), dtype=image.dtype)
+    square[:resized.shape[0], :resized.shape[1]] = resized
+    return square, scale
+
 
 class DetectionModelHandler:
     def __init__(self):
@@ -23,63 +59,105 @@ class DetectionModelHandler:
         model_path = "/home/model-server/model-store/modelPrunned.onnx"  # Path to the ONNX model
         self.session = ort.InferenceSession(model_path)
         self.input_name = self.session.get_inputs()[0].name  # Ensure this attribute is defined
+        # The whole batch runs at once when the model takes a dynamic batch dimension and returns
+        # batched detections; otherwise it is exported for one image and is run once per image
+        input_shape = self.session.get_inputs()[0].shape
+        output_shape = self.session.get_outputs()[0].shape
+        self.batched = len(input_shape) == 4 and not isinstance(input_shape[0], int) and len(output_shape) == 3
         self.initialized = True
-        logging.info("ONNX model initialized successfully.")
+        logging.info("ONNX model initialized successfully (batched inference: %s).", self.batched)
 
 
     def preprocess(self, data):
+        """
+        Decode and letterbox the images of every request of the batch. Returns the batched input
+        tensor, the (scale, width, height) of each original image and, per request, whether it is a
+        multi-image request and the position of each of its images in the batch (None for an image
+        that could not be decoded).
+        """
         if isinstance(data, dict):
-            image = data.get("data") or data.get("body")
-        elif isinstance(data, list) and data:
-            image = data[0].get("data") or data[0].get("body")
-        else:
+            data = [data]
+        elif not isinstance(data, list) or not data:
             raise ValueError("Data provided is neither dict nor list, or it is empty.")
 
-
+        images, shapes, requests = [], [], []
+        for idx, row in enumerate(data):
+            encoded, multi = request_images(row)
+            positions = []
+            for image in encoded:
+                try:
+                    image, shape = self.read_image(image)
+                except (ValueError, OSError, cv2.error) as e:
+                    logging.warning("Request %d of the batch has an invalid image: %s", idx, e)
+                    positions.append(None)
+                    continue
+                images.append(image)
+                shapes.append(shape)
+                positions.append(len(images) - 1)
+            requests.append((multi, positions))
+
+        model_input = np.stack(images) if images else np.empty((0, 3, INPUT_SIZE, INPUT_SIZE), dtype=np.float32)
+        return model_input, shapes, requests
+
+
+    def read_image(self, image):
         if isinstance(image, (bytes, bytearray)):
             image = Image.open(io.BytesIO(image))
             image = np.array(image)
         else:
             raise ValueError("Invalid image format: not bytes or bytearray")
 
-
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = cv2.resize(image, (640, 640))  # Resize to (640, 640)
+        height, width = image.shape[:2]
+        image, scale = letterbox(image, INPUT_SIZE)
         image = image.astype(np.float32) / 255.0  # Normalize
 
-
         image_tensor = np.transpose(image, (2, 0, 1))  # Change data layout to CHW
-        image_tensor = np.expand_dims(image_tensor, axis=0)  # Add batch dimension
-        return image_tensor
+        return image_tensor, (scale, width, height)
 
 
     def inference(self, model_input):
-        inputs = {self.input_name: model_input}
-        outputs = self.session.run(None, inputs)
-        logging.info("Inference executed successfully")
-
-
-        # Assuming outputs are numpy arrays and indexing is correct
-        if len(outputs[0]) == 0:
-            logging.info("No objects detected.")
+        if self.batched:
+            outputs = self.session.run(None, {self.input_name: model_input}) if len(model_input) else [[], [], []]
+            outputs = list(zip(*outputs))
         else:
-            logging.info("Objects detected: %d", len(outputs[0]))
-
-
-        output_dict = {
-            'boxes': outputs[0].tolist(),
-            'scores': outputs[1].tolist(),
-            'labels': outputs[2].tolist()
+            outputs = [self.session.run(None, {self.input_name: image[np.newaxis]}) for image in model_input]
+        logging.info("Inference executed successfully on a batch of %d images", len(model_input))
+        logging.info("Objects detected: %s", [len(output[0]) for output in outputs])
+        return outputs
+
+
+    def detections(self, output, shape):
+        """Detections of one image, with the boxes mapped from the letterboxed input back to the original image."""
+        boxes, scores, labels = output
+        scale, width, height = shape
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4) / scale
+        boxes[:, 0::2] = boxes[:, 0::2].clip(0, width)
+        boxes[:, 1::2] = boxes[:, 1::2].clip(0, height)
+        return {
+            'boxes': boxes.tolist(),
+            'scores': np.asarray(scores).tolist(),
+            'labels': np.asarray(labels).tolist()
         }
-        return output_dict
 
 
-    def postprocess(self, inference_output):
-        return json.dumps(inference_output).encode('utf-8')
+    def postprocess(self, inference_output, shapes, requests, context):
+        """
+        One response per request, in order: the detections of a single-image request (a 400 when its
+        image is invalid), or the list of the detections of each image of a multi-image request.
+        """
+        responses = []
+        for idx, (multi, positions) in enumerate(requests):
+            outputs = [
+                self.detections(inference_output[position], shapes[position]) if position is not None else INVALID_IMAGE
+                for position in positions
+            ]
+            if not multi and outputs[0] is INVALID_IMAGE:
+                context.set_response_status(code=400, phrase="Invalid image", idx=idx)
+            responses.append(json.dumps(outputs if multi else outputs[0]).encode('utf-8'))
+        return responses
 
 
     def handle(self, data, context):
-        model_input = self.preprocess(data)
-        model_output = self.inference(model_input)
-        response = self.postprocess(model_output)
-        return [response]
+        model_input, shapes, requests = self.preprocess(data)
+        return self.postprocess(self.inference(model_input), shapes, requests, context)
@@ -17,6 +17,26 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 # Set the device
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Parts of a multi-image request are named image_0 ... image_<n-1>
+MULTI_IMAGE_PREFIX = "image_"
+INVALID_IMAGE = {'error': "Invalid image"}
+
+
+def request_images(row):
+    """
+    Encoded images of one request, in order, and whether it is a multi-image request: the 'data'
+    (or 'body') of a single-image request, or the image_<i> parts of a multi-image one.
+    """
+    image = row.get("data") or row.get("body")
+    parts = sorted(
+        (int(name[len(MULTI_IMAGE_PREFIX):]), value) for name, value in row.items()
+        if name.startswith(MULTI_IMAGE_PREFIX) and name[len(MULTI_IMAGE_PREFIX):].isdigit()
+    )
+    if image is not None or not parts:
+        return [image], False
+    return [value for _, value in parts], True
+
+
 class DetectionModelHandler:
     def __init__(self):
         self.initialized = False
@@ -44,13 +64,31 @@ class DetectionModelHandler:
         return model
 
     def preprocess(self, data):
+        """
+        Decode the images of every request of the batch. Returns the image tensors and, per request,
+        whether it is a multi-image request and the position of each of its images among the tensors
+        (None for an image that could not be decoded).
+        """
         if isinstance(data, dict):
-            image = data.get("data") or data.get("body")
-        elif isinstance(data, list) and data:
-            image = data[0].get("data") or data[0].get("body")
-        else:
+            data = [data]
+        elif not isinstance(data, list) or not data:
             raise ValueError("Data provided is neither dict nor list, or it is empty.")
 
+        images, requests = [], []
+        for idx, row in enumerate(data):
+            encoded, multi = request_images(row)
+            positions = []
+            for image in encoded:
+                try:
+                    images.append(self.read_image(image))
+                    positions.append(len(images) - 1)
+                except (ValueError, OSError, cv2.error) as e:
+                    logging.warning("Request %d of the batch has an invalid image: %s", idx, e)
+                    positions.append(None)
+            requests.append((multi, positions))
+        return images, requests
+
+    def read_image(self, image):
         if isinstance(image, (bytes, bytearray)):
             image = Image.open(io.BytesIO(image))
             image = np.array(image)
@@ -58,29 +96,41 @@ class DetectionModelHandler:
             raise ValueError("Invalid image format: not bytes or bytearray")
 
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-        image_tensor = to_tensor(image).unsqueeze_(0).to(DEVICE)
-        return image_tensor
+        return to_tensor(image).to(DEVICE)
 
     def inference(self, model_input):
-        print("Model input size:", model_input.size())
+        """
+        Run the model once on the whole batch. RetinaNet's transform resizes the images, pads them
+        into a single batched tensor and maps the boxes back to the size of each original image.
+        """
+        if not model_input:
+            return []
+        print("Batch of", len(model_input), "images, sizes:", [tuple(image.shape[1:]) for image in model_input])
         with torch.no_grad():
             outputs = self.model(model_input)
-        if outputs[0]['boxes'].nelement() == 0:
-            print("No objects detected.")
-        else:
-            print("Objects detected:", outputs[0]['boxes'].shape[0])
-        output_dict = {
-            'boxes': outputs[0]['boxes'].cpu().tolist(),
-            'labels': outputs[0]['labels'].cpu().tolist(),
-            'scores': outputs[0]['scores'].cpu().tolist()
-        }
-        return output_dict
+        print("Objects detected:", [output['boxes'].shape[0] for output in outputs])
+        return [
+            {
+                'boxes': output['boxes'].cpu().tolist(),
+                'labels': output['labels'].cpu().tolist(),
+                'scores': output['scores'].cpu().tolist()
+            }
+            for output in outputs
+        ]
 
-    def postprocess(self, inference_output):
-        return json.dumps(inference_output).encode('utf-8')
+    def postprocess(self, inference_output, requests, context):
+        """
+        One response per request, in order: the detections of a single-image request (a 400 when its
+        image is invalid), or the list of the detections of each image of a multi-image request.
+        """
+        responses = []
+        for idx, (multi, positions) in enumerate(requests):
+            outputs = [inference_output[position] if position is not None else INVALID_IMAGE for position in positions]
+            if not multi and outputs[0] is INVALID_IMAGE:
+                context.set_response_status(code=400, phrase="Invalid image", idx=idx)
+            responses.append(json.dumps(outputs if multi else outputs[0]).encode('utf-8'))
+        return responses
 
     def handle(self, data, context):
-        model_input = self.preprocess(data)
-        model_output = self.inference(model_input)
-        response = self.postprocess(model_output)
-        return [response]
\ No newline at end of file
+        images, requests = self.preprocess(data)
+        return self.postprocess(self.inference(images), requests, context)
@@ -10,17 +10,25 @@ MODEL_TYPE="${MODEL_TYPE:-PYTORCH}"  # Default to PYTORCH if not set
 # Define the model name as 'retinanet' for both types
 MODEL_NAME="retinanet"
 
+# Dynamic batching: a worker waits up to MAX_BATCH_DELAY ms to gather up to BATCH_SIZE requests
+BATCH_SIZE="${BATCH_SIZE:-8}"
+MAX_BATCH_DELAY="${MAX_BATCH_DELAY:-50}"
+WORKERS="${WORKERS:-2}"
+
+# Intra-op threads of each PyTorch worker: the CPUs are shared between the workers unless set
+export TORCH_NUM_THREADS="${TORCH_NUM_THREADS:-$(( $(nproc) / WORKERS > 0 ? $(nproc) / WORKERS : 1 ))}"
+
 # Start TorchServe command with consistent model naming
 if [[ "$1" == "serve" ]]; then
     shift 1
-    # Start TorchServe with the specified model store and the model loaded by default
-    torchserve --start --ncs --model-store ${MODEL_STORE} --models ${MODEL_NAME}=${MODEL_NAME}.mar --ts-config /home/model-server/config.properties --disable-token-auth
+    # Start TorchServe with the specified model store
+    torchserve --start --ncs --model-store ${MODEL_STORE} --ts-config /home/model-server/config.properties --disable-token-auth
 
     # Wait for TorchServe to fully start
     sleep 30
-    # Initialize workers for the model (Default = 2)
-    curl -X PUT "http://localhost:8081/models/${MODEL_NAME}?min_worker=2" || {
-        echo "Failed to set workers"
+    # Register the model with its batching settings and initialize its workers (Default = 2)
+    curl -X POST "http://localhost:8081/models?url=${MODEL_NAME}.mar&model_name=${MODEL_NAME}&batch_size=${BATCH_SIZE}&max_batch_delay=${MAX_BATCH_DELAY}&initial_workers=${WORKERS}&synchronous=true" || {
+        echo "Failed to register the model"
         exit 1
     }
 else
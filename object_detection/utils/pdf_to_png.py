@@ -1,11 +1,17 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF
 import os
+import time
 import glob
 import numpy as np
 
 #define parameters
 THRESHOLD=220
 STDDEV_THRESHOLD=15
+PAGE_ORDERS = ('natural', 'reverse', 'last_first', 'outside_in')
+# Shared by every document: MuPDF holds the GIL while rendering, so more threads would only queue on it
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='pdf-render')
 
 def is_blank_image_page(pix, threshold=THRESHOLD, stddev_threshold=STDDEV_THRESHOLD):
     """
@@ -51,6 +57,119 @@ def convert_pdf_to_png(pdf_path, output_folder):
     doc.close()  # Close the PDF after processing
     return image_files  # Return the list of generated files
 
+def page_order(page_count, order='natural'):
+    """
+    Indices of the pages of a document in the order they should be rendered.
+
+    Parameters:
+    - page_count: Number of pages.
+    - order: 'natural' (first to last), 'reverse' (last to first), 'last_first' (the last page, then
+      the others from the first) or 'outside_in' (last, first, second to last, second, ...).
+    """
+    indices = list(range(page_count))
+    if order == 'reverse':
+        return indices[::-1]
+    if order == 'last_first':
+        return indices[-1:] + indices[:-1]
+    if order == 'outside_in':
+        return [indices[-1 - i // 2] if i % 2 == 0 else indices[i // 2] for i in range(page_count)]
+    return indices
+
+def iter_pdf_pages_png(pdf_bytes, observe=None, order='natural'):
+    """
+    Renders the non-blank pages of an in-memory PDF one at a time, without touching the filesystem.
+
+    Parameters:
+    - pdf_bytes: Content of the PDF file.
+    - observe: Optional callback observe(stage, seconds) receiving the duration of each
+      'pdf_render', 'blank_check' and 'png_encode' step.
+    - order: Order in which the pages are rendered, see page_order.
+
+    Yields (page_number, png_bytes) tuples, page numbers starting at 1.
+    """
+    observe = observe or (lambda stage, seconds: None)
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")  # Open the PDF from memory
+    try:
+        for i in page_order(len(doc), order):  # Iterate over each page
+            page = doc[i]
+            start = time.perf_counter()
+            pix = page.get_pixmap()  # Render page to an image
+            rendered = time.perf_counter()
+            observe('pdf_render', rendered - start)
+            blank = is_blank_image_page(pix)  # Check if the page is not blank
+            checked = time.perf_counter()
+            observe('blank_check', checked - rendered)
+            if not blank:
+                png = pix.tobytes("png")  # Encode the page straight into a buffer
+                observe('png_encode', time.perf_counter() - checked)
+                yield i + 1, png
+    finally:
+        doc.close()
+
+def convert_pdf_bytes_to_png(pdf_bytes):
+    """
+    Converts each non-blank page of an in-memory PDF to PNG bytes.
+    Returns a list of (page_number, png_bytes) tuples, page numbers starting at 1.
+    """
+    return list(iter_pdf_pages_png(pdf_bytes))
+
+def pdf_page_count(pdf_bytes):
+    """
+    Number of pages of an in-memory PDF, blank pages included, without rendering them.
+    Returns 1 for a file that cannot be opened as a PDF.
+    """
+    try:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return doc.page_count
+    except (fitz.FileDataError, RuntimeError, ValueError):
+        return 1
+
+async def stream_pdf_pages(pdf_bytes, max_buffered_pages=2, observe=None, order='natural'):
+    """
+    Asynchronously iterates over the non-blank pages of an in-memory PDF as (page_number, png_bytes).
+
+    Pages are rendered on RENDER_EXECUTOR, off the event loop, so waiting on the backends for one
+    page overlaps with rendering the next; rendering holds the GIL, so concurrent documents share
+    that thread time rather than being rendered in parallel. Rendering stays at most
+    max_buffered_pages ahead of the consumer, so memory is bounded no matter how many pages the
+    document has, and stops when the consumer stops iterating. observe is passed to
+    iter_pdf_pages_png and is called from the rendering thread; order is the order in which pages
+    are rendered (see page_order).
+    """
+    loop = asyncio.get_running_loop()
+    pages = iter_pdf_pages_png(pdf_bytes, observe, order)
+    queue = asyncio.Queue(maxsize=max_buffered_pages)
+    done = object()
+
+    async def produce():
+        try:
+            while True:
+                render = loop.run_in_executor(RENDER_EXECUTOR, next, pages, done)
+                try:
+                    page = await asyncio.shield(render)
+                except asyncio.CancelledError:
+                    await asyncio.wait([render])  # The document cannot be closed while a page is rendered
+                    raise
+                await queue.put(page)
+                if page is done:
+                    return
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await loop.run_in_executor(RENDER_EXECUTOR, pages.close)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            page = await queue.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        producer.cancel()  # Closes the document once the current page is rendered
+
 def convert_pdf_images_to_png(input_folder, output_folder):
     """
     Converts all non-blank PDF pages in a specified directory to PNG images.
@@ -67,8 +186,9 @@ def convert_pdf_images_to_png(input_folder, output_folder):
     for pdf_file in pdf_files:
         convert_pdf_to_png(pdf_file, output_folder)  # Convert each non-blank PDF page to PNG
 
-# Paths to the input and output folders
-input_folder = "invoices"
-output_folder = "invoices_png"
+if __name__ == "__main__":
+    # Paths to the input and output folders
+    input_folder = "invoices"
+    output_folder = "invoices_png"
 
-convert_pdf_images_to_png(input_folder, output_folder)  # Run the conversion process
+    convert_pdf_images_to_png(input_folder, output_folder)  # Run the conversion process
@@ -13,8 +13,12 @@ def process_torch_serve_response(response):
     """
     Processes the JSON response from TorchServe and organizes detections by class.
     """
-    detection_results = response.json()
+    return process_detections(response.json())
 
+def process_detections(detection_results):
+    """
+    Organizes the detections of one image (the handler's 'boxes', 'scores' and 'labels') by class.
+    """
     # Initialize response data structure
     response_data = {
         'detected_classes': {class_name: {'present': False, 'detections': []} for class_name in CLASSES if class_name != '__background__'}
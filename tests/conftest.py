@@ -0,0 +1,76 @@
+"""
+Fakes of the gateway's backends, shared by the tests.
+
+The tests run from the repository root, where the gateway modules read config.json.
+"""
+import asyncio
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+FIELD_LABELS = ['B-total', 'I-total', 'O', 'B-date']
+
+
+def page_number(image_bytes):
+    """Number of a fake page image, b'page-<n>'."""
+    return int(image_bytes.split(b'-')[1])
+
+
+def page_detections(image_bytes):
+    """RetinaNet output for a fake page: one stamp whose box starts at the page number."""
+    n = page_number(image_bytes)
+    return {'boxes': [[n, n, n + 10, n + 10]], 'scores': [0.9], 'labels': [1]}
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+
+class FakeBackends:
+    """
+    Stand-in for BackendClients. RetinaNet answers single-image ('data') and multi-image
+    (image_0 ... image_<n-1>) calls with page_detections, LayoutLMv3 with FIELD_LABELS.
+
+    Parameters:
+    - delays: Seconds each backend takes to answer, by backend name.
+    - failing_pages: Page numbers RetinaNet answers with an error.
+    """
+    def __init__(self, delays=None, failing_pages=()):
+        self.delays = delays or {}
+        self.failing_pages = set(failing_pages)
+        self.calls = []
+
+    def detections(self, image_bytes):
+        if page_number(image_bytes) in self.failing_pages:
+            return {'error': 'Failed to process image'}
+        return page_detections(image_bytes)
+
+    async def post(self, backend, files):
+        await asyncio.sleep(self.delays.get(backend, 0))
+        parts = files.items() if isinstance(files, dict) else files
+        images = [contents for _, (_, contents) in parts]
+        self.calls.append((backend, [page_number(image) for image in images]))
+        if backend != 'retinanet':
+            return FakeResponse(FIELD_LABELS)
+        if isinstance(files, dict):
+            detections = self.detections(images[0])
+            return FakeResponse(detections, 500 if 'error' in detections else 200)
+        return FakeResponse([self.detections(image) for image in images])
+
+
+class FakeClassifier:
+    """Stand-in for ImageClassifier: every page is machinewritten, after delay seconds."""
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    async def classify_async(self, image_bytes):
+        await asyncio.sleep(self.delay)
+        return False
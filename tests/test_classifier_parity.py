@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torchvision')
+
+from benchmarks.classifier_parity import DRAFT_MAX_DIFF, DRAFT_MEAN_DIFF, SAMPLES_DIR, TOLERANCE, reference_input, samples
+from classifier.classifier import preprocess_image
+
+SAMPLES = list(samples(SAMPLES_DIR, jpeg_quality=90))
+
+
+@pytest.mark.parametrize('name, kind, image_bytes', SAMPLES, ids=[f'{name}-{kind}' for name, kind, _ in SAMPLES])
+def test_preprocessing_matches_torchvision(name, kind, image_bytes):
+    difference = np.abs(preprocess_image(image_bytes) - reference_input(image_bytes))
+    assert difference.max() <= TOLERANCE
+
+
+@pytest.mark.parametrize('name, kind, image_bytes', SAMPLES, ids=[f'{name}-{kind}' for name, kind, _ in SAMPLES])
+def test_draft_decoding_stays_within_the_documented_tolerance(name, kind, image_bytes):
+    difference = np.abs(preprocess_image(image_bytes, jpeg_draft=True) - reference_input(image_bytes))
+    if kind == 'png':  # Draft decoding only applies to JPEGs
+        assert difference.max() <= TOLERANCE
+    else:
+        assert difference.max() <= DRAFT_MAX_DIFF
+        assert difference.mean() <= DRAFT_MEAN_DIFF
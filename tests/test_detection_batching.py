@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from conftest import FakeBackends, FakeClassifier
+from utils.batching import MicroBatcher
+from utils.pipeline import InvoicePipeline
+from utils.uploads import BufferedUpload
+
+
+def predict(backends, pages, **batching):
+    async def run():
+        pipeline = InvoicePipeline(FakeClassifier(), backends, **batching)
+        try:
+            uploads = [BufferedUpload(f'{n}.png', b'page-%d' % n) for n in pages]
+            return await pipeline.process_files([str(n) for n in pages], uploads), pipeline.stats()['detection_batching']
+        finally:
+            pipeline.close()
+    return asyncio.run(run())
+
+
+def stamp_boxes(result):
+    return [detection['box'] for detection in result['detected_classes']['stamp']['detections']]
+
+
+def test_concurrent_pages_are_grouped_and_mapped_back_to_their_page():
+    backends = FakeBackends()
+    pages = list(range(1, 11))
+    results, stats = predict(backends, pages, detection_batch_size=4, detection_batch_wait=0.05, detection_concurrent_batches=2)
+    retinanet_calls = [call_pages for backend, call_pages in backends.calls if backend == 'retinanet']
+    assert sorted(page for call_pages in retinanet_calls for page in call_pages) == pages
+    assert len(retinanet_calls) < len(pages)
+    assert max(len(call_pages) for call_pages in retinanet_calls) == 4
+    assert stats['items'] == len(pages) and stats['batches'] == len(retinanet_calls)
+    for n, result in zip(pages, results):
+        assert result['id'] == str(n)
+        assert stamp_boxes(result) == [[n, n, n + 10, n + 10]]
+
+
+def test_a_failed_image_only_affects_its_own_page():
+    backends = FakeBackends(failing_pages={3})
+    results, _ = predict(backends, [1, 2, 3, 4], detection_batch_size=4, detection_batch_wait=0.05)
+    assert [len(call_pages) for backend, call_pages in backends.calls if backend == 'retinanet'] == [4]
+    assert [result['detected_classes'] != {} for result in results] == [True, True, False, True]
+    assert stamp_boxes(results[3]) == [[4, 4, 14, 14]]
+
+
+def test_without_grouping_every_page_is_its_own_call():
+    backends = FakeBackends()
+    results, stats = predict(backends, [1, 2, 3])
+    assert stats is None
+    assert sorted(call_pages for backend, call_pages in backends.calls if backend == 'retinanet') == [[1], [2], [3]]
+    assert [stamp_boxes(result) for result in results] == [[[n, n, n + 10, n + 10]] for n in (1, 2, 3)]
+
+
+def run_batcher(arrivals, delay, **batching):
+    """Submit one item at each arrival time (seconds) to a batcher whose batches take delay seconds; returns the batches and the latency of each item."""
+    batches = []
+
+    async def process_batch(items):
+        batches.append(items)
+        await asyncio.sleep(delay)
+        return items
+
+    async def submit(batcher, item, arrival):
+        await asyncio.sleep(arrival)
+        start = time.perf_counter()
+        assert await batcher.submit(item) == item
+        return time.perf_counter() - start
+
+    async def run():
+        batcher = MicroBatcher(process_batch, **batching)
+        try:
+            return await asyncio.gather(*[submit(batcher, n, arrival) for n, arrival in enumerate(arrivals)])
+        finally:
+            batcher.stop()
+
+    return batches, asyncio.run(run())
+
+
+def test_a_lone_item_does_not_wait_for_its_batch_to_fill():
+    batches, latencies = run_batcher([0, 0.1], 0.01, max_batch_size=4, max_wait=1.0, max_concurrent_batches=2)
+    assert batches == [[0], [1]]
+    assert max(latencies) < 0.5
+
+
+def test_items_arriving_while_every_slot_is_busy_are_grouped():
+    batches, _ = run_batcher([0, 0.01, 0.02, 0.03, 0.04], 0.1, max_batch_size=4, max_wait=0, max_concurrent_batches=1)
+    assert batches == [[0], [1, 2, 3, 4]]
@@ -0,0 +1,63 @@
+import asyncio
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from utils.image_normalize import ImageNormalizer
+
+PROFILES = {
+    'retinanet': {'max_side': 1333, 'format': 'jpeg', 'quality': 90},
+    'LMv3_machine': {'max_side': 2480, 'format': 'png', 'compress_level': 1, 'quality': 90},
+    'LMv3_hand': {'max_side': 2480, 'format': 'png', 'compress_level': 1, 'quality': 90},
+}
+
+
+def scan(width, height, format):
+    """A noisy page, so that lossless re-encoding is expensive."""
+    rng = random.Random(0)
+    image = Image.frombytes('L', (width, height), bytes(rng.getrandbits(8) for _ in range(width * height))).convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format=format, quality=85)
+    return output.getvalue()
+
+
+def test_resized_jpeg_stays_jpeg_and_smaller():
+    normalizer = ImageNormalizer(PROFILES)
+    original = scan(3000, 2000, 'JPEG')
+    contents, scale = normalizer.normalize(original, 'LMv3_machine')
+    assert Image.open(io.BytesIO(contents)).format == 'JPEG'
+    assert Image.open(io.BytesIO(contents)).size == (2480, 1653)
+    assert len(contents) < len(original)
+    assert scale == (3000 / 2480, 2000 / 1653)
+
+
+def test_original_kept_when_re_encoding_is_larger():
+    normalizer = ImageNormalizer(PROFILES)
+    image = Image.new('RGB', (3000, 2000), 'white')
+    draw = ImageDraw.Draw(image)
+    for y in range(0, 2000, 40):
+        draw.rectangle([0, y, 2999, y + 3], fill='black')
+    output = io.BytesIO()
+    image.save(output, format='PNG', compress_level=9)
+    original = output.getvalue()
+    # The downscaled JPEG of a ruled page is far larger than the original PNG
+    assert normalizer.normalize(original, 'retinanet') == (original, None)
+    assert normalizer.stats()['bytes_out']['retinanet'] == len(original)
+
+
+def test_only_posted_backends_are_normalised():
+    normalizer = ImageNormalizer(PROFILES)
+    original = scan(3000, 2000, 'JPEG')
+    page = normalizer.page(original)
+
+    async def post():
+        await page.payload('retinanet')
+        await page.payload('LMv3_machine')
+        await page.payload('LMv3_machine')
+
+    asyncio.run(post())
+    stats = normalizer.stats()
+    assert stats['images'] == 2
+    assert set(stats['bytes_in']) == {'retinanet', 'LMv3_machine'}
+    assert stats['bytes_in']['LMv3_machine'] == len(original)
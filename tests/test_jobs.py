@@ -0,0 +1,66 @@
+import asyncio
+
+from conftest import FakeBackends, FakeClassifier
+from utils.jobs import COMPLETED, QUEUED, JobQueue
+from utils.pipeline import InvoicePipeline
+from utils.result_cache import ResultCache
+from utils.uploads import BufferedUpload
+
+
+async def wait_for_status(queue, job_id, status, timeout=5.0):
+    for _ in range(int(timeout / 0.05)):
+        job = await queue.get(job_id)
+        if job['status'] == status:
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Job {job_id} is still {job['status']}")
+
+
+def test_deferred_job_waits_for_degradation_to_end_and_reuses_detections(tmp_path):
+    backends = FakeBackends()
+    degraded = {'now': True}
+
+    async def run():
+        pipeline = InvoicePipeline(FakeClassifier(), backends, cache=ResultCache(str(tmp_path / 'results.sqlite3')))
+        queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), pipeline, hold_deferred=lambda: degraded['now'])
+        queue.start()
+        try:
+            # The degraded request: object detection only, its detections are cached
+            upload = BufferedUpload('a.png', b'page-1')
+            await pipeline.process_files(['a'], [upload], extract_fields=False)
+            deferred_id = await queue.submit(['a'], [upload], deferred=True)
+            other_id = await queue.submit(['b'], [BufferedUpload('b.png', b'page-2')])
+
+            await wait_for_status(queue, other_id, COMPLETED)
+            await asyncio.sleep(0.3)
+            held = await queue.get(deferred_id)
+            assert held['status'] == QUEUED and held['deferred']
+            assert [backend for backend, _ in backends.calls].count('LMv3_machine') == 1  # The other job only
+
+            degraded['now'] = False
+            job = await wait_for_status(queue, deferred_id, COMPLETED)
+        finally:
+            await queue.stop()
+        return job
+
+    job = asyncio.run(run())
+    result, = job['results']
+    assert result['detected_classes']['stamp']['present']
+    assert result['field_predictions'] == ['date', 'total']
+    assert [pages for backend, pages in backends.calls if backend == 'retinanet'] == [[1], [2]]
+
+
+def test_callback_urls_are_limited_to_the_allowed_hosts(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), None,
+                     callback_allowed_hosts=['https://hooks.example.com', 'http://receiver:9000'])
+    assert queue.callback_allowed('https://hooks.example.com/invoices?batch=1')
+    assert queue.callback_allowed('HTTPS://Hooks.Example.com/done')
+    assert queue.callback_allowed('http://receiver:9000/done')
+    assert not queue.callback_allowed('http://receiver/done')  # Other port
+    assert not queue.callback_allowed('http://hooks.example.com/done')  # Other scheme
+    assert not queue.callback_allowed('http://tr:8081/models')
+    assert not queue.callback_allowed('https://hooks.example.com.attacker.net/')
+    assert not queue.callback_allowed('https://hooks.example.com@od:8081/')
+    assert not queue.callback_allowed('file:///etc/passwd')
+    assert not queue.callback_allowed('not a url')
+    assert not JobQueue(str(tmp_path / 'other.sqlite3'), None).callback_allowed('https://hooks.example.com/')
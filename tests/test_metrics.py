@@ -0,0 +1,29 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from conftest import FakeBackends, FakeClassifier
+from utils.metrics import observe_stage
+from utils.pipeline import InvoicePipeline
+from utils.uploads import BufferedUpload
+
+
+def stage_count(stage, doc_type):
+    return REGISTRY.get_sample_value('gateway_stage_seconds_count', {'stage': stage, 'doc_type': doc_type}) or 0
+
+
+class TimedClassifier(FakeClassifier):
+    """Observes its stages like ImageClassifier, before the page's document type is known."""
+    async def classify_async(self, image_bytes):
+        observe_stage('classifier_inference', 0.01)
+        return await super().classify_async(image_bytes)
+
+
+def test_page_stages_are_labelled_with_the_document_type():
+    before = {stage: stage_count(stage, 'machinewritten') for stage in ('page', 'classifier_inference')}
+    unknown_before = stage_count('upload_read', 'unknown')
+    pipeline = InvoicePipeline(TimedClassifier(), FakeBackends())
+    asyncio.run(pipeline.process_files(['a'], [BufferedUpload('a.png', b'page-1')]))
+    assert stage_count('page', 'machinewritten') == before['page'] + 1
+    assert stage_count('classifier_inference', 'machinewritten') == before['classifier_inference'] + 1
+    assert stage_count('upload_read', 'unknown') == unknown_before + 1
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeBackends, FakeClassifier, page_detections, page_number
+import utils.pipeline
+from utils.pipeline import InvoicePipeline
+from utils.uploads import BufferedUpload
+
+PAGES = 6
+
+
+class SignedBackends(FakeBackends):
+    """FakeBackends whose page signed_page also carries a signature."""
+    def __init__(self, signed_page, **kwargs):
+        super().__init__(**kwargs)
+        self.signed_page = signed_page
+
+    def detections(self, image_bytes):
+        detections = page_detections(image_bytes)
+        if page_number(image_bytes) == self.signed_page:
+            detections = {'boxes': detections['boxes'] * 2, 'scores': [0.9, 0.9], 'labels': [1, 2]}
+        return detections
+
+
+@pytest.fixture(autouse=True)
+def fake_pdf(monkeypatch):
+    """Render a PDF as the fake pages b'page-1' ... b'page-6', in page order."""
+    async def stream_pdf_pages(pdf_bytes, max_buffered_pages=2, observe=None, order='natural'):
+        for n in range(1, PAGES + 1):
+            yield n, f'page-{n}'.encode()
+
+    monkeypatch.setattr(utils.pipeline, 'stream_pdf_pages', stream_pdf_pages)
+
+
+def analyse(backends, **kwargs):
+    pipeline = InvoicePipeline(FakeClassifier(), backends, single_flight=False, presence_target_fields=['total', 'date'], **kwargs)
+    result, = asyncio.run(pipeline.process_files(['a'], [BufferedUpload('a.pdf', b'%PDF')], presence=True))
+    return result
+
+
+@pytest.mark.parametrize('signed_page', [1, 3])
+def test_pages_after_everything_was_found_are_not_analysed(signed_page):
+    backends = SignedBackends(signed_page, delays={'retinanet': 0.01, 'LMv3_machine': 0.01})
+    result = analyse(backends)
+    assert result['detected_classes']['stamp']['present']
+    assert result['detected_classes']['signature']['present']
+    assert result['field_predictions'] == ['date', 'total']
+    # The fields are all found on the first page, the detections on the signed one
+    assert result['pages_analysed'] == {'od': signed_page, 'fields': 1}
+    assert sorted({pages[0] for backend, pages in backends.calls if backend == 'retinanet'}) == list(range(1, signed_page + 1))
+
+
+def test_wider_window_analyses_pages_in_flight():
+    backends = SignedBackends(1, delays={'retinanet': 0.01, 'LMv3_machine': 0.01})
+    result = analyse(backends, presence_max_pages_in_flight=PAGES)
+    assert result['pages_analysed'] == {'od': PAGES, 'fields': PAGES}
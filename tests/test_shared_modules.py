@@ -0,0 +1,12 @@
+from pathlib import Path
+
+import pytest
+
+# Modules the object detection service copies from the gateway, since it is built from its own Docker context
+SHARED_MODULES = ['utils/admission.py', 'utils/budget.py', 'utils/pdf_to_png.py', 'middleware/admission.py']
+
+
+@pytest.mark.parametrize('path', SHARED_MODULES)
+def test_object_detection_copy_matches_gateway(path):
+    assert Path('object_detection', path).read_text() == Path(path).read_text(), (
+        f"object_detection/{path} differs from {path}: edit the gateway's copy and copy it over")
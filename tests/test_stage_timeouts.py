@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeBackends, FakeClassifier
+from utils.pipeline import InvoicePipeline
+from utils.postprocessing import aggregate_results
+from utils.uploads import BufferedUpload
+
+STAGE_BUDGETS = {'od': 0.05, 'classifier': 0.05, 'lmv3': 0.05}  # 50 ms of a 1 s deadline
+
+
+def predict(backends, classifier, uploads):
+    pipeline = InvoicePipeline(classifier, backends, request_deadline=1.0, stage_budgets=STAGE_BUDGETS)
+    return asyncio.run(pipeline.process_files([upload.filename for upload in uploads], uploads))
+
+
+def test_no_timeout():
+    result, = predict(FakeBackends(), FakeClassifier(), [BufferedUpload('a.png', b'page-1')])
+    assert result['timed_out'] == []
+    assert result['detected_classes']['stamp']['present']
+    assert result['field_predictions'] == ['date', 'total']
+
+
+@pytest.mark.parametrize('backends, classifier, stage', [
+    (FakeBackends({'retinanet': 1}), FakeClassifier(), 'od'),
+    (FakeBackends(), FakeClassifier(delay=1), 'classifier'),
+    (FakeBackends({'LMv3_machine': 1}), FakeClassifier(), 'lmv3'),
+])
+def test_timed_out_stage_is_reported(backends, classifier, stage):
+    result, = predict(backends, classifier, [BufferedUpload('a.png', b'page-1')])
+    assert result['timed_out'] == [stage]
+    if stage == 'od':
+        assert result['detected_classes'] == {}
+        assert result['field_predictions'] == ['date', 'total']
+    else:
+        assert result['detected_classes']['stamp']['present']
+        assert result['field_predictions'] == []
+
+
+def test_only_the_file_that_timed_out_is_marked():
+    backends = FakeBackends()
+    answer = backends.post
+
+    async def post(backend, files):
+        if backend == 'retinanet' and files['data'][1] == b'page-2':
+            await asyncio.sleep(1)
+        return await answer(backend, files)
+
+    backends.post = post
+    first, second = predict(backends, FakeClassifier(), [BufferedUpload('a.png', b'page-1'), BufferedUpload('b.png', b'page-2')])
+    assert first['timed_out'] == []
+    assert second['timed_out'] == ['od']
+
+
+def test_pdf_result_lists_the_stages_timed_out_on_any_page():
+    file_result = {'detected_classes': {}, 'field_predictions': [], 'timed_out': []}
+    aggregate_results(file_result, [
+        {'detected_classes': {}, 'unique_fields': ['total'], 'timed_out': ['od']},
+        {'detected_classes': {}, 'unique_fields': [], 'timed_out': ['lmv3']},
+        {'detected_classes': {}, 'unique_fields': ['date'], 'timed_out': []},
+    ])
+    assert file_result['timed_out'] == ['lmv3', 'od']
+    assert file_result['field_predictions'] == ['date', 'total']
@@ -0,0 +1,90 @@
+import io
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+pytest.importorskip('cv2')
+pytest.importorskip('torchvision')
+pytest.importorskip('onnxruntime')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'object_detection', 'torchserve'))
+
+import docker_handler  # noqa: E402
+import docker_onnx_handler  # noqa: E402
+from docker_onnx_handler import INPUT_SIZE, letterbox  # noqa: E402
+
+
+def png(width, height, box=None):
+    image = Image.new('RGB', (width, height), 'black')
+    if box is not None:
+        ImageDraw.Draw(image).rectangle(box, fill='white')
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+class FakeContext:
+    def __init__(self):
+        self.statuses = []
+
+    def set_response_status(self, code, phrase, idx):
+        self.statuses.append((idx, code))
+
+
+@pytest.mark.parametrize('handler_module', [docker_handler, docker_onnx_handler])
+def test_request_images_orders_parts_by_index(handler_module):
+    row = {'image_10': b'k', 'image_2': b'c', 'image_0': b'a', 'image_1': b'b', 'image_x': b'ignored'}
+    assert handler_module.request_images(row) == ([b'a', b'b', b'c', b'k'], True)
+    assert handler_module.request_images({'data': b'a'}) == ([b'a'], False)
+    assert handler_module.request_images({'body': b'a'}) == ([b'a'], False)
+
+
+def test_torch_handler_answers_each_image_of_a_multi_image_request_in_order():
+    handler = docker_handler.DetectionModelHandler()
+    data = [{'image_0': png(40, 30), 'image_1': b'not an image', 'image_2': png(50, 20)}, {'data': b'not an image'}]
+    images, requests = handler.preprocess(data)
+    assert [tuple(image.shape) for image in images] == [(3, 30, 40), (3, 20, 50)]
+    assert requests == [(True, [0, None, 1]), (False, [None])]
+
+    outputs = [{'boxes': [[i, i, i + 1, i + 1]], 'labels': [1], 'scores': [0.9]} for i in range(len(images))]
+    context = FakeContext()
+    multi, single = [json.loads(response) for response in handler.postprocess(outputs, requests, context)]
+    assert multi == [outputs[0], docker_handler.INVALID_IMAGE, outputs[1]]
+    assert single == docker_handler.INVALID_IMAGE
+    assert context.statuses == [(1, 400)]
+
+
+def test_onnx_handler_answers_each_image_of_a_multi_image_request_in_order():
+    handler = docker_onnx_handler.DetectionModelHandler()
+    data = [{'image_0': png(40, 30), 'image_1': b'not an image', 'image_2': png(50, 20)}]
+    model_input, shapes, requests = handler.preprocess(data)
+    assert model_input.shape == (2, 3, INPUT_SIZE, INPUT_SIZE)
+    assert [shape[1:] for shape in shapes] == [(40, 30), (50, 20)]
+    assert requests == [(True, [0, None, 1])]
+
+    outputs = [([[0, 0, 64, 64]], [0.9], [1]), ([[0, 0, 700, 128]], [0.8], [2])]
+    first, invalid, second = json.loads(handler.postprocess(outputs, shapes, requests, FakeContext())[0])
+    assert invalid == docker_onnx_handler.INVALID_IMAGE
+    assert first['labels'] == [1] and second['labels'] == [2]
+    assert np.allclose(first['boxes'], [[0, 0, 64 / shapes[0][0], 64 / shapes[0][0]]])
+    assert np.allclose(second['boxes'], [[0, 0, 50, 128 / shapes[1][0]]])  # Clipped to the original width
+
+
+@pytest.mark.parametrize('width, height', [(1000, 600), (600, 1000), (320, 200)])
+def test_letterbox_boxes_map_back_to_the_original_image(width, height):
+    box = [width // 5, height // 4, width // 2, height // 2]
+    image = np.array(Image.open(io.BytesIO(png(width, height, box))))
+    square, scale = letterbox(image, INPUT_SIZE)
+    assert square.shape == (INPUT_SIZE, INPUT_SIZE, 3)
+    assert scale == INPUT_SIZE / max(width, height)
+
+    # Where the box landed in the letterboxed image, as the model would report it
+    rows, columns = np.nonzero(square[:, :, 0] > 127)
+    letterboxed_box = [columns.min(), rows.min(), columns.max(), rows.max()]
+    output = ([letterboxed_box], [0.9], [1])
+    detections = docker_onnx_handler.DetectionModelHandler().detections(output, (scale, width, height))
+    assert np.allclose(detections['boxes'][0], box, atol=2 / scale)
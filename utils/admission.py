@@ -0,0 +1,162 @@
+# Shared with the object detection service, which is built from its own Docker context and cannot
+# import the gateway's packages: object_detection/utils/admission.py is a verbatim copy of this file, checked by
+# tests/test_shared_modules.py. Edit this copy and copy it over.
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import math
+import time
+
+from utils.budget import CountingBudget
+
+
+class Overloaded(Exception):
+    """A request turned away by admission control, with the status code and Retry-After (seconds) to answer."""
+    def __init__(self, status_code, retry_after, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+    def headers(self):
+        return {'Retry-After': str(self.retry_after)}
+
+
+class RateLimiter:
+    """
+    Token bucket per client (an API key or an IP address): a client may send burst requests at once
+    and rate requests per second on average.
+
+    Parameters:
+    - rate: Tokens added to each bucket per second.
+    - burst: Size of the buckets.
+    - max_clients: Buckets kept; the least recently seen clients are forgotten beyond it (their
+      bucket starts full again).
+    - on_reject: Optional callable given the reason ('rate_limited') of every rejection.
+    """
+    def __init__(self, rate, burst, max_clients=10000, on_reject=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.on_reject = on_reject
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+    def acquire(self, client):
+        """Take a token from the client's bucket. Returns 0 when granted, else the seconds until a token is available."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self.buckets[client] = (tokens - 1, now)
+            wait = 0.0
+        else:
+            self.buckets[client] = (tokens, now)
+            self.limited += 1
+            if self.on_reject is not None:
+                self.on_reject('rate_limited')
+            wait = (1 - tokens) / self.rate
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'clients': len(self.buckets), 'limited': self.limited}
+
+
+class AdmissionQueue:
+    """
+    Global budget of pages in flight in front of a service, with a bounded FIFO wait queue.
+
+    A request is admitted as soon as its pages fit in the budget; otherwise it waits in the queue,
+    at most max_queue_wait seconds. When max_queued_requests are already waiting, or the wait runs
+    out, the request is rejected with 503 and a Retry-After estimated from the pages ahead of it and
+    the rate at which pages were completed recently. A request larger than the whole budget runs alone.
+
+    Parameters:
+    - max_pages: Pages admitted at once, across all requests.
+    - max_queued_requests: Requests allowed to wait for the budget.
+    - max_queue_wait: Seconds a request may wait before being rejected.
+    - rate_window: Seconds of completed pages the service rate is measured over.
+    - service: Name of the service in the 503 message.
+    - on_reject: Optional callable given the reason ('queue_full' or 'queue_timeout') of every rejection.
+    """
+    def __init__(self, max_pages, max_queued_requests, max_queue_wait, rate_window=30.0, service='service', on_reject=None):
+        self.budget = CountingBudget(max_pages)
+        self.max_queued_requests = max_queued_requests
+        self.max_queue_wait = max_queue_wait
+        self.rate_window = rate_window
+        self.service = service
+        self.on_reject = on_reject
+        self.completions = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    def full(self):
+        return len(self.budget.waiters) >= self.max_queued_requests
+
+    def queued_pages(self):
+        return sum(pages for pages, _ in self.budget.waiters)
+
+    def service_rate(self):
+        """Pages completed per second over the last rate_window seconds, or None before any completed."""
+        now = time.monotonic()
+        while self.completions and self.completions[0][0] < now - self.rate_window:
+            self.completions.popleft()
+        if not self.completions:
+            return None
+        elapsed = max(now - self.completions[0][0], 1.0)
+        return sum(pages for _, pages in self.completions) / elapsed
+
+    def retry_after(self, pages=0):
+        """Seconds until the pages in flight, those queued and pages more are expected to be processed."""
+        rate = self.service_rate()
+        if rate is None:
+            return max(1, math.ceil(self.max_queue_wait))
+        return max(1, math.ceil((self.budget.in_use + self.queued_pages() + pages) / rate))
+
+    def overloaded(self, reason, pages=0):
+        self.rejected += 1
+        if self.on_reject is not None:
+            self.on_reject(reason)
+        return Overloaded(503, self.retry_after(pages), f"The {self.service} is overloaded, retry later.")
+
+    async def acquire(self, pages):
+        """
+        Wait until pages fit in the budget and reserve them. Returns the reserved amount, to release
+        once the request completes. Raises Overloaded when the request is rejected.
+        """
+        if self.full():
+            raise self.overloaded('queue_full', pages)
+        try:
+            reserved = await asyncio.wait_for(self.budget.acquire(pages), self.max_queue_wait)
+        except asyncio.TimeoutError:
+            raise self.overloaded('queue_timeout', pages) from None
+        self.admitted += 1
+        return reserved
+
+    @asynccontextmanager
+    async def admit(self, pages):
+        """Hold pages of the budget while the block runs. Raises Overloaded when the request is rejected."""
+        reserved = await self.acquire(pages)
+        try:
+            yield
+        finally:
+            self.release(reserved)
+
+    def release(self, pages):
+        self.budget.release(pages)
+        self.completions.append((time.monotonic(), pages))
+
+    def stats(self):
+        rate = self.service_rate()
+        return {
+            'max_pages': self.budget.limit,
+            'pages_in_flight': self.budget.in_use,
+            'peak_pages_in_flight': self.budget.peak,
+            'queued_requests': len(self.budget.waiters),
+            'queued_pages': self.queued_pages(),
+            'service_rate_pages_per_second': round(rate, 2) if rate is not None else None,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,392 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from utils.latency import LatencyTracker
+
+DEFAULT_POOL = {
+    'max_connections': 32,
+    'max_keepalive_connections': 16,
+    'keepalive_expiry': 30.0,
+    'timeout': 30.0,
+    'connect_timeout': 5.0,
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def http2_available():
+    """HTTP/2 support in httpx needs the optional 'h2' package."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """
+    Stops routing requests to a replica after failure_threshold consecutive failures.
+    After open_seconds a single trial request is let through (half-open): its success closes the
+    breaker, its failure opens it again.
+    """
+    def __init__(self, failure_threshold=3, open_seconds=15.0):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at < self.open_seconds:
+            return OPEN
+        return HALF_OPEN
+
+    def allows_request(self):
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self.trial_in_flight)
+
+    def on_request(self):
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = True
+
+    def on_cancel(self):
+        self.trial_in_flight = False  # A cancelled trial says nothing about the replica
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        half_open = self.state == HALF_OPEN
+        self.trial_in_flight = False
+        if half_open or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+class Replica:
+    """
+    One TorchServe endpoint of a backend, with its own pooled httpx.AsyncClient, request counters,
+    circuit breaker and the result of the latest health probe.
+    """
+    def __init__(self, url, pool, http2=False, failure_threshold=3, open_seconds=15.0, latency=None):
+        self.url = url
+        self.latency = latency
+        self.ping_url = str(httpx.URL(url).copy_with(path='/ping', query=None))
+        self.pool = pool
+        self.http2 = http2
+        self.client = None
+        self.breaker = CircuitBreaker(failure_threshold, open_seconds)
+        self.healthy = True  # Until a probe says otherwise
+        self.last_probe = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def open(self):
+        limits = httpx.Limits(
+            max_connections=self.pool['max_connections'],
+            max_keepalive_connections=self.pool['max_keepalive_connections'],
+            keepalive_expiry=self.pool['keepalive_expiry'],
+        )
+        timeout = httpx.Timeout(self.pool['timeout'], connect=self.pool['connect_timeout'])
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=self.http2)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @property
+    def available(self):
+        return self.healthy and self.breaker.allows_request()
+
+    async def post(self, **kwargs):
+        self.in_flight += 1
+        self.requests += 1
+        self.breaker.on_request()
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(self.url, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.on_cancel()
+            raise
+        finally:
+            self.in_flight -= 1
+        if response.status_code >= 500:
+            self.errors += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+            if self.latency is not None:
+                self.latency.record(time.perf_counter() - start)
+        return response
+
+    async def probe(self, timeout):
+        """Query TorchServe's /ping; the replica is healthy when it answers 200."""
+        try:
+            response = await self.client.get(self.ping_url, timeout=timeout)
+            healthy = response.status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != self.healthy:
+            logging.warning(f"Backend replica {self.url} is now {'healthy' if healthy else 'unhealthy'}")
+        self.healthy = healthy
+        self.last_probe = time.time()
+
+    def stats(self):
+        """
+        Health, breaker and connection pool statistics of the replica.
+        Connection counts come from the httpcore pool and are omitted if it cannot be inspected.
+        """
+        stats = {
+            'url': self.url,
+            'healthy': self.healthy,
+            'circuit': self.breaker.state,
+            'circuit_trips': self.breaker.trips,
+            'last_probe': self.last_probe,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+        try:
+            connections = self.client._transport._pool.connections
+        except AttributeError:
+            return stats
+        stats['connections'] = len(connections)
+        stats['idle_connections'] = sum(1 for connection in connections if connection.is_idle())
+        stats['http2_connections'] = sum(1 for connection in connections if 'HTTP/2' in connection.info())
+        return stats
+
+
+class Backend:
+    """
+    A TorchServe model served by one or more replicas.
+
+    Each request goes to the available replica (healthy and circuit not open) with the fewest
+    outstanding requests. On a 5xx response or a transport error (timeout, refused connection),
+    the request is retried up to max_retries times, each time on a replica it has not tried yet.
+    When no replica is available, the least loaded one is tried anyway.
+
+    With hedging, a request still unanswered after the hedge_percentile of the backend's recent
+    latencies (at least hedge_min_delay) is duplicated on another replica, or on the same one when it
+    is the only replica so that another TorchServe worker picks it up. The first successful response
+    wins and the other request is cancelled. At most hedge_max_ratio of the requests are hedged,
+    so a slow backend is not flooded with duplicates.
+    """
+    def __init__(self, name, urls, pool, http2=False, max_retries=1, failure_threshold=3, open_seconds=15.0,
+                 hedging=False, hedge_percentile=95, hedge_min_delay=0.05, hedge_max_ratio=0.1):
+        self.name = name
+        self.pool = {**DEFAULT_POOL, **(pool or {})}
+        self.http2 = http2
+        self.max_retries = max_retries
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.latency = LatencyTracker()
+        if isinstance(urls, str):
+            urls = [urls]
+        self.replicas = [Replica(url, self.pool, http2, failure_threshold, open_seconds, self.latency) for url in urls]
+        self.retries = 0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def open(self):
+        for replica in self.replicas:
+            replica.open()
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.close()
+
+    @property
+    def healthy(self):
+        return any(replica.available for replica in self.replicas)
+
+    @property
+    def in_flight(self):
+        return sum(replica.in_flight for replica in self.replicas)
+
+    def choose(self, exclude=()):
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        if not candidates:
+            return None
+        available = [replica for replica in candidates if replica.available] or candidates
+        fewest = min(replica.in_flight for replica in available)
+        return random.choice([replica for replica in available if replica.in_flight == fewest])
+
+    def hedge_delay(self):
+        """Delay after which a request is hedged, or None if it must not be."""
+        if not self.hedging or self.hedges >= self.hedge_max_ratio * self.calls:
+            return None
+        delay = self.latency.percentile(self.hedge_percentile)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    async def post(self, **kwargs):
+        self.calls += 1
+        tried = []
+        replica = self.choose()
+        while True:
+            tried.append(replica)
+            try:
+                response = await self.post_hedged(replica, tried, kwargs)
+            except httpx.TransportError:
+                retry = len(tried) <= self.max_retries and self.choose(tried)
+                if not retry:
+                    raise
+            else:
+                retry = response.status_code >= 500 and len(tried) <= self.max_retries and self.choose(tried)
+                if not retry:
+                    return response
+            logging.warning(f"Retrying {self.name} request on {retry.url} after a failure on {replica.url}")
+            self.retries += 1
+            replica = retry
+
+    async def post_hedged(self, replica, tried, kwargs):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await replica.post(**kwargs)
+        primary = asyncio.ensure_future(replica.post(**kwargs))
+        attempts = [primary]
+        try:
+            done, pending = await asyncio.wait(attempts, timeout=delay)
+            if not done:
+                hedge_replica = self.choose(tried) or replica
+                if hedge_replica is not replica:
+                    tried.append(hedge_replica)
+                self.hedges += 1
+                hedge = asyncio.ensure_future(hedge_replica.post(**kwargs))
+                attempts.append(hedge)
+                pending.add(hedge)
+            while True:
+                if not done:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None and attempt.result().status_code < 500:
+                        if attempt is not primary:
+                            self.hedge_wins += 1
+                        return attempt.result()
+                if not pending:
+                    return attempt.result()  # Every attempt failed: return or raise the last failure
+                done = set()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def probe(self, timeout):
+        await asyncio.gather(*[replica.probe(timeout) for replica in self.replicas])
+
+    def stats(self):
+        return {
+            'http2': self.http2,
+            'max_connections': self.pool['max_connections'],
+            'max_keepalive_connections': self.pool['max_keepalive_connections'],
+            'in_flight': self.in_flight,
+            'requests': sum(replica.requests for replica in self.replicas),
+            'errors': sum(replica.errors for replica in self.replicas),
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'latency': self.latency.stats(),
+            'replicas': [replica.stats() for replica in self.replicas],
+        }
+
+    def health(self):
+        return {
+            'healthy': self.healthy,
+            'replicas': [
+                {'url': replica.url, 'healthy': replica.healthy, 'circuit': replica.breaker.state, 'last_probe': replica.last_probe}
+                for replica in self.replicas
+            ],
+        }
+
+
+class BackendClients:
+    """
+    Process-wide pooled HTTP clients for the TorchServe backends.
+
+    Each backend can be served by several replicas, balanced by fewest outstanding requests, with
+    a circuit breaker per replica and retries on another replica (see Backend). Every replica gets
+    its own connection pool with keep-alive, optional HTTP/2 and its own timeouts. Clients are
+    opened at application startup and closed at shutdown; in between, every replica's TorchServe
+    /ping is probed every health_interval seconds and unhealthy replicas receive no traffic.
+
+    Parameters:
+    - urls: Mapping of backend name to a TorchServe prediction URL or a list of them.
+    - pools: Mapping of backend name to pool settings (see DEFAULT_POOL), applied to each replica; missing keys use the defaults.
+    - http2: Negotiate HTTP/2 with the backends (requires the 'h2' package).
+    - max_retries: Retries of a failed request, each on another replica.
+    - failure_threshold: Consecutive failures that open a replica's circuit breaker.
+    - open_seconds: How long an open breaker keeps the replica out of rotation before a trial request.
+    - health_interval: Seconds between health probes; None or 0 disables probing.
+    - health_timeout: Timeout (seconds) of a health probe.
+    - hedging: Mapping of hedging settings (enabled, percentile, min_delay, max_ratio), see Backend.
+    """
+    def __init__(self, urls, pools=None, http2=False, max_retries=1, failure_threshold=3, open_seconds=15.0,
+                 health_interval=5.0, health_timeout=2.0, hedging=None):
+        pools = pools or {}
+        if http2 and not http2_available():
+            logging.warning("HTTP/2 requested for the backends but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+        hedging = hedging or {}
+        self.backends = {
+            name: Backend(name, url, pools.get(name), http2=http2, max_retries=max_retries,
+                          failure_threshold=failure_threshold, open_seconds=open_seconds,
+                          hedging=hedging.get('enabled', False),
+                          hedge_percentile=hedging.get('percentile', 95),
+                          hedge_min_delay=hedging.get('min_delay', 0.05),
+                          hedge_max_ratio=hedging.get('max_ratio', 0.1))
+            for name, url in urls.items()
+        }
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.probe_task = None
+
+    def open(self):
+        for backend in self.backends.values():
+            backend.open()
+        if self.health_interval:
+            self.probe_task = asyncio.create_task(self._probe_forever())
+
+    async def close(self):
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            await asyncio.gather(self.probe_task, return_exceptions=True)
+            self.probe_task = None
+        for backend in self.backends.values():
+            await backend.close()
+
+    async def _probe_forever(self):
+        while True:
+            await asyncio.gather(*[backend.probe(self.health_timeout) for backend in self.backends.values()])
+            await asyncio.sleep(self.health_interval)
+
+    async def post(self, name, **kwargs):
+        """POST to the prediction URL of the named backend, e.g. post('retinanet', files=...)."""
+        return await self.backends[name].post(**kwargs)
+
+    def stats(self):
+        return {name: backend.stats() for name, backend in self.backends.items()}
+
+    def health(self):
+        """Cached health of every backend and replica, as of the latest probes and requests."""
+        return {name: backend.health() for name, backend in self.backends.items()}
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted concurrently (e.g. from several in-flight requests) into batches.
+
+    While fewer than max_concurrent_batches batches are running, an item is dispatched at once,
+    together with the items already queued: a lone item never waits for a batch to fill. Once every
+    batch slot is busy, new items keep queueing until a slot frees up, and are then dispatched
+    together after at most max_wait more seconds, so batches grow with the load.
+
+    Parameters:
+    - process_batch: Async callable taking a list of items and returning one result per item, in order.
+    - max_batch_size: Maximum number of items per batch.
+    - max_wait: Maximum time (seconds) a batch formed while every slot was busy waits to fill once a slot frees up.
+    - max_concurrent_batches: Number of batches allowed to run at the same time.
+    """
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.005, max_concurrent_batches=1):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrent_batches = max_concurrent_batches
+        self.queue = None
+        self.worker = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        """Queue an item and wait for its own result."""
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future))
+        return await future
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.max_concurrent_batches)
+        while True:
+            batch = [await self.queue.get()]
+            if slots.locked():
+                # Every slot is busy: items queue up until one frees up, then the batch may fill a little more
+                await slots.acquire()
+                self._drain(batch)
+                if len(batch) < self.max_batch_size and self.max_wait > 0:
+                    await asyncio.sleep(self.max_wait)
+            else:
+                await slots.acquire()
+            self._drain(batch)
+            asyncio.create_task(self._dispatch(batch, slots))
+
+    async def _dispatch(self, batch, slots):
+        try:
+            batch = [(item, future) for item, future in batch if not future.done()]  # Drop cancelled callers
+            if not batch:
+                return
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                logging.exception("Batch of %d items failed", len(batch))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            slots.release()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'average_batch_size': self.items / self.batches if self.batches else 0.0,
+            'pending': self.queue.qsize() if self.queue is not None else 0,
+        }
@@ -0,0 +1,75 @@
+# Shared with the object detection service, which is built from its own Docker context and cannot
+# import the gateway's packages: object_detection/utils/budget.py is a verbatim copy of this file, checked by
+# tests/test_shared_modules.py. Edit this copy and copy it over.
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class CountingBudget:
+    """
+    Asynchronous counting semaphore bounding an amount held at once, in whatever unit its callers
+    reserve: bytes of uploaded files in memory, or pages admitted to the pipeline.
+
+    Reservations are granted in FIFO order, so a large reservation is not starved by a stream of small
+    ones. A reservation larger than the whole budget is clamped to it, so an oversized one waits until
+    it can run alone instead of waiting forever.
+
+    Parameters:
+    - limit: Budget, in the unit of the reservations.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waiters = deque()
+
+    async def acquire(self, amount):
+        """Wait until amount fits in the budget and reserve it. Returns the reserved amount."""
+        amount = min(amount, self.limit)
+        if not self.waiters and self.in_use + amount <= self.limit:
+            self._grant(amount)
+            return amount
+        waiter = (amount, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter[1].done() and not waiter[1].cancelled():
+                self.in_use -= amount  # Granted just before being cancelled
+            self._wake()
+            raise
+        return amount
+
+    def release(self, amount):
+        self.in_use -= amount
+        self._wake()
+
+    @asynccontextmanager
+    async def reserve(self, amount):
+        reserved = await self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(reserved)
+
+    def _grant(self, amount):
+        self.in_use += amount
+        self.peak = max(self.peak, self.in_use)
+
+    def _wake(self):
+        while self.waiters:
+            amount, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+            if self.in_use + amount > self.limit:
+                break
+            self.waiters.popleft()
+            self._grant(amount)
+            future.set_result(None)
+
+    def stats(self):
+        return {'limit': self.limit, 'in_use': self.in_use, 'peak': self.peak, 'waiting': len(self.waiters)}
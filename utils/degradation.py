@@ -0,0 +1,89 @@
+import contextvars
+import time
+
+from utils.metrics import DEGRADED_REQUESTS
+
+# Whether the request being processed skips the classifier -> LayoutLMv3 branch, inherited by the tasks it creates
+fields_skipped = contextvars.ContextVar('fields_skipped', default=False)
+
+DEGRADATION_MODES = ('skip', 'defer')
+
+
+class DegradationPolicy:
+    """
+    Decides, from the load of the LayoutLMv3 backends, whether requests marked as degradable get
+    object detection only.
+
+    The backends are overloaded when more than max_in_flight requests are outstanding across the
+    watched backends, or when the percentile of the latencies recorded by one of them over the last
+    latency_window seconds exceeds max_latency. Degradation then lasts at least hold_seconds after
+    the thresholds were last crossed, so it does not flap from one request to the next. Once the
+    degraded requests stop reaching the backends their load drops, and degradation ends.
+
+    Parameters:
+    - backends: The BackendClients of the pipeline.
+    - watched: Names of the backends whose load is watched.
+    - enabled: Degrade at all.
+    - mode: 'skip' drops the field extraction of degraded requests, 'defer' queues it as a job.
+    - max_in_flight: Outstanding requests on the watched backends; None to ignore.
+    - max_latency: Latency (seconds); None to ignore.
+    - percentile: Percentile of the recent latencies compared with max_latency.
+    - latency_window: Seconds of latencies considered.
+    - hold_seconds: Minimum duration of a degradation.
+    """
+    def __init__(self, backends, watched=('LMv3_machine', 'LMv3_hand'), enabled=True, mode='defer', max_in_flight=None,
+                 max_latency=None, percentile=95, latency_window=10.0, hold_seconds=5.0):
+        if mode not in DEGRADATION_MODES:
+            raise ValueError(f"Unknown degradation mode: {mode}")
+        self.backends = [backends.backends[name] for name in watched]
+        self.enabled = enabled
+        self.mode = mode
+        self.max_in_flight = max_in_flight
+        self.max_latency = max_latency
+        self.percentile = percentile
+        self.latency_window = latency_window
+        self.hold_seconds = hold_seconds
+        self.degraded_until = 0.0
+        self.degraded_requests = 0
+
+    def in_flight(self):
+        return sum(backend.in_flight for backend in self.backends)
+
+    def latency(self):
+        """Highest recent latency percentile of the watched backends, or None without enough recent calls."""
+        latencies = [backend.latency.recent_percentile(self.percentile, self.latency_window) for backend in self.backends]
+        latencies = [latency for latency in latencies if latency is not None]
+        return max(latencies) if latencies else None
+
+    def overloaded(self):
+        if self.max_in_flight is not None and self.in_flight() > self.max_in_flight:
+            return True
+        latency = self.latency() if self.max_latency is not None else None
+        return latency is not None and latency > self.max_latency
+
+    def degraded(self):
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        if self.overloaded():
+            self.degraded_until = now + self.hold_seconds
+        return now < self.degraded_until
+
+    def degrade(self, endpoint):
+        """Whether a degradable request arriving now gets object detection only; counts it if so."""
+        if not self.degraded():
+            return False
+        self.degraded_requests += 1
+        DEGRADED_REQUESTS.labels(endpoint=endpoint, mode=self.mode).inc()
+        return True
+
+    def stats(self):
+        latency = self.latency()
+        return {
+            'enabled': self.enabled,
+            'mode': self.mode,
+            'degraded': self.degraded(),
+            'in_flight': self.in_flight(),
+            f'p{self.percentile}_latency': round(latency, 4) if latency is not None else None,
+            'degraded_requests': self.degraded_requests,
+        }
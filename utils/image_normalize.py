@@ -0,0 +1,130 @@
+import asyncio
+import io
+import logging
+import time
+from collections import defaultdict
+
+from PIL import Image
+
+from utils.metrics import observe_stage
+
+FORMATS = {'jpeg': 'JPEG', 'png': 'PNG'}
+
+
+class ImageNormalizer:
+    """
+    Shrinks and re-encodes page images before they are posted to the TorchServe backends.
+
+    A page is normalised separately for each backend it is posted to: the image is downscaled so that
+    its longest side is at most max_side and re-encoded with that backend's profile. JPEG sources stay
+    JPEG (at the profile's quality) even for PNG profiles, since a lossless copy of a lossy image only
+    grows. The original bytes are sent when they are already small enough and in the target format,
+    when the re-encoded image is not smaller than the original, or when the image cannot be decoded.
+
+    Parameters:
+    - profiles: Maps a backend name to {'max_side': int, 'format': 'jpeg' or 'png', 'quality': int (jpeg,
+      and png profiles given a jpeg source), 'compress_level': int (png)}. Backends without a profile
+      (or with None) receive the original bytes.
+    """
+    def __init__(self, profiles):
+        self.profiles = {backend: profile for backend, profile in (profiles or {}).items() if profile}
+        for backend, profile in self.profiles.items():
+            if profile['format'] not in FORMATS:
+                raise ValueError(f"Unknown image format for {backend}: {profile['format']}")
+        self.images = 0
+        self.seconds = 0.0
+        self.bytes_in = defaultdict(int)
+        self.bytes_out = defaultdict(int)
+
+    def profile_id(self, backend):
+        """Short description of a backend's profile, part of the result cache model identifiers."""
+        profile = self.profiles.get(backend)
+        if profile is None:
+            return 'raw'
+        if profile['format'] == 'jpeg':
+            return f"max{profile['max_side']}-jpeg-q{profile.get('quality', 90)}"
+        return f"max{profile['max_side']}-png-q{profile.get('quality', 90)}"
+
+    def normalize(self, image_bytes, backend):
+        """
+        Return the (contents, scale) to post to a profiled backend (blocking).
+        scale is the (x, y) factor mapping coordinates in the sent image back to the original image,
+        or None when the original bytes are sent.
+        """
+        profile = self.profiles[backend]
+        start = time.perf_counter()
+        contents, scale = image_bytes, None
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            source_format = image.format
+            width, height = image.size
+            size = self.target_size(width, height, profile['max_side'])
+            target_format = 'jpeg' if source_format == 'JPEG' else profile['format']
+            if size != (width, height) or FORMATS[target_format] != source_format:
+                # Let JPEGs decode directly at a reduced scale, still at least as large as the target
+                image.draft('RGB', size)
+                image = image.convert('RGB')
+                if image.size != size:
+                    image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+                encoded = self.encode(image, {**profile, 'format': target_format})
+                if len(encoded) < len(image_bytes):
+                    contents = encoded
+                    scale = None if size == (width, height) else (width / size[0], height / size[1])
+        except Exception as e:
+            logging.warning(f"Could not decode page image, sending it unchanged: {e!r}")
+
+        elapsed = time.perf_counter() - start
+        observe_stage('image_normalize', elapsed)
+        self.images += 1
+        self.seconds += elapsed
+        self.bytes_in[backend] += len(image_bytes)
+        self.bytes_out[backend] += len(contents)
+        return contents, scale
+
+    @staticmethod
+    def target_size(width, height, max_side):
+        longest = max(width, height)
+        if longest <= max_side:
+            return width, height
+        ratio = max_side / longest
+        return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+    @staticmethod
+    def encode(image, profile):
+        output = io.BytesIO()
+        if profile['format'] == 'jpeg':
+            image.save(output, format='JPEG', quality=profile.get('quality', 90))
+        else:
+            image.save(output, format='PNG', compress_level=profile.get('compress_level', 1))
+        return output.getvalue()
+
+    def page(self, image_bytes):
+        return NormalizedPage(self, image_bytes)
+
+    def stats(self):
+        return {
+            'images': self.images,
+            'seconds': round(self.seconds, 3),
+            'bytes_in': dict(self.bytes_in),
+            'bytes_out': dict(self.bytes_out),
+        }
+
+
+class NormalizedPage:
+    """
+    The backend payloads of one page image. The image is normalised on a worker thread the first
+    time each profiled backend needs it, so only the backends a page is actually posted to are
+    encoded, and pages whose backend results are all cached are never decoded.
+    """
+    def __init__(self, normalizer, image_bytes):
+        self.normalizer = normalizer
+        self.image_bytes = image_bytes
+        self.variants = {}
+
+    async def payload(self, backend):
+        """Return the (contents, scale) to post to a backend; scale is None when coordinates need no mapping."""
+        if backend not in self.normalizer.profiles:
+            return self.image_bytes, None
+        if backend not in self.variants:
+            self.variants[backend] = asyncio.ensure_future(asyncio.to_thread(self.normalizer.normalize, self.image_bytes, backend))
+        return await self.variants[backend]
@@ -0,0 +1,289 @@
+import asyncio
+from contextlib import aclosing
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+import uuid
+
+import httpx
+
+from utils.metrics import REQUESTS_IN_FLIGHT
+
+def url_origin(url):
+    """scheme://host[:port] of a URL, lowercased, or None when it is not an absolute http(s) URL."""
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+        return None
+    return f"{parts.scheme.lower()}://{parts.hostname.lower()}" + (f":{port}" if port is not None else "")
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+
+
+class StoredUpload:
+    """A file of a queued job, read from the database only when the pipeline gets to it."""
+    def __init__(self, queue, job_id, idx, filename, size):
+        self.queue = queue
+        self.job_id = job_id
+        self.idx = idx
+        self.filename = filename
+        self.size = size
+
+    async def read(self):
+        rows = await asyncio.to_thread(
+            self.queue._execute, "SELECT contents FROM job_files WHERE job_id = ? AND idx = ?", (self.job_id, self.idx))
+        return rows[0][0]
+
+
+class JobQueue:
+    """
+    Durable queue of /predict batches, stored in SQLite and processed by a pool of background workers.
+
+    Submitting a job stores the uploaded files with it and returns immediately. Workers run the
+    files through the regular InvoicePipeline and record each file result as soon as it completes,
+    so partial results are visible while the job runs. Jobs interrupted by a restart are picked up
+    again on startup and only their unfinished files are processed. Once a job completes its file
+    contents are dropped, an optional callback URL receives the final job status, and the job is
+    deleted after retention_seconds. Each database file is meant to be owned by a single gateway process.
+
+    Deferred jobs (the field extraction of degraded requests) are left queued while hold_deferred()
+    is true, so they do not add to the load of overloaded backends; other jobs are claimed ahead of
+    them meanwhile. They then run through the pipeline like any job: pages whose detections the
+    degraded request stored in the result cache do not go through object detection again.
+
+    Parameters:
+    - path: SQLite database file; its directory is created if needed.
+    - pipeline: The InvoicePipeline used to process the files.
+    - workers: Number of jobs processed at the same time.
+    - retention_seconds: How long finished jobs can still be queried.
+    - callback_timeout: Timeout (seconds) of the completion callback.
+    - hold_deferred: Optional callable telling whether deferred jobs must wait, checked each time a
+      worker looks for a job.
+    - callback_allowed_hosts: Origins (scheme://host[:port]) callback URLs may point to; none
+      allowed by default. Callbacks do not follow redirects.
+    """
+    def __init__(self, path, pipeline, workers=2, retention_seconds=86400, callback_timeout=10.0, hold_deferred=None,
+                 callback_allowed_hosts=()):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.pipeline = pipeline
+        self.workers = workers
+        self.retention_seconds = retention_seconds
+        self.callback_timeout = callback_timeout
+        self.hold_deferred = hold_deferred
+        self.callback_origins = {url_origin(host) for host in callback_allowed_hosts} - {None}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, "
+            "callback_url TEXT, total_files INTEGER NOT NULL, deferred INTEGER NOT NULL DEFAULT 0)"
+        )
+        if 'deferred' not in {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN deferred INTEGER NOT NULL DEFAULT 0")  # Databases of older versions
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_files ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, file_id TEXT NOT NULL, filename TEXT NOT NULL, "
+            "contents BLOB, result TEXT, error TEXT, PRIMARY KEY (job_id, idx))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self.wakeup = None
+        self.tasks = []
+        self.callback_client = None
+
+    def _execute(self, query, params=()):
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def start(self):
+        """Requeue jobs interrupted by a restart and start the workers."""
+        with self.lock:
+            requeued = self.conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING)).rowcount
+        if requeued:
+            logging.info(f"Requeued {requeued} interrupted jobs")
+        self._purge()
+        self.wakeup = asyncio.Event()
+        self.callback_client = httpx.AsyncClient(timeout=self.callback_timeout, follow_redirects=False)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.callback_client is not None:
+            await self.callback_client.aclose()
+
+    def _insert(self, job_id, file_ids, uploads, callback_url, deferred):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute(
+                    "INSERT INTO jobs (id, status, created, updated, callback_url, total_files, deferred) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, QUEUED, now, now, callback_url, len(uploads), int(deferred)),
+                )
+                self.conn.executemany(
+                    "INSERT INTO job_files (job_id, idx, file_id, filename, contents) VALUES (?, ?, ?, ?, ?)",
+                    # Files are read one at a time as they are inserted
+                    ((job_id, idx, f_id, upload.filename, upload.read_bytes()) for idx, (f_id, upload) in enumerate(zip(file_ids, uploads))),
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def callback_allowed(self, callback_url):
+        """Whether completion callbacks may be POSTed to callback_url: an http(s) URL on an allowed origin."""
+        return url_origin(callback_url) in self.callback_origins
+
+    async def submit(self, file_ids, uploads, callback_url=None, deferred=False):
+        """
+        Queue a batch of uploads (SpooledUpload or BufferedUpload) and return the job id.
+        The job is durable once this returns. A deferred job waits while hold_deferred() is true.
+        """
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self._insert, job_id, file_ids, uploads, callback_url, deferred)
+        self.wakeup.set()
+        return job_id
+
+    def _status(self, job_id):
+        jobs = self._execute("SELECT status, created, updated, total_files, deferred FROM jobs WHERE id = ?", (job_id,))
+        if not jobs:
+            return None
+        status, created, updated, total_files, deferred = jobs[0]
+        rows = self._execute(
+            "SELECT idx, file_id, result, error FROM job_files WHERE job_id = ? AND (result IS NOT NULL OR error IS NOT NULL) ORDER BY idx",
+            (job_id,),
+        )
+        results = [{'index': idx, **json.loads(result)} for idx, _, result, _ in rows if result is not None]
+        errors = [{'index': idx, 'id': f_id, 'detail': error} for idx, f_id, _, error in rows if error is not None]
+        return {
+            'job_id': job_id,
+            'status': status,
+            'deferred': bool(deferred),
+            'created': created,
+            'updated': updated,
+            'total_files': total_files,
+            'completed_files': len(rows),
+            'results': results,
+            'errors': errors,
+        }
+
+    async def get(self, job_id):
+        """Status and partial results of a job, or None if it does not exist (or has expired)."""
+        return await asyncio.to_thread(self._status, job_id)
+
+    def _claim(self, hold_deferred=False):
+        """
+        Move the oldest queued job (deferred ones excluded with hold_deferred) to running; the update
+        only succeeds while the job is still queued.
+        """
+        query = "SELECT id FROM jobs WHERE status = ?" + (" AND deferred = 0" if hold_deferred else "") + " ORDER BY created LIMIT 1"
+        with self.lock:
+            while True:
+                row = self.conn.execute(query, (QUEUED,)).fetchone()
+                if row is None:
+                    return None
+                claimed = self.conn.execute(
+                    "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?", (RUNNING, time.time(), row[0], QUEUED)
+                ).rowcount
+                if claimed:
+                    return row[0]
+
+    def _pending_files(self, job_id):
+        return self._execute(
+            "SELECT idx, file_id, filename, length(contents) FROM job_files WHERE job_id = ? AND result IS NULL AND error IS NULL ORDER BY idx",
+            (job_id,),
+        )
+
+    def _record(self, job_id, idx, result=None, error=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE job_files SET result = ?, error = ? WHERE job_id = ? AND idx = ?",
+                (json.dumps(result) if result is not None else None, error, job_id, idx),
+            )
+            self.conn.execute("UPDATE jobs SET updated = ? WHERE id = ?", (time.time(), job_id))
+
+    def _complete(self, job_id):
+        with self.lock:
+            self.conn.execute("UPDATE job_files SET contents = NULL WHERE job_id = ?", (job_id,))
+            self.conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (COMPLETED, time.time(), job_id))
+            row = self.conn.execute("SELECT callback_url FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def _purge(self):
+        expired = time.time() - self.retention_seconds
+        with self.lock:
+            self.conn.execute("DELETE FROM job_files WHERE job_id IN (SELECT id FROM jobs WHERE status = ? AND updated < ?)", (COMPLETED, expired))
+            self.conn.execute("DELETE FROM jobs WHERE status = ? AND updated < ?", (COMPLETED, expired))
+
+    async def _worker(self):
+        while True:
+            hold_deferred = self.hold_deferred is not None and self.hold_deferred()
+            job_id = await asyncio.to_thread(self._claim, hold_deferred)
+            if job_id is None:
+                self.wakeup.clear()
+                try:
+                    # Also polls for jobs queued by other processes, and for deferred jobs once they may run
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1.0 if hold_deferred else 5.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                with REQUESTS_IN_FLIGHT.labels(endpoint='/jobs').track_inprogress():
+                    await self._run(job_id)
+            except asyncio.CancelledError:
+                raise  # Left running; requeued at the next startup
+            except Exception:
+                logging.exception(f"Job {job_id} failed")
+                await asyncio.to_thread(self._fail_pending, job_id)
+            callback_url = await asyncio.to_thread(self._complete, job_id)
+            if callback_url:
+                await self._callback(job_id, callback_url)
+            await asyncio.to_thread(self._purge)
+
+    def _fail_pending(self, job_id):
+        for idx, _, _, _ in self._pending_files(job_id):
+            self._record(job_id, idx, error='Job failed')
+
+    async def _run(self, job_id):
+        pending = await asyncio.to_thread(self._pending_files, job_id)
+        indexes = [idx for idx, _, _, _ in pending]
+        file_ids = [f_id for _, f_id, _, _ in pending]
+        uploads = [StoredUpload(self, job_id, idx, filename, size) for idx, _, filename, size in pending]
+        logging.info(f"Processing job {job_id}: {len(pending)} files")
+        # Jobs are not interactive, so they are not held to the request deadline
+        async with aclosing(self.pipeline.iter_files(file_ids, uploads, apply_deadline=False)) as results:
+            async for position, result, error in results:
+                if error is not None:
+                    logging.error(f"Job {job_id}: failed to process file {file_ids[position]}: {error!r}")
+                    await asyncio.to_thread(self._record, job_id, indexes[position], error=str(error))
+                else:
+                    await asyncio.to_thread(self._record, job_id, indexes[position], result=result)
+
+    async def _callback(self, job_id, callback_url):
+        if not self.callback_allowed(callback_url):  # Queued before the allowlist changed
+            logging.error(f"Completion callback for job {job_id} to {callback_url} skipped: host not allowed")
+            return
+        try:
+            response = await self.callback_client.post(callback_url, json=await self.get(job_id))
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logging.error(f"Completion callback for job {job_id} to {callback_url} failed: {e!r}")
+
+    def stats(self):
+        rows = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
@@ -0,0 +1,71 @@
+import contextvars
+import math
+import time
+from collections import deque
+
+
+def percentiles(samples, qs):
+    """Nearest-rank percentiles (0-100) of a non-empty sequence."""
+    ordered = sorted(samples)
+    return [ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))] for q in qs]
+
+
+# Deadline of the request being processed, inherited by the tasks it creates
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class LatencyTracker:
+    """
+    Sliding window of the most recent latencies of a backend, used to pick hedging delays.
+
+    Parameters:
+    - window: Number of recent latencies kept.
+    - min_samples: Percentiles are only reported once this many latencies were recorded.
+    """
+    def __init__(self, window=512, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.times = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.times.append(time.monotonic())
+
+    def percentile(self, q):
+        """The q-th percentile (0-100) of the recent latencies, or None without enough samples."""
+        if len(self.samples) < self.min_samples:
+            return None
+        return percentiles(self.samples, [q])[0]
+
+    def recent_percentile(self, q, max_age):
+        """The q-th percentile of the latencies recorded in the last max_age seconds, or None without enough of them."""
+        since = time.monotonic() - max_age
+        recent = [seconds for seconds, recorded in zip(self.samples, self.times) if recorded >= since]
+        if len(recent) < self.min_samples:
+            return None
+        return percentiles(recent, [q])[0]
+
+    def stats(self):
+        if not self.samples:
+            return {'samples': 0}
+        p50, p95, p99 = percentiles(self.samples, [50, 95, 99])
+        return {'samples': len(self.samples), 'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4)}
+
+
+class Deadline:
+    """
+    Overall time budget of a request, shared by all of its stages.
+
+    Parameters:
+    - seconds: Budget, from the moment the deadline is created.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def stage_timeout(self, share):
+        """Time a stage may use: its share of the whole budget, but never past the deadline."""
+        return min(self.seconds * share, self.remaining())
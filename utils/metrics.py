@@ -0,0 +1,145 @@
+from contextvars import ContextVar
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+
+from utils.tracing import record_span
+
+UNKNOWN = 'unknown'
+
+# Upper bounds (seconds) suited to the gateway: from sub-millisecond checks to slow backend calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PAGE_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+STAGE_SECONDS = Histogram(
+    'gateway_stage_seconds',
+    'Duration of the gateway processing stages: upload_read, pdf_render, blank_check, png_encode, '
+    'image_normalize, classifier_preprocess, classifier_inference and page (a whole page).',
+    ['stage', 'doc_type'],
+    buckets=LATENCY_BUCKETS,
+)
+BACKEND_SECONDS = Histogram(
+    'gateway_backend_request_seconds',
+    'Duration of the TorchServe calls, retries and hedged duplicates included.',
+    ['backend', 'doc_type'],
+    buckets=LATENCY_BUCKETS,
+)
+BACKEND_BYTES = Counter(
+    'gateway_backend_bytes_sent',
+    'Image bytes posted to each TorchServe backend.',
+    ['backend', 'doc_type'],
+)
+ERRORS = Counter(
+    'gateway_errors',
+    'Failed stages: backend calls that failed or ran out of budget, and files that could not be processed.',
+    ['stage', 'doc_type'],
+)
+PAGES = Counter(
+    'gateway_pages',
+    'Pages processed.',
+    ['doc_type'],
+)
+DOCUMENT_PAGES = Histogram(
+    'gateway_document_pages',
+    'Pages per processed document.',
+    ['file_kind', 'doc_type'],
+    buckets=PAGE_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'gateway_requests_in_flight',
+    'Requests being processed, per endpoint.',
+    ['endpoint'],
+    multiprocess_mode='livesum',
+)
+PAGES_IN_FLIGHT = Gauge(
+    'gateway_pages_in_flight',
+    'Pages being processed.',
+    multiprocess_mode='livesum',
+)
+ADMISSION_REJECTIONS = Counter(
+    'gateway_admission_rejections',
+    'Requests turned away by admission control: rate_limited (429), queue_full and queue_timeout (503).',
+    ['reason'],
+)
+DEGRADED_REQUESTS = Counter(
+    'gateway_degraded_requests',
+    'Degradable requests answered with object detection only while the LayoutLMv3 backends were overloaded.',
+    ['endpoint', 'mode'],
+)
+
+# PageMetrics of the page being processed, whose stages are labelled with its document type
+current_page_metrics = ContextVar('current_page_metrics', default=None)
+
+
+def observe_stage(stage, seconds):
+    """
+    Record the duration of a stage, and a span of the current request when it is traced.
+    A stage of a page being processed is labelled with the page's document type once it is known;
+    other stages (upload_read and the PDF rendering ones) are labelled unknown.
+    """
+    page_metrics = current_page_metrics.get()
+    if page_metrics is None:
+        STAGE_SECONDS.labels(stage=stage, doc_type=UNKNOWN).observe(seconds)
+    else:
+        page_metrics.stage(stage, seconds)
+    record_span(stage, seconds)
+
+
+def document_type(page_types):
+    """Document type of a file from the types of its pages: handwritten, machinewritten, mixed or unknown."""
+    known = {page_type for page_type in page_types if page_type != UNKNOWN}
+    if len(known) > 1:
+        return 'mixed'
+    return known.pop() if known else UNKNOWN
+
+
+class PageMetrics:
+    """
+    Observations made while a page is processed, recorded once the classifier has told whether the
+    page is handwritten or machinewritten. Object detection runs in parallel with the classifier,
+    so its metrics are only labelled with the document type when the page completes.
+    The stage durations observed while the page is the current_page_metrics are held back the same way.
+    timed_out lists the stages ('od', 'classifier', 'lmv3') that ran out of budget on the page.
+    """
+    def __init__(self):
+        self.doc_type = UNKNOWN
+        self.pending = []
+        self.stages = []
+        self.flushed = False
+        self.timed_out = []
+
+    def backend_call(self, backend, seconds, bytes_sent, failed):
+        self.pending.append((backend, seconds, bytes_sent, failed))
+
+    def stage(self, stage, seconds):
+        if self.flushed:  # A straggler, e.g. a normalisation still running when the page failed
+            STAGE_SECONDS.labels(stage=stage, doc_type=self.doc_type).observe(seconds)
+        else:
+            self.stages.append((stage, seconds))
+
+    def flush(self):
+        self.flushed = True
+        for stage, seconds in self.stages:
+            STAGE_SECONDS.labels(stage=stage, doc_type=self.doc_type).observe(seconds)
+        self.stages = []
+        for backend, seconds, bytes_sent, failed in self.pending:
+            BACKEND_SECONDS.labels(backend=backend, doc_type=self.doc_type).observe(seconds)
+            BACKEND_BYTES.labels(backend=backend, doc_type=self.doc_type).inc(bytes_sent)
+            if failed:
+                ERRORS.labels(stage=backend, doc_type=self.doc_type).inc()
+        self.pending = []
+        PAGES.labels(doc_type=self.doc_type).inc()
+
+
+def latest_metrics():
+    """
+    Metrics in the Prometheus text format, with their content type.
+    When PROMETHEUS_MULTIPROC_DIR is set (several gateway worker processes), the metrics of every
+    worker are aggregated.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,480 @@
+import asyncio
+from contextlib import aclosing
+import copy
+import logging
+import time
+
+from utils.batching import MicroBatcher
+from utils.budget import CountingBudget
+from utils.degradation import fields_skipped
+from utils.image_normalize import ImageNormalizer
+from utils.latency import Deadline, request_deadline
+from utils.metrics import (DOCUMENT_PAGES, ERRORS, PAGES_IN_FLIGHT, UNKNOWN, PageMetrics, current_page_metrics, document_type,
+                           observe_stage)
+from utils.postprocessing import CLASSES, process_detections, aggregate_results
+from utils.pdf_to_png import PAGE_ORDERS, pdf_page_count, stream_pdf_pages
+from utils.presence import PresenceTracker, presence_only
+from utils.singleflight import SingleFlight, content_hash
+from utils.tracing import bind_observer, record_span, scoped
+
+IMAGE_EXTENSIONS = ['png', 'jpeg', 'jpg']
+
+
+def extract_unique_fields(labels):
+    """
+    Strip the IOB prefixes from LayoutLMv3 token labels and return the distinct field names.
+    The 'O' (outside) label is dropped.
+    """
+    return sorted({label[2:] if label.startswith(('B-', 'I-')) else label for label in labels if label != 'O'})
+
+
+async def skipped(value):
+    """Result of a stage a page does not go through."""
+    return value
+
+
+class InvoicePipeline:
+    """
+    Runs object detection, document classification and field extraction on uploaded invoices.
+
+    In concurrent mode, object detection and the classify -> LayoutLMv3 branch of a page run in
+    parallel, and the pages and files of a request are fanned out concurrently. The number of pages
+    in flight is capped per request and globally across all requests of the process.
+    Results are always returned in input order.
+
+    Backend calls go through the process-wide BackendClients ('retinanet', 'LMv3_machine', 'LMv3_hand').
+    PDF pages are rendered on a separate thread while earlier pages are being inferred; at most
+    pdf_render_buffer_pages rendered pages wait for a slot, and at most max_concurrent_pages_per_request
+    pages of a document are in flight, so memory stays bounded for long documents.
+
+    With single_flight enabled, byte-identical files that are in flight at the same time (retries,
+    duplicate uploads, duplicates within one request) share a single computation.
+
+    With a ResultCache, the output of each stage (detections, classification, LayoutLMv3 labels) is
+    looked up by page hash and model identifier before calling the classifier or the backend.
+    model_ids maps 'retinanet', 'classifier', 'LMv3_machine' and 'LMv3_hand' to those identifiers.
+
+    Uploaded files are only read into memory once their size fits both the request's memory budget
+    (max_request_memory_bytes) and the process-wide one (max_upload_memory_bytes); until then they
+    stay in their spooled temporary files. A file is released from the budgets once it is processed.
+
+    With an ImageNormalizer, page images are downscaled and re-encoded per backend before being
+    posted, and RetinaNet boxes are mapped back to the original image. The classifier always gets
+    the original image.
+
+    With request_deadline (seconds), every request gets an overall deadline. Each call of a stage
+    ('od', 'classifier', 'lmv3') is cut off after its share of the deadline (stage_budgets) or when
+    the deadline passes, whichever comes first. A call cut off this way is treated like a failed
+    backend call: the page gets no detections or no fields, and nothing is cached. The stages cut
+    off are listed in the 'timed_out' entry of the page and file results, so that a page whose
+    stage ran out of time is not mistaken for one without detections or fields.
+
+    Requests processed without field extraction (extract_fields=False, under degradation) only run
+    object detection; their pages get no fields and no document type.
+
+    In presence-only mode (presence_only=True), the pages of a PDF are rendered in presence_page_order
+    and a page skips object detection once every class has been detected on earlier pages, and
+    field extraction once every field of presence_target_fields has been seen; rendering stops when
+    nothing is left to find. The detections of the skipped pages are missing from the results.
+    At most presence_max_pages_in_flight pages of such a PDF are in flight, so that each page is
+    dispatched knowing what the pages before it found: with 1, no page is analysed needlessly.
+
+    With detection_batch_size greater than 1, the pages sent to RetinaNet by all in-flight requests
+    (the pages of a PDF as well as concurrent single images) are grouped into multi-image calls of up
+    to that many pages: one POST carries the images as the multipart parts image_0 ... image_<n-1>
+    and the handler returns the list of their detections, in order. At most detection_concurrent_batches
+    calls are in flight at once. A page is posted at once while a call slot is free; pages arriving
+    while every slot is busy are grouped, and wait at most detection_batch_wait seconds more once a
+    slot frees up.
+    """
+    def __init__(self, classifier, backends, concurrent=True, max_concurrent_pages=32, max_concurrent_pages_per_request=8,
+                 single_flight=True, cache=None, model_ids=None, pdf_render_buffer_pages=2,
+                 max_request_memory_bytes=64 * 1024 * 1024, max_upload_memory_bytes=256 * 1024 * 1024, normalizer=None,
+                 request_deadline=None, stage_budgets=None, presence_target_fields=None, presence_page_order='natural',
+                 presence_max_pages_in_flight=1, detection_batch_size=1, detection_batch_wait=0.005, detection_concurrent_batches=4):
+        self.classifier = classifier
+        self.backends = backends
+        self.single_flight = SingleFlight() if single_flight else None
+        self.cache = cache
+        self.model_ids = model_ids or {}
+        self.pdf_render_buffer_pages = pdf_render_buffer_pages
+        self.concurrent = concurrent
+        self.max_concurrent_pages_per_request = max_concurrent_pages_per_request if concurrent else 1
+        self.global_semaphore = asyncio.Semaphore(max_concurrent_pages if concurrent else 1)
+        self.max_request_memory_bytes = max_request_memory_bytes
+        self.upload_budget = CountingBudget(max_upload_memory_bytes)
+        self.normalizer = normalizer or ImageNormalizer({})
+        self.request_deadline = request_deadline
+        self.stage_budgets = stage_budgets or {}
+        if presence_page_order not in PAGE_ORDERS:
+            raise ValueError(f"Unknown page order: {presence_page_order}")
+        self.presence_target_fields = presence_target_fields
+        self.presence_page_order = presence_page_order
+        self.presence_max_pages_in_flight = presence_max_pages_in_flight
+        self.detection_batcher = None
+        if detection_batch_size > 1:
+            self.detection_batcher = MicroBatcher(self.post_detection_batch, max_batch_size=detection_batch_size,
+                                                  max_wait=detection_batch_wait,
+                                                  max_concurrent_batches=detection_concurrent_batches)
+
+    def new_deadline(self, apply_deadline):
+        return Deadline(self.request_deadline) if apply_deadline and self.request_deadline else None
+
+    async def within_request(self, deadline, extract_fields, presence, coroutine):
+        """
+        Run a coroutine with the request deadline its stages are held to, with or without field
+        extraction, and in presence-only mode or not.
+        """
+        deadline_token = request_deadline.set(deadline)
+        fields_token = fields_skipped.set(not extract_fields)
+        presence_token = presence_only.set(presence)
+        try:
+            return await coroutine
+        finally:
+            presence_only.reset(presence_token)
+            fields_skipped.reset(fields_token)
+            request_deadline.reset(deadline_token)
+
+    async def within_budget(self, stage, awaitable):
+        """Await a stage call, cut off at the stage's share of the request deadline (asyncio.TimeoutError)."""
+        deadline = request_deadline.get()
+        if deadline is None or stage not in self.stage_budgets:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, deadline.stage_timeout(self.stage_budgets[stage]))
+
+    async def count_pages(self, files):
+        """
+        Pages the uploaded files will put through the pipeline, for admission control: one per image
+        and the page count of each PDF, blank pages included. PDFs are read under the process-wide
+        memory budget and rewound for the pipeline.
+        """
+        pages = 0
+        for file in files:
+            if file.filename.split('.')[-1].lower() != 'pdf':
+                pages += 1
+                continue
+            async with self.upload_budget.reserve(file.size or 0):
+                contents = await file.read()
+                await file.seek(0)
+                pages += await asyncio.to_thread(pdf_page_count, contents)
+        return pages
+
+    async def process_files(self, file_ids, files, apply_deadline=True, extract_fields=True, presence=False):
+        """
+        Process every uploaded file and return one result per file, in input order.
+
+        Parameters:
+        - file_ids: Client supplied ids, one per file.
+        - files: The uploaded files (UploadFile).
+        - apply_deadline: Hold the stages to the request deadline, if one is configured.
+        - extract_fields: Run the classifier -> LayoutLMv3 branch; without it, results only have detections.
+        - presence: Presence-only mode, PDF pages stop being analysed once everything sought was found.
+        """
+        request_semaphore = asyncio.Semaphore(self.max_concurrent_pages_per_request)
+        request_budget = CountingBudget(self.max_request_memory_bytes)
+        deadline = self.new_deadline(apply_deadline)
+        if not self.concurrent:
+            return [
+                await self.within_request(deadline, extract_fields, presence, self.process_file(f_id, file, request_semaphore, request_budget))
+                for f_id, file in zip(file_ids, files)
+            ]
+        return list(await asyncio.gather(*[
+            self.within_request(deadline, extract_fields, presence, self.process_file(f_id, file, request_semaphore, request_budget))
+            for f_id, file in zip(file_ids, files)
+        ]))
+
+    async def iter_files(self, file_ids, files, on_page=None, apply_deadline=True, extract_fields=True, presence=False):
+        """
+        Process every uploaded file and yield (index, result, error) as soon as each file completes,
+        in completion order. Exactly one of result and error is set.
+
+        Parameters:
+        - file_ids: Client supplied ids, one per file.
+        - files: The uploaded files (UploadFile).
+        - on_page: Optional callback on_page(file_id, page_number, page_result), called as each page completes.
+        - apply_deadline: Hold the stages to the request deadline, if one is configured.
+        - extract_fields: Run the classifier -> LayoutLMv3 branch; without it, results only have detections.
+        - presence: Presence-only mode, PDF pages stop being analysed once everything sought was found.
+        """
+        request_semaphore = asyncio.Semaphore(self.max_concurrent_pages_per_request)
+        request_budget = CountingBudget(self.max_request_memory_bytes)
+        deadline = self.new_deadline(apply_deadline)
+        if not self.concurrent:
+            for index, (f_id, file) in enumerate(zip(file_ids, files)):
+                try:
+                    result = await self.within_request(deadline, extract_fields, presence, self.process_file(f_id, file, request_semaphore, request_budget, on_page))
+                    yield index, result, None
+                except Exception as e:
+                    yield index, None, e
+            return
+
+        tasks = {
+            asyncio.create_task(self.within_request(deadline, extract_fields, presence, self.process_file(f_id, file, request_semaphore, request_budget, on_page))): index
+            for index, (f_id, file) in enumerate(zip(file_ids, files))
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.get):
+                    if task.exception() is not None:
+                        yield tasks[task], None, task.exception()
+                    else:
+                        yield tasks[task], task.result(), None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def process_file(self, f_id, file, request_semaphore, request_budget, on_page=None):
+        # The request budget is taken first, so a request only competes for the global one with files it can hold
+        size = file.size or 0
+        with scoped(file=f_id):
+            async with request_budget.reserve(size), self.upload_budget.reserve(size):
+                start = time.perf_counter()
+                file_contents = await file.read()
+                observe_stage('upload_read', time.perf_counter() - start)
+                try:
+                    return await self.process_file_contents(f_id, file.filename, file_contents, request_semaphore, on_page)
+                except Exception:
+                    ERRORS.labels(stage='file', doc_type=UNKNOWN).inc()
+                    raise
+
+    async def process_file_contents(self, f_id, filename, file_contents, request_semaphore, on_page=None):
+        file_extension = filename.split('.')[-1].lower()
+        file_on_page = (lambda page_number, page_result: on_page(f_id, page_number, page_result)) if on_page else None
+
+        if self.single_flight is None:
+            analysis = await self.analyse_file(file_contents, file_extension, request_semaphore, file_on_page)
+        else:
+            # Only the caller that starts a shared computation receives its page callbacks; computations
+            # without field extraction or in presence-only mode are not shared with complete ones
+            file_kind = 'image' if file_extension in IMAGE_EXTENSIONS else file_extension
+            key = (file_kind, await asyncio.to_thread(content_hash, file_contents), fields_skipped.get(), presence_only.get())
+            analysis = copy.deepcopy(await self.single_flight.do(
+                key, self.analyse_file, file_contents, file_extension, request_semaphore, file_on_page))
+        return {'id': f_id, **analysis}
+
+    async def analyse_file(self, file_contents, file_extension, request_semaphore, on_page=None):
+        """
+        Compute the detections and field predictions of one file, independently of its file_id.
+        """
+        file_result = {'detected_classes': {}, 'field_predictions': [], 'timed_out': []}
+        page_results = []
+        if file_extension in IMAGE_EXTENSIONS:
+            page_result = await self.process_numbered_page(1, file_contents, request_semaphore, on_page)
+            file_result['detected_classes'] = page_result['detected_classes']
+            file_result['field_predictions'].extend(page_result['unique_fields'])
+            file_result['timed_out'] = page_result['timed_out']
+            page_results = [page_result]
+
+        elif file_extension == 'pdf':
+            presence = PresenceTracker(self.presence_classes(), self.presence_target_fields) if presence_only.get() else None
+            page_results = await self.process_pdf(file_contents, request_semaphore, on_page, presence)
+            aggregate_results(file_result, page_results)
+            if presence is not None:
+                file_result['pages_analysed'] = presence.analysed
+
+        DOCUMENT_PAGES.labels(
+            file_kind='image' if file_extension in IMAGE_EXTENSIONS else 'pdf' if file_extension == 'pdf' else 'other',
+            doc_type=document_type(page_result['doc_type'] for page_result in page_results),
+        ).observe(len(page_results))
+        return file_result
+
+    @staticmethod
+    def presence_classes():
+        return [class_name for class_name in CLASSES if class_name != '__background__']
+
+    async def process_pdf(self, pdf_bytes, request_semaphore, on_page=None, presence=None):
+        """
+        Stream the pages of a PDF into the page pipeline as they are rendered.
+        Pages are rendered and PNG-encoded in memory, never written to disk. Returns the page results
+        in the order the pages were rendered: page order, unless a PresenceTracker is given, in which
+        case rendering follows presence_page_order and stops once the tracker is done.
+        """
+        # Pages are rendered on another thread, where the trace of the request is not visible
+        observe = bind_observer(observe_stage)
+        order = self.presence_page_order if presence is not None else 'natural'
+        extract_fields = not fields_skipped.get()
+        page_results = []
+        # Pages wait for a slot in this window before the next one is pulled from the renderer. In presence-only
+        # mode, a page waits for the results of the pages before it, which decide whether it still needs analysing
+        window = asyncio.Semaphore(self.max_concurrent_pages_per_request if presence is None
+                                   else min(self.presence_max_pages_in_flight, self.max_concurrent_pages_per_request))
+        tasks = []
+        try:
+            async with aclosing(stream_pdf_pages(pdf_bytes, self.pdf_render_buffer_pages, observe, order)) as pages:
+                async for page_number, image_contents in pages:
+                    if self.concurrent:
+                        await window.acquire()
+                    if presence is not None and presence.done(extract_fields):
+                        break
+                    if not self.concurrent:
+                        page_results.append(await self.process_numbered_page(page_number, image_contents, request_semaphore, on_page, presence))
+                        continue
+                    task = asyncio.create_task(self.process_numbered_page(page_number, image_contents, request_semaphore, on_page, presence))
+                    task.add_done_callback(lambda _: window.release())
+                    tasks.append(task)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return page_results + list(await asyncio.gather(*tasks))
+
+    async def process_numbered_page(self, page_number, image_contents, request_semaphore, on_page=None, presence=None):
+        with scoped(page=page_number):
+            page_result = await self.process_page(image_contents, request_semaphore, presence)
+        if on_page is not None:
+            on_page(page_number, page_result)
+        return page_result
+
+    async def process_page(self, image_contents, request_semaphore, presence=None):
+        """
+        Run object detection and field extraction on a single page image, or only the stages still
+        needed by the PresenceTracker of its document.
+        Returns a dict with 'detected_classes', 'unique_fields', the page's 'doc_type' and the stages
+        that ran out of budget, 'timed_out'.
+        """
+        async with request_semaphore, self.global_semaphore:
+            metrics = PageMetrics()
+            metrics_token = current_page_metrics.set(metrics)
+            start = time.perf_counter()
+            try:
+                with PAGES_IN_FLIGHT.track_inprogress():
+                    page_hash = await asyncio.to_thread(content_hash, image_contents) if self.cache is not None else None
+                    page = self.normalizer.page(image_contents)
+                    run_detection = presence is None or presence.needs_detection()
+                    run_fields = not fields_skipped.get() and (presence is None or presence.needs_fields())
+                    if self.concurrent:
+                        detected_classes, unique_fields = await asyncio.gather(
+                            self.detect_objects(page, page_hash, metrics) if run_detection else skipped({}),
+                            self.extract_fields(page, page_hash, metrics) if run_fields else skipped([]),
+                        )
+                    else:
+                        detected_classes = await self.detect_objects(page, page_hash, metrics) if run_detection else {}
+                        unique_fields = await self.extract_fields(page, page_hash, metrics) if run_fields else []
+                    if presence is not None:
+                        presence.update(detected_classes, unique_fields, run_detection, run_fields)
+            finally:
+                observe_stage('page', time.perf_counter() - start)
+                metrics.flush()
+                current_page_metrics.reset(metrics_token)
+        return {'detected_classes': detected_classes, 'unique_fields': unique_fields, 'doc_type': metrics.doc_type,
+                'timed_out': sorted(metrics.timed_out)}
+
+    async def cached(self, stage, model, page_hash, compute):
+        """
+        Return the cached result of a stage, or compute and store it.
+        compute returns a (value, cacheable) pair; failed backend calls are not cached.
+        """
+        if self.cache is not None:
+            value = await self.cache.aget(stage, self.model_ids.get(model, model), page_hash)
+            if value is not None:
+                return value
+        value, cacheable = await compute()
+        if self.cache is not None and cacheable:
+            await self.cache.aput(stage, self.model_ids.get(model, model), page_hash, value)
+        return value
+
+    async def post_page(self, stage, backend, image_contents, metrics):
+        """POST a page image to a backend within the stage's budget, recording the call in the page metrics."""
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = await self.within_budget(stage, self.backends.post(backend, files={'data': ('filename', image_contents)}))
+            failed = response.status_code != 200
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.backend_call(backend, elapsed, len(image_contents), failed)
+            record_span(f'backend.{backend}', elapsed)
+
+    async def post_detection_batch(self, images):
+        """
+        POST page images to RetinaNet in one multi-image call. Returns the detections of each image,
+        in order, or None for an image the call failed for. A single image is posted on its own.
+        """
+        if len(images) == 1:
+            response = await self.backends.post('retinanet', files={'data': ('filename', images[0])})
+            return [response.json() if response.status_code == 200 else None]
+        files = [(f'image_{i}', (f'page_{i}', image_contents)) for i, image_contents in enumerate(images)]
+        response = await self.backends.post('retinanet', files=files)
+        results = response.json() if response.status_code == 200 else None
+        if not isinstance(results, list) or len(results) != len(images):
+            if response.status_code == 200:
+                logging.warning("RetinaNet answered a call of %d images with an unexpected response", len(images))
+            return [None] * len(images)
+        return [None if 'error' in result else result for result in results]
+
+    async def detect_page(self, image_contents, metrics):
+        """
+        Detections of a page image within the object detection budget, through a multi-image call when
+        batching is enabled, or None when the backend call failed.
+        """
+        if self.detection_batcher is None:
+            od_response = await self.post_page('od', 'retinanet', image_contents, metrics)
+            return od_response.json() if od_response.status_code == 200 else None
+        start = time.perf_counter()
+        detections = None
+        try:
+            detections = await self.within_budget('od', self.detection_batcher.submit(image_contents))
+            return detections
+        finally:
+            elapsed = time.perf_counter() - start  # Including the wait for the call to fill
+            metrics.backend_call('retinanet', elapsed, len(image_contents), detections is None)
+            record_span('backend.retinanet', elapsed)
+
+    async def detect_objects(self, page, page_hash, metrics):
+        async def compute():
+            image_contents, scale = await page.payload('retinanet')
+            try:
+                detections = await self.detect_page(image_contents, metrics)
+            except asyncio.TimeoutError:
+                logging.warning("Object detection exceeded its latency budget")
+                metrics.timed_out.append('od')
+                return {}, False
+            if detections is not None:
+                return process_detections(detections, scale)['detected_classes'], True
+            return {}, False
+        return await self.cached('od', 'retinanet', page_hash, compute)
+
+    async def extract_fields(self, page, page_hash, metrics):
+        async def classify():
+            try:
+                return bool(await self.within_budget('classifier', self.classifier.classify_async(page.image_bytes))), True
+            except asyncio.TimeoutError:
+                logging.warning("Classification exceeded its latency budget")
+                ERRORS.labels(stage='classifier', doc_type=UNKNOWN).inc()
+                metrics.timed_out.append('classifier')
+                return None, False
+        is_handwritten = await self.cached('classifier', 'classifier', page_hash, classify)
+        if is_handwritten is None:
+            return []
+        metrics.doc_type = 'handwritten' if is_handwritten else 'machinewritten'
+        backend = 'LMv3_hand' if is_handwritten else 'LMv3_machine'
+
+        async def recognise():
+            image_contents, _ = await page.payload(backend)
+            try:
+                field_response = await self.post_page('lmv3', backend, image_contents, metrics)
+            except asyncio.TimeoutError:
+                logging.warning(f"{backend} exceeded its latency budget")
+                metrics.timed_out.append('lmv3')
+                return [], False
+            if field_response.status_code == 200:
+                return field_response.json(), True  # Directly using the list
+            return [], False
+        labels = await self.cached('lmv3', backend, page_hash, recognise)
+        return extract_unique_fields(labels)
+
+    def stats(self):
+        return {
+            'single_flight': self.single_flight.stats() if self.single_flight is not None else None,
+            'result_cache': self.cache.stats() if self.cache is not None else None,
+            'upload_memory': self.upload_budget.stats(),
+            'normalization': self.normalizer.stats(),
+            'detection_batching': self.detection_batcher.stats() if self.detection_batcher is not None else None,
+        }
+
+    def close(self):
+        if self.detection_batcher is not None:
+            self.detection_batcher.stop()
@@ -9,12 +9,18 @@ threshold = config['threshold']
 COLORS = config['colors']
 CLASSES = config['classes']
 
-def process_torch_serve_response(response):
+def process_torch_serve_response(response, scale=None):
     """
     Processes the JSON response from TorchServe and organizes detections by class.
+    scale is the (x, y) factor mapping boxes of a downscaled image back to the original image.
     """
-    detection_results = response.json()
+    return process_detections(response.json(), scale)
 
+def process_detections(detection_results, scale=None):
+    """
+    Organizes the detections of one image (the handler's 'boxes', 'scores' and 'labels') by class.
+    scale is the (x, y) factor mapping boxes of a downscaled image back to the original image.
+    """
     # Initialize response data structure
     response_data = {
         'detected_classes': {class_name: {'present': False, 'detections': []} for class_name in CLASSES if class_name != '__background__'}
@@ -24,6 +30,8 @@ def process_torch_serve_response(response):
     for box, score, label in zip(detection_results['boxes'], detection_results['scores'], detection_results['labels']):
         class_name = CLASSES[label]
         if score >= threshold:
+            if scale is not None:
+                box = [box[0] * scale[0], box[1] * scale[1], box[2] * scale[0], box[3] * scale[1]]
             response_data['detected_classes'][class_name]['present'] = True
             response_data['detected_classes'][class_name]['detections'].append({
                 'box': box,
@@ -35,14 +43,21 @@ def process_torch_serve_response(response):
 def aggregate_results(file_result, pdf_results):
     """
     Combine results from all pages of a PDF into a single JSON object.
-    Each detection class is considered present if detected on any page.
+    Each detection class is considered present if detected on any page, and the field predictions
+    are the union of the fields found on every page, as are the stages that timed out.
     """
     detected_classes = {class_name: {'present': False, 'detections': []} for class_name in CLASSES if class_name != '__background__'}
+    field_predictions = set(file_result.get('field_predictions', []))
+    timed_out = set(file_result.get('timed_out', []))
     
     for result in pdf_results:
         for class_name, data in result.get('detected_classes', {}).items():
             if data['present']:
                 detected_classes[class_name]['present'] = True
                 detected_classes[class_name]['detections'].extend(data['detections'])
+        field_predictions.update(result.get('unique_fields', []))
+        timed_out.update(result.get('timed_out', []))
 
-    file_result['detected_classes'] = detected_classes
\ No newline at end of file
+    file_result['detected_classes'] = detected_classes
+    file_result['field_predictions'] = sorted(field_predictions)
+    file_result['timed_out'] = sorted(timed_out)
\ No newline at end of file
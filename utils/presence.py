@@ -0,0 +1,42 @@
+import contextvars
+
+# Whether the request being processed only needs to know what its PDFs contain, inherited by the tasks it creates
+presence_only = contextvars.ContextVar('presence_only', default=False)
+
+
+class PresenceTracker:
+    """
+    What has been found so far across the pages of a PDF processed in presence-only mode.
+
+    Once every class has been detected, the remaining pages skip object detection; once every
+    target field has been seen, they skip field extraction. Without target fields, field
+    extraction runs on every page.
+
+    Parameters:
+    - classes: Classes whose presence is sought (e.g. 'stamp', 'signature').
+    - target_fields: Field names (LayoutLMv3 labels without their IOB prefix) whose presence is sought.
+    """
+    def __init__(self, classes, target_fields=None):
+        self.missing_classes = set(classes)
+        self.missing_fields = set(target_fields) if target_fields else None
+        self.analysed = {'od': 0, 'fields': 0}
+
+    def needs_detection(self):
+        return bool(self.missing_classes)
+
+    def needs_fields(self):
+        return self.missing_fields is None or bool(self.missing_fields)
+
+    def done(self, extract_fields=True):
+        """Whether the remaining pages would skip every stage."""
+        return not self.needs_detection() and not (extract_fields and self.needs_fields())
+
+    def update(self, detected_classes, unique_fields, ran_detection, ran_fields):
+        """Record the results of a page and the stages it went through."""
+        if ran_detection:
+            self.analysed['od'] += 1
+            self.missing_classes -= {name for name, data in detected_classes.items() if data['present']}
+        if ran_fields:
+            self.analysed['fields'] += 1
+            if self.missing_fields is not None:
+                self.missing_fields -= set(unique_fields)
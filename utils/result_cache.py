@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+
+class ResultCache:
+    """
+    Persistent, content-addressed cache of per-stage pipeline results, stored in SQLite.
+
+    Entries are keyed by stage, model identifier (name and version) and the SHA-256 of the page
+    image, so results survive restarts and are invalidated simply by bumping a model version.
+    When the stored values exceed max_bytes, the least recently used entries are evicted.
+
+    Parameters:
+    - path: SQLite database file; its directory is created if needed.
+    - max_bytes: Size bound of the stored values.
+    """
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, stage TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(stage, model, page_hash):
+        return f"{stage}:{model}:{page_hash}"
+
+    def get(self, stage, model, page_hash):
+        """Return the cached value, or None on a miss."""
+        key = self.make_key(stage, model, page_hash)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses[stage] += 1
+                return None
+            self.hits[stage] += 1
+            self.conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, stage, model, page_hash, value):
+        key = self.make_key(stage, model, page_hash)
+        data = json.dumps(value)
+        size = len(data)
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, stage, value, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, data, size, time.time()),
+            )
+            self.total_bytes += size - (row[0] if row else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the bound so that eviction does not run on every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 256").fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                keys.append((key,))
+                self.total_bytes -= size
+            self.conn.executemany("DELETE FROM results WHERE key = ?", keys)
+            evicted += len(keys)
+        self.evictions += evicted
+        logging.info(f"Result cache evicted {evicted} entries")
+
+    async def aget(self, stage, model, page_hash):
+        return await asyncio.to_thread(self.get, stage, model, page_hash)
+
+    async def aput(self, stage, model, page_hash, value):
+        await asyncio.to_thread(self.put, stage, model, page_hash, value)
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {
+            'entries': entries,
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,44 @@
+import asyncio
+import hashlib
+
+
+def content_hash(contents):
+    """SHA-256 hex digest of an uploaded file or page image."""
+    return hashlib.sha256(contents).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent computations that share a key.
+
+    The first caller for a key starts the computation; callers arriving while it is still in flight
+    await the same result instead of starting their own. The computation runs as its own task, so a
+    caller that disconnects does not cancel it for the others. Keys are forgotten as soon as the
+    computation finishes, so nothing is cached beyond the in-flight window.
+    """
+    def __init__(self):
+        self.in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, func, *args):
+        """Return the result of func(*args), shared with every concurrent caller using the same key."""
+        self.calls += 1
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            task.add_done_callback(self._consume_exception)
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _consume_exception(task):
+        # Every caller may have gone away; the error is still raised to any caller that awaits it
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {'in_flight': len(self.in_flight), 'calls': self.calls, 'shared': self.shared}
@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import aclosing
+import json
+import logging
+import time
+
+from utils.metrics import REQUESTS_IN_FLIGHT
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+
+def format_record(record, stream_format):
+    """Serialise one record as an NDJSON line or a server-sent event."""
+    data = json.dumps(record)
+    if stream_format == 'sse':
+        return f"event: {record['type']}\ndata: {data}\n\n"
+    return data + '\n'
+
+
+async def stream_predictions(pipeline, file_ids, files, granularity='file', stream_format='ndjson', degradation=None,
+                             presence=False):
+    """
+    Run the pipeline over the uploaded files and yield one record per file (and per page with
+    granularity='page') as soon as it completes, followed by a final summary record.
+
+    degradation, when set, is merged into the file and summary records ({'degraded': ...}, see main),
+    and a degraded request is processed without field extraction. presence selects the presence-only
+    mode of the pipeline.
+
+    Record types:
+    - page: {'type': 'page', 'id', 'page', 'detected_classes', 'field_predictions', 'timed_out'}
+    - file: {'type': 'file', 'index', 'id', 'detected_classes', 'field_predictions', 'timed_out'}
+    - error: {'type': 'error', 'index', 'id', 'detail'}, when a file could not be processed
+    - summary: {'type': 'summary', 'files', 'pages', 'errors', 'elapsed_seconds'}
+    """
+    start = time.perf_counter()
+    records = asyncio.Queue()
+    counts = {'files': 0, 'pages': 0, 'errors': 0}
+    done = object()
+
+    def on_page(f_id, page_number, page_result):
+        counts['pages'] += 1
+        if granularity == 'page':
+            records.put_nowait({
+                'type': 'page',
+                'id': f_id,
+                'page': page_number,
+                'detected_classes': page_result['detected_classes'],
+                'field_predictions': page_result['unique_fields'],
+                'timed_out': page_result['timed_out'],
+            })
+
+    async def run():
+        try:
+            extract_fields = not (degradation and degradation['degraded'])
+            async with aclosing(pipeline.iter_files(file_ids, files, on_page=on_page, extract_fields=extract_fields, presence=presence)) as results:
+                async for index, result, error in results:
+                    if error is not None:
+                        logging.error(f"Failed to process file {file_ids[index]}: {error!r}")
+                        counts['errors'] += 1
+                        records.put_nowait({'type': 'error', 'index': index, 'id': file_ids[index], 'detail': str(error)})
+                    else:
+                        counts['files'] += 1
+                        records.put_nowait({'type': 'file', 'index': index, **result, **(degradation or {})})
+            records.put_nowait({
+                'type': 'summary', **counts, 'elapsed_seconds': round(time.perf_counter() - start, 3), **(degradation or {}),
+            })
+        finally:
+            records.put_nowait(done)
+
+    runner = asyncio.create_task(run())
+    in_flight = REQUESTS_IN_FLIGHT.labels(endpoint='/predict/stream')
+    in_flight.inc()
+    try:
+        while True:
+            record = await records.get()
+            if record is done:
+                break
+            yield format_record(record, stream_format)
+        await runner
+    finally:
+        in_flight.dec()
+        runner.cancel()  # The client went away: stop processing the remaining files
@@ -0,0 +1,92 @@
+import contextvars
+import time
+from collections import defaultdict
+
+# Trace of the request being processed, None when tracing is off
+current_trace = contextvars.ContextVar('current_trace', default=None)
+# File id and page number the current task works on, inherited by the tasks it creates
+trace_scope = contextvars.ContextVar('trace_scope', default={})
+
+TRACE_MODES = ('server-timing', 'full')
+
+
+class Trace:
+    """
+    Spans recorded while one request is processed.
+
+    Each span has a name (a stage such as 'pdf_render' or a backend call such as 'backend.retinanet'),
+    the file id and page number it belongs to, and its start and duration relative to the request.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, start, duration, scope):
+        self.spans.append({
+            'name': name,
+            **scope,
+            'start_ms': round((start - self.start) * 1000, 2),
+            'duration_ms': round(duration * 1000, 2),
+        })
+
+    def file_timings(self, file_id):
+        """The spans of one file, in start order."""
+        return sorted((span for span in self.spans if span.get('file') == file_id), key=lambda span: span['start_ms'])
+
+    def server_timing(self):
+        """
+        Server-Timing header value: the total duration of each span name across all files and pages
+        (their count in the description), followed by the wall time of the whole request.
+        """
+        totals = defaultdict(float)
+        counts = defaultdict(int)
+        for span in self.spans:
+            totals[span['name']] += span['duration_ms']
+            counts[span['name']] += 1
+        entries = [f'{name};dur={totals[name]:.2f};desc="{counts[name]}x"' for name in totals]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ', '.join(entries)
+
+
+def record_span(name, seconds):
+    """Record a span that just ended and lasted seconds, if the current request is traced."""
+    trace = current_trace.get()
+    if trace is not None:
+        now = time.perf_counter()
+        trace.add(name, now - seconds, seconds, trace_scope.get())
+
+
+def bind_observer(observe):
+    """
+    Wrap an observe(stage, seconds) callback that is called from another thread (where context
+    variables are not set), so that it also records spans in the current trace and scope.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return observe
+    scope = trace_scope.get()
+
+    def observe_and_trace(stage, seconds):
+        observe(stage, seconds)
+        now = time.perf_counter()
+        trace.add(stage, now - seconds, seconds, scope)
+    return observe_and_trace
+
+
+class scoped:
+    """Attribute the spans recorded in a block (and in the tasks it creates) to a file or a page."""
+    __slots__ = ('scope', 'token')
+
+    def __init__(self, **scope):
+        self.scope = scope
+        self.token = None
+
+    def __enter__(self):
+        if current_trace.get() is not None:
+            self.token = trace_scope.set({**trace_scope.get(), **self.scope})
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.token is not None:
+            trace_scope.reset(self.token)
+        return False
@@ -0,0 +1,96 @@
+import asyncio
+import tempfile
+
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starlette.requests import Request, parse_options_header
+
+
+class BufferedUpload:
+    """
+    An uploaded file whose content is already in memory, exposing the part of the UploadFile
+    interface used by the pipeline.
+    """
+    def __init__(self, filename, contents):
+        self.filename = filename
+        self.contents = contents
+        self.size = len(contents)
+
+    def read_bytes(self):
+        return self.contents
+
+    async def read(self):
+        return self.contents
+
+    def close(self):
+        self.contents = None
+
+
+class SpooledUpload:
+    """
+    Takes over the spooled temporary file of an UploadFile so that it can be processed after the
+    request's UploadFiles are closed, without reading it into memory first. Large uploads stay on
+    disk until the pipeline reads them. Call close() once the file is no longer needed.
+    """
+    def __init__(self, upload):
+        self.filename = upload.filename
+        self.size = upload.size
+        self.file = upload.file
+        # FastAPI closes the request's UploadFiles when the endpoint returns: give it an empty file to close
+        upload.file = tempfile.SpooledTemporaryFile()
+
+    def read_bytes(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    async def read(self):
+        return await asyncio.to_thread(self.read_bytes)
+
+    def close(self):
+        self.file.close()
+
+
+class SpoolingRequest(Request):
+    """
+    Request whose multipart form keeps each uploaded file in memory up to spool_threshold bytes and
+    spools it to disk above, instead of Starlette's fixed MultiPartParser.max_file_size of 1 MiB.
+
+    Mirrors the multipart branch of Request._get_form of Starlette 0.37, which creates its parser
+    without a way to pass the threshold; other content types are left to it.
+    """
+    spool_threshold = MultiPartParser.max_file_size
+
+    async def _get_form(self, *, max_files=1000, max_fields=1000):
+        if self._form is None:
+            content_type, _ = parse_options_header(self.headers.get('Content-Type'))
+            if content_type == b'multipart/form-data':
+                parser = MultiPartParser(self.headers, self.stream(), max_files=max_files, max_fields=max_fields)
+                parser.max_file_size = self.spool_threshold  # This parser only, not the class
+                try:
+                    self._form = await parser.parse()
+                except MultiPartException as exc:
+                    raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields)
+
+
+def spooling_route(spool_threshold):
+    """
+    APIRoute class whose endpoints parse multipart uploads with a SpoolingRequest, set as the
+    route_class of a router before its routes are declared.
+
+    Parameters:
+    - spool_threshold: Size in bytes above which an uploaded file is spooled to disk.
+    """
+    class SpoolingRoute(APIRoute):
+        def get_route_handler(self):
+            handler = super().get_route_handler()
+
+            async def spooling_handler(request):
+                request = SpoolingRequest(request.scope, request.receive)
+                request.spool_threshold = spool_threshold
+                return await handler(request)
+
+            return spooling_handler
+
+    return SpoolingRoute